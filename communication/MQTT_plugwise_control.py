@@ -1,4 +1,7 @@
 from plugwise.api import *
+from plugwise.groups import CircleGroup
+from plugwise.commands import PRIORITY_ACTUATION
+from plugwise.startup import LazyInitializer
 from time import sleep
 from datetime import datetime
 import paho.mqtt.client as mqtt
@@ -13,19 +16,52 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "mosquitto")   # Replace with your MQTT b
 MQTT_PORT = 1883
 MQTT_TOPIC_PLUS = "plugwise/control/plus"  # Topic for Circle+ commands
 MQTT_TOPIC_CIRCLE = "plugwise/control/circle"  # Topic for Circle commands
+MQTT_TOPIC_GROUP_PREFIX = "plugwise/control/group/"  # plugwise/control/group/<name> switches a whole group
 MQTT_CLIENT_ID = "plugwise_controller"
+RELAY_MAX_STALENESS = 60  # seconds the known relay state is trusted before asking the device
 
-# Initialize Plugwise Stick and devices
-stick = Stick(DEFAULT_PORT)
+# Initialize Plugwise Stick and devices, the reader thread lets the command queue
+# serialize the MQTT commands and the background initialization
+stick = Stick(DEFAULT_PORT, reader=True)
 circle_plus = Circle(PLUS_MAC, stick)
 circle = Circle(MAC, stick)
 
-# Set clock for both devices
-current_time = datetime.now()
-circle_plus.set_clock(current_time)
-sleep(1)
-circle.set_clock(current_time)
-sleep(1)
+# Groups of Circles that are switched together, all switch frames are sent back-to-back
+GROUPS = {
+    "all": CircleGroup([circle_plus, circle], name="all"),
+}
+
+DEVICE_NAMES = {circle_plus.mac: "Circle+", circle.mac: "Circle"}
+
+# Clock sync and state discovery run in the background through the command queue,
+# a device that gets a command before that is initialized first
+def device_ready(device, result):
+    name = DEVICE_NAMES[device.mac]
+    if isinstance(result, Exception):
+        print(f"{name} ({device.mac}) init failed: {result}")
+    elif result["relay_state"] == 1:
+        print(f"{name} ({device.mac}) is on")
+    else:
+        print(f"{name} ({device.mac}) is off")
+
+initializer = LazyInitializer(stick, [circle_plus, circle], callback=device_ready)
+
+# Switching runs in the command queue, ahead of the background initialization
+def switch_device(device, device_name, action):
+    try:
+        initializer.ensure(device)
+        # the relay state comes from the shadow kept by the Circle
+        if device.switch_if_needed(action == "on", max_staleness=RELAY_MAX_STALENESS):
+            print(f"Turning {action} {device_name} ({device.mac})...")
+        else:
+            print(f"{device_name} ({device.mac}) is already {action}")
+    except Exception as e:
+        print(f"Switching {device_name} ({device.mac}) {action} failed: {e}")
+
+def switch_group(group_name, group, action):
+    ready, results = initializer.ensure_all(group.circles)
+    results.update(CircleGroup(ready, name=group_name).switch(action == "on", max_staleness=RELAY_MAX_STALENESS))
+    print(f"Group {group_name}: switched {action} {len(results)} of {len(group.circles)} devices: {results}")
 
 # MQTT callback functions
 def on_connect(client, userdata, flags, rc):
@@ -33,7 +69,8 @@ def on_connect(client, userdata, flags, rc):
         print("Connected to MQTT broker")
         client.subscribe(MQTT_TOPIC_PLUS)
         client.subscribe(MQTT_TOPIC_CIRCLE)
-        print(f"Subscribed to {MQTT_TOPIC_PLUS} and {MQTT_TOPIC_CIRCLE}")
+        client.subscribe(MQTT_TOPIC_GROUP_PREFIX + "+")
+        print(f"Subscribed to {MQTT_TOPIC_PLUS}, {MQTT_TOPIC_CIRCLE} and {MQTT_TOPIC_GROUP_PREFIX}+")
     else:
         print(f"Failed to connect to MQTT broker with code: {rc}")
 
@@ -44,6 +81,18 @@ def on_message(client, userdata, msg):
         action = command.get("action")
         topic = msg.topic
 
+        # Switch a whole group in one round trip
+        if topic.startswith(MQTT_TOPIC_GROUP_PREFIX):
+            group_name = topic[len(MQTT_TOPIC_GROUP_PREFIX):]
+            group = GROUPS.get(group_name)
+            if group is None:
+                print(f"Unknown group: {group_name}")
+            elif action in ("on", "off"):
+                stick.execute(PRIORITY_ACTUATION, switch_group, group_name, group, action)
+            else:
+                print(f"Unknown action for group {group_name}: {action}")
+            return
+
         # Determine which device to control based on topic
         if topic == MQTT_TOPIC_PLUS:
             device = circle_plus
@@ -55,23 +104,8 @@ def on_message(client, userdata, msg):
             print(f"Unknown topic: {topic}")
             return
 
-        # Get current state
-        state = device.get_info()
-        print(f"{device_name} ({device.mac}) current state: {state['relay_state']}")
-
-        # Process action
-        if action == "on":
-            if state["relay_state"] == 0:
-                print(f"Turning on {device_name} ({device.mac})...")
-                device.switch_on()
-            else:
-                print(f"{device_name} ({device.mac}) is already on")
-        elif action == "off":
-            if state["relay_state"] == 1:
-                print(f"Turning off {device_name} ({device.mac})...")
-                device.switch_off()
-            else:
-                print(f"{device_name} ({device.mac}) is already off")
+        if action in ("on", "off"):
+            stick.execute(PRIORITY_ACTUATION, switch_device, device, device_name, action)
         else:
             print(f"Unknown action for {device_name} ({device.mac}): {action}")
 
@@ -86,15 +120,8 @@ mqtt_client.on_message = on_message
 # Connect to MQTT broker
 mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
 
-# Initial state check and print for both devices
-for device, name in [(circle_plus, "Circle+"), (circle, "Circle")]:
-    state = device.get_info()
-    print(f"{name} ({device.mac}) state: {state}")
-    if state["relay_state"] == 1:
-        print(f"{name} ({device.mac}) is on")
-    else:
-        print(f"{name} ({device.mac}) is off")
-    sleep(1)
+# Clocks and states of the devices are fetched in the background
+initializer.start()
 
 # Start MQTT loop
 try:
@@ -1,65 +1,254 @@
 from influxdb_client import InfluxDBClient
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from itertools import takewhile
+import atexit
+import json
+import logging
 import os
+import threading
+import time
+
+########## shared client ##########
+# One long-lived client (HTTP session + connection pool) for every query instead of
+# a new client per call. It is pinged when it has been idle for a while and
+# recreated after a failed query or ping.
+INFLUX_POOL_SIZE       = int(os.getenv("INFLUX_POOL_SIZE", "4"))           # HTTP connections kept open
+INFLUX_TIMEOUT_MS      = int(os.getenv("INFLUX_TIMEOUT_MS", "10000"))      # per request
+INFLUX_HEALTH_INTERVAL = float(os.getenv("INFLUX_HEALTH_INTERVAL", "60"))  # idle seconds before a ping
+
+_client: InfluxDBClient | None = None
+_client_used = 0.0                 # monotonic time of the last successful use
+_client_lock = threading.Lock()
+_stats: dict[str, list] = {}       # query name → [count, errors, total s, max s]
+_stats_lock = threading.Lock()
+
+
+def _new_client() -> InfluxDBClient:
+    return InfluxDBClient(url=os.environ["INFLUX_URL"],
+                          token=os.environ["INFLUX_TOKEN"],
+                          org=os.environ["INFLUX_ORG"],
+                          timeout=INFLUX_TIMEOUT_MS,
+                          connection_pool_maxsize=INFLUX_POOL_SIZE)
+
+
+def get_client() -> InfluxDBClient:
+    """The shared client, (re)connected if needed."""
+    global _client, _client_used
+    with _client_lock:
+        if _client is not None and time.monotonic() - _client_used > INFLUX_HEALTH_INTERVAL:
+            try:
+                healthy = _client.ping()
+            except Exception:
+                healthy = False
+            if not healthy:
+                logging.warning("InfluxDB ping failed, reconnecting")
+                _close(_client)
+                _client = None
+            else:
+                _client_used = time.monotonic()
+        if _client is None:
+            _client = _new_client()
+            _client_used = time.monotonic()
+        return _client
+
+
+def _close(client: InfluxDBClient) -> None:
+    try:
+        client.close()
+    except Exception as e:
+        logging.debug("closing InfluxDB client failed: %s", e)
+
+
+def close_client() -> None:
+    """Close the shared client, the next query opens a new one. Runs at exit."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _close(_client)
+            _client = None
+
+atexit.register(close_client)
+
+
+def _query(name: str, flux_query: str):
+    """Run the query on the shared client and record its latency under `name`."""
+    global _client, _client_used
+    client = get_client()
+    started = time.perf_counter()
+    try:
+        tables = client.query_api().query(org=os.environ["INFLUX_ORG"], query=flux_query)
+    except Exception:
+        _record(name, time.perf_counter() - started, failed=True)
+        # the connection might be broken, start over with a new client next time
+        with _client_lock:
+            if _client is client:
+                _close(client)
+                _client = None
+        raise
+    elapsed = time.perf_counter() - started
+    _record(name, elapsed)
+    with _client_lock:
+        _client_used = time.monotonic()
+    logging.debug("InfluxDB query %s took %.1f ms", name, elapsed * 1000)
+    return tables
+
+
+def _record(name: str, elapsed: float, failed: bool = False) -> None:
+    with _stats_lock:
+        entry = _stats.setdefault(name, [0, 0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += failed
+        entry[2] += elapsed
+        entry[3] = max(entry[3], elapsed)
+
+
+def query_stats() -> dict[str, dict]:
+    """Per query name: count, errors, average and max latency in ms."""
+    with _stats_lock:
+        return {name: {"count": count,
+                       "errors": errors,
+                       "avg_ms": round(total / count * 1000, 1),
+                       "max_ms": round(peak * 1000, 1)}
+                for name, (count, errors, total, peak) in _stats.items()}
+
+########## luminance ##########
+# The latest 10 s window mean of the light sensor, computed from a local buffer of
+# raw points. After the first call only the points since the last one seen (minus a
+# short overlap for late writes) are read, so the cost doesn't grow with the lookback.
+LUMINANCE_WINDOW_S    = 10      # same windows as aggregateWindow(every: 10s)
+LUMINANCE_LOOKBACK_S  = 2 * 3600   # older data doesn't count as current
+LUMINANCE_OVERLAP_S   = 30      # re-read this much before the last point for late writes
+LUMINANCE_BUFFER_SIZE = 360     # raw points kept (~1 h at one point per 10 s)
+
+_lum_points: deque = deque(maxlen=LUMINANCE_BUFFER_SIZE)   # (time, lux), oldest first
+_lum_lock = threading.Lock()
+
+
+def _flux_time(t: datetime) -> str:
+    return t.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _merge_luminance(points: list[tuple[datetime, float]]) -> None:
+    """Add new points to the buffer, skipping the ones the overlap read again."""
+    late = []
+    for t, v in points:
+        if not _lum_points or t > _lum_points[-1][0]:
+            _lum_points.append((t, v))
+        else:
+            late.append((t, v))
+    if late:
+        # rare: a point written after a newer one was already read
+        known = {t for t, _ in _lum_points}
+        late = [(t, v) for t, v in late if t not in known]
+        if late:
+            merged = sorted(list(_lum_points) + late)
+            _lum_points.clear()
+            _lum_points.extend(merged)
+
 
 def get_current_luminance():
-    url     = os.environ["INFLUX_URL"]
-    token   = os.environ["INFLUX_TOKEN"]
-    org     = os.environ["INFLUX_ORG"]
     bucket  = "zwave"
+    now     = datetime.now(timezone.utc)
+    oldest  = now - timedelta(seconds=LUMINANCE_LOOKBACK_S)
 
-    flux_query = f'''
-    from(bucket: "{bucket}")
-      |> range(start: -2h)
-      |> filter(fn: (r) =>
-          r._measurement == "sensor_data" and
-          r._field == "luminance" and
-          r.topic == "zwave/sensor_data"
-      )
-      |> group(columns: ["topic"])   
-      |> aggregateWindow(every: 10s, fn: mean, createEmpty: false)
-      |> last()
-    '''
+    with _lum_lock:
+        if _lum_points and _lum_points[-1][0] > oldest:
+            start = _flux_time(max(_lum_points[-1][0] - timedelta(seconds=LUMINANCE_OVERLAP_S), oldest))
+            limit = ""
+        else:
+            # cold start or everything in the buffer is too old: fill the buffer once
+            start = f"-{LUMINANCE_LOOKBACK_S}s"
+            limit = f"|> tail(n: {LUMINANCE_BUFFER_SIZE})"
 
-    with InfluxDBClient(url=url, token=token, org=org) as client:
-        tables = client.query_api().query(org=org, query=flux_query)
-        for table in tables:
+        flux_query = f'''
+        from(bucket: "{bucket}")
+          |> range(start: {start})
+          |> filter(fn: (r) =>
+              r._measurement == "sensor_data" and
+              r._field == "luminance" and
+              r.topic == "zwave/sensor_data"
+          )
+          |> group(columns: ["topic"])
+          |> sort(columns: ["_time"])
+          {limit}
+        '''
+
+        points = []
+        for table in _query("luminance", flux_query):
             for record in table.records:
-                # print(">>> Got record:", record)
-                return float(record.get_value())
+                points.append((record.get_time(), float(record.get_value())))
+        _merge_luminance(sorted(points))
+
+        if not _lum_points or _lum_points[-1][0] <= oldest:
+            print(">>> No luminance data found.")
+            return None
 
-    print(">>> No luminance data found.")
-    return None
+        # mean of the last window, the windows are aligned to the epoch like aggregateWindow
+        window = int(_lum_points[-1][0].timestamp() // LUMINANCE_WINDOW_S)
+        values = [v for t, v in takewhile(lambda p: int(p[0].timestamp() // LUMINANCE_WINDOW_S) == window,
+                                          reversed(_lum_points))]
+        return sum(values) / len(values)
 
 
 ###############################plugwise###########
-def _get_current_power(topic: str,
-                       bucket: str = "zwave",
-                       measurement: str = "plugwise_power",
-                       field: str = "power",
-                       window: str = "-15s") -> float | None:
+def get_latest_values(series: list[tuple[str, str, str]],
+                      bucket: str = "zwave",
+                      window: str = "-15s") -> dict[tuple[str, str, str], float | None]:
+    """
+    Latest value of each (measurement, field, topic) series within `window`,
+    all in one pivoted Flux query. Series without data in the window map to None.
+    Points of a series that differ in other tags (e.g. host) count as one series.
+    """
+    series = list(dict.fromkeys(series))
+    if not series:
+        return {}
 
-    url   = os.environ["INFLUX_URL"]
-    token = os.environ["INFLUX_TOKEN"]
-    org   = os.environ["INFLUX_ORG"]
+    predicate = " or\n          ".join(
+        f"(r._measurement == {json.dumps(m)} and r._field == {json.dumps(f)} and r.topic == {json.dumps(t)})"
+        for m, f, t in series)
 
     flux_query = f'''
     from(bucket: "{bucket}")
       |> range(start: {window})
       |> filter(fn: (r) =>
-          r._measurement == "{measurement}" and
-          r._field       == "{field}"       and
-          r.topic        == "{topic}"
+          {predicate}
       )
+      |> map(fn: (r) => ({{r with _value: float(v: r._value)}}))
+      |> group(columns: ["_measurement", "_field", "topic"])
+      |> sort(columns: ["_time"])
       |> last()
+      |> map(fn: (r) => ({{_start: r._start, _value: r._value,
+                          series: r._measurement + "|" + r._field + "|" + r.topic}}))
+      |> group()
+      |> pivot(rowKey: ["_start"], columnKey: ["series"], valueColumn: "_value")
     '''
 
-    with InfluxDBClient(url=url, token=token, org=org) as client:
-        tables = client.query_api().query(org=org, query=flux_query)
-        for table in tables:
-            for record in table.records:
-                return float(record.get_value())
+    values = {}
+    for table in _query("latest_values", flux_query):
+        for record in table.records:
+            values.update(record.values)
+
+    result = {}
+    for m, f, t in series:
+        value = values.get(f"{m}|{f}|{t}")
+        result[(m, f, t)] = None if value is None else float(value)
+    return result
+
+
+def _get_current_power(topic: str,
+                       bucket: str = "zwave",
+                       measurement: str = "plugwise_power",
+                       field: str = "power",
+                       window: str = "-15s") -> float | None:
+    key = (measurement, field, topic)
+    return get_latest_values([key], bucket=bucket, window=window)[key]
 
-    return None
+
+def get_powers(topics: list[str], window: str = "-15s") -> dict[str, float | None]:
+    """Power of several plugs with one query, topic → W (None without recent data)."""
+    latest = get_latest_values([("plugwise_power", "power", t) for t in topics], window=window)
+    return {t: latest[("plugwise_power", "power", t)] for t in topics}
 
 
 
@@ -78,3 +267,57 @@ def get_power_circle() -> float | None:
 
 ##################Set a luminance getter every 10 second
 
+
+################ history for the lux model ################
+def get_luminance_history(start: str = "-7d",
+                          every: str = "30s",
+                          bucket: str = "zwave") -> list[tuple[datetime, float]]:
+    """(time, lux) pairs of the sensor, averaged over `every`, oldest first."""
+
+    flux_query = f'''
+    from(bucket: "{bucket}")
+      |> range(start: {start})
+      |> filter(fn: (r) =>
+          r._measurement == "sensor_data" and
+          r._field == "luminance" and
+          r.topic == "zwave/sensor_data"
+      )
+      |> group(columns: ["topic"])
+      |> aggregateWindow(every: {every}, fn: mean, createEmpty: false)
+    '''
+
+    series = []
+    for table in _query("luminance_history", flux_query):
+        for record in table.records:
+            series.append((record.get_time(), float(record.get_value())))
+
+    series.sort(key=lambda p: p[0])
+    return series
+
+
+def get_control_events(topics: list[str],
+                       start: str = "-7d",
+                       bucket: str = "zwave") -> list[tuple[datetime, str, str]]:
+    """(time, topic, action) of the on/off commands sent to the lamps, oldest first."""
+
+    flux_query = f'''
+    from(bucket: "{bucket}")
+      |> range(start: {start})
+      |> filter(fn: (r) =>
+          r._measurement == "plugwise_control" and
+          contains(value: r.topic, set: {json.dumps(topics)})
+      )
+      |> keep(columns: ["_time", "topic", "action"])
+      |> group()
+      |> sort(columns: ["_time"])
+    '''
+
+    events = set()
+    for table in _query("control_events", flux_query):
+        for record in table.records:
+            action = record.values.get("action")
+            if action in ("on", "off"):
+                events.add((record.get_time(), record.values["topic"], action))
+
+    return sorted(events)
+
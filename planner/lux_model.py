@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+每盏灯的照度贡献模型
+从 InfluxDB 的历史数据中学习每盏灯打开后能增加多少 lux：
+- plugwise_control：发给每盏灯的 on/off 命令（按 topic 区分灯）
+- sensor_data：光照传感器的 luminance
+
+对每次开/关灯事件，比较事件前一段时间与传感器稳定后一段时间的平均照度，
+差值就是这盏灯的一个贡献样本（关灯取相反数）；取中位数以抵抗日光变化。
+窗口内还有其他灯被操作的事件会被丢弃，避免把两盏灯的效果混在一起。
+
+有了贡献值，就可以一次选出能让照度落入 [LOW_THRESHOLD, HIGH_THRESHOLD]
+的整组灯，而不是每轮只开/关一盏再等传感器稳定。
+"""
+from __future__ import annotations
+
+import bisect
+import itertools
+import logging
+import statistics
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from influx_utils import get_control_events, get_luminance_history
+
+BEFORE_WINDOW = timedelta(seconds=60)   # 事件前取多长时间的照度作为基线
+SETTLE_DELAY = timedelta(seconds=30)    # 事件后等传感器稳定的时间
+AFTER_WINDOW = timedelta(seconds=60)    # 稳定后取多长时间的照度
+MIN_SAMPLES = 3                         # 样本少于此数时使用默认贡献值
+
+
+@dataclass
+class LuxModel:
+    """每盏灯的照度贡献 (lux)，以及每盏灯用于拟合的样本数（0 表示用的是默认值）。"""
+    contributions: Dict[str, float]
+    samples: Dict[str, int] = field(default_factory=dict)
+
+    def ambient(self, lux: float, states: Dict[str, bool]) -> float:
+        """从当前照度减去已开灯的贡献，估计环境光（不小于 0）。"""
+        lit = sum(self.contributions.get(l, 0.0) for l, on in states.items() if on)
+        return max(lux - lit, 0.0)
+
+    def predict(self, ambient: float, on_lamps: Sequence[str]) -> float:
+        return ambient + sum(self.contributions.get(l, 0.0) for l in on_lamps)
+
+
+def fit_model(
+    events: Sequence[Tuple[datetime, str, str]],
+    series: Sequence[Tuple[datetime, float]],
+    lamp_of_topic: Dict[str, str],
+    default: float,
+) -> LuxModel:
+    """
+    events: (time, topic, "on"/"off")，按时间排序
+    series: (time, lux)，按时间排序
+    lamp_of_topic: topic → 灯名；不在其中的事件只用于判断窗口是否受干扰
+    """
+    times = [t for t, _ in series]
+    values = [v for _, v in series]
+    event_times = [t for t, _, _ in events]
+
+    def mean_between(start: datetime, end: datetime) -> Optional[float]:
+        lo, hi = bisect.bisect_left(times, start), bisect.bisect_left(times, end)
+        return statistics.fmean(values[lo:hi]) if hi > lo else None
+
+    per_lamp: Dict[str, List[float]] = {l: [] for l in lamp_of_topic.values()}
+    last_action: Dict[str, str] = {}
+    for t, topic, action in events:
+        lamp = lamp_of_topic.get(topic)
+        if lamp is None:
+            continue
+        # 重复的命令没有改变灯的状态，不能作为样本
+        repeated = last_action.get(lamp) == action
+        last_action[lamp] = action
+        if repeated:
+            continue
+
+        start, end = t - BEFORE_WINDOW, t + SETTLE_DELAY + AFTER_WINDOW
+        lo, hi = bisect.bisect_left(event_times, start), bisect.bisect_right(event_times, end)
+        if hi - lo > 1:
+            continue  # 窗口内还有别的开关事件
+
+        before = mean_between(start, t)
+        after = mean_between(t + SETTLE_DELAY, end)
+        if before is None or after is None:
+            continue
+        delta = after - before
+        per_lamp[lamp].append(delta if action == "on" else -delta)
+
+    contributions: Dict[str, float] = {}
+    samples: Dict[str, int] = {}
+    for lamp, deltas in per_lamp.items():
+        if len(deltas) >= MIN_SAMPLES:
+            contributions[lamp] = max(statistics.median(deltas), 0.0)
+            samples[lamp] = len(deltas)
+        else:
+            contributions[lamp] = default
+            samples[lamp] = 0
+    return LuxModel(contributions, samples)
+
+
+def learn_model(topic_map: Dict[str, str], default: float, history: str = "-7d") -> LuxModel:
+    """查询 InfluxDB 历史并拟合模型；查询失败时所有灯使用默认贡献值。"""
+    lamp_of_topic = {topic: lamp for lamp, topic in topic_map.items()}
+    try:
+        events = get_control_events(list(lamp_of_topic), start=history)
+        series = get_luminance_history(start=history)
+    except Exception as e:
+        logging.warning("读取照度模型历史数据失败，使用默认贡献 %.0f lux：%s", default, e)
+        return LuxModel({l: default for l in topic_map}, {l: 0 for l in topic_map})
+
+    model = fit_model(events, series, lamp_of_topic, default)
+    logging.info("照度模型：%d 个开关事件，%d 个照度点 → 贡献 %s（样本数 %s）",
+                 len(events), len(series),
+                 {l: round(c, 1) for l, c in model.contributions.items()}, model.samples)
+    return model
+
+
+def choose_lamps(
+    model: LuxModel,
+    lux: float,
+    states: Dict[str, bool],
+    lamps: List[str],
+    low: float,
+    high: float,
+) -> Optional[Tuple[str, List[str]]]:
+    """
+    选出一步就能让照度落入 [low, high] 的一组灯。
+    太暗时只在关着的灯里选要打开的，太亮时只在开着的灯里选要关掉的（与领域的
+    dark/bright 前提一致）。评价依次为：离区间的距离、操作的灯数、离区间中点的距离；
+    同分时按 lamps 顺序优先。返回 ("turn-on"/"turn-off", 灯列表)，无可操作灯返回 None。
+    """
+    if lux < low:
+        action, pool = "turn-on", [l for l in lamps if not states.get(l, False)]
+    elif lux > high:
+        action, pool = "turn-off", [l for l in lamps if states.get(l, False)]
+    else:
+        return None
+    if not pool:
+        return None
+
+    ambient = model.ambient(lux, {l: states.get(l, False) for l in lamps})
+    lit = [l for l in lamps if states.get(l, False)]
+    middle = (low + high) / 2
+
+    best: Optional[Tuple[Tuple[float, int, float], List[str]]] = None
+    for size in range(1, len(pool) + 1):
+        for chosen in itertools.combinations(pool, size):
+            on_lamps = lit + list(chosen) if action == "turn-on" else [l for l in lit if l not in chosen]
+            predicted = model.predict(ambient, on_lamps)
+            distance = max(low - predicted, predicted - high, 0.0)
+            score = (distance, size, abs(predicted - middle))
+            if best is None or score < best[0]:
+                best = (score, list(chosen))
+    return action, best[1]
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+进程内 STRIPS 规划引擎
+启动时解析并实例化 (ground) 一次 domain.pddl，之后每次决策只做内存中的 BFS，
+不再为每个决策启动 pyperplan 子进程、重复解析 PDDL、再用正则解析输出。
+
+只支持 light-control 这类 :strips 领域：
+- 参数可带类型（类型会被忽略，所有对象都可代入）
+- 前提条件是原子或 (and ...) 的合取
+- 效果是原子、(not 原子) 或它们的 (and ...)
+
+事实用元组表示，例如 ("lamp-on", "l1")、("dark",)；
+动作同样是元组，例如 ("turn-on", "l1")。
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+Fact = Tuple[str, ...]
+Action = Tuple[str, ...]
+SExpr = Union[str, list]
+
+
+# =============== PDDL 读取 ================
+
+def _tokenize(text: str) -> List[str]:
+    # 去掉 ; 注释，小写化（PDDL 不区分大小写）
+    lines = [line.split(";", 1)[0] for line in text.splitlines()]
+    return " ".join(lines).lower().replace("(", " ( ").replace(")", " ) ").split()
+
+
+def parse_sexpr(text: str) -> SExpr:
+    """把 PDDL 文本解析成嵌套列表。"""
+    stack: List[list] = [[]]
+    for tok in _tokenize(text):
+        if tok == "(":
+            stack.append([])
+        elif tok == ")":
+            if len(stack) == 1:
+                raise ValueError("PDDL 括号不匹配：多余的 ')'")
+            expr = stack.pop()
+            stack[-1].append(expr)
+        else:
+            stack[-1].append(tok)
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError("PDDL 括号不匹配或包含多个顶层表达式")
+    return stack[0][0]
+
+
+def _variables(params: list) -> List[str]:
+    """(?a ?b - type ?c) → ["?a", "?b", "?c"]，类型被忽略。"""
+    out: List[str] = []
+    skip = False
+    for tok in params:
+        if skip:
+            skip = False
+        elif tok == "-":
+            skip = True
+        else:
+            out.append(tok)
+    return out
+
+
+def _conjunction(expr: SExpr, what: str) -> List[list]:
+    if expr == [] or expr == ["and"]:
+        return []
+    if isinstance(expr, list) and expr and expr[0] == "and":
+        return expr[1:]
+    if isinstance(expr, list):
+        return [expr]
+    raise ValueError(f"无法解析的{what}: {expr}")
+
+
+@dataclass(frozen=True)
+class Schema:
+    """未实例化的动作模式。"""
+    name: str
+    params: Tuple[str, ...]
+    pre: Tuple[Fact, ...]
+    add: Tuple[Fact, ...]
+    delete: Tuple[Fact, ...]
+
+
+def parse_domain(text: str) -> Tuple[str, List[Schema]]:
+    """返回 (领域名, 动作模式列表)。"""
+    tree = parse_sexpr(text)
+    if not (isinstance(tree, list) and tree[:1] == ["define"]):
+        raise ValueError("domain 文件必须以 (define ...) 开头")
+
+    name = ""
+    schemas: List[Schema] = []
+    for part in tree[1:]:
+        if not isinstance(part, list) or not part:
+            continue
+        if part[0] == "domain":
+            name = part[1]
+        elif part[0] == ":action":
+            fields = dict(zip(part[2::2], part[3::2]))
+            pre: List[Fact] = []
+            for atom in _conjunction(fields.get(":precondition", []), "前提条件"):
+                if atom and atom[0] in ("not", "or", "forall", "exists", "imply", "when"):
+                    raise ValueError(f"动作 {part[1]} 的前提条件不是 STRIPS: {atom}")
+                pre.append(tuple(atom))
+            add: List[Fact] = []
+            delete: List[Fact] = []
+            for atom in _conjunction(fields.get(":effect", []), "效果"):
+                if atom and atom[0] == "not":
+                    delete.append(tuple(atom[1]))
+                elif atom and atom[0] in ("when", "forall", "increase", "decrease"):
+                    raise ValueError(f"动作 {part[1]} 的效果不是 STRIPS: {atom}")
+                else:
+                    add.append(tuple(atom))
+            schemas.append(Schema(part[1], tuple(_variables(fields.get(":parameters", []))),
+                                  tuple(pre), tuple(add), tuple(delete)))
+    return name, schemas
+
+
+# =============== 实例化后的领域 ================
+
+@dataclass(frozen=True)
+class Operator:
+    """实例化后的动作，前提/增加/删除都编码成事实位图。"""
+    action: Action
+    pre: int
+    add: int
+    delete: int
+
+
+class GroundedDomain:
+    """
+    一次性解析并实例化的领域。状态是整数位图，每个事实占一位，
+    因此后继状态计算只是几次位运算。
+
+    用法:
+        engine = GroundedDomain.from_file(DOMAIN_FILE, ["l1", "l2"])
+        engine.plan({("dark",), ("lamp-off", "l1")}, {("lamp-on", "l1")})
+        # → [("turn-on", "l1")]
+    """
+
+    def __init__(self, domain_text: str, objects: Iterable[str]):
+        self.name, self.schemas = parse_domain(domain_text)
+        self.objects: Tuple[str, ...] = tuple(o.lower() for o in objects)
+        self.facts: List[Fact] = []
+        self.index: Dict[Fact, int] = {}
+        self.operators: List[Operator] = []
+        self._ground()
+
+    @classmethod
+    def from_file(cls, domain_file: Path, objects: Iterable[str]) -> "GroundedDomain":
+        return cls(Path(domain_file).read_text(encoding="utf-8"), objects)
+
+    def _bit(self, fact: Fact) -> int:
+        if fact not in self.index:
+            self.index[fact] = len(self.facts)
+            self.facts.append(fact)
+        return 1 << self.index[fact]
+
+    def _mask(self, atoms: Iterable[Fact], binding: Dict[str, str]) -> int:
+        mask = 0
+        for atom in atoms:
+            mask |= self._bit(tuple(binding.get(t, t) for t in atom))
+        return mask
+
+    def _ground(self) -> None:
+        for schema in self.schemas:
+            for values in itertools.product(self.objects, repeat=len(schema.params)):
+                binding = dict(zip(schema.params, values))
+                self.operators.append(Operator(
+                    action=(schema.name,) + values,
+                    pre=self._mask(schema.pre, binding),
+                    add=self._mask(schema.add, binding),
+                    delete=self._mask(schema.delete, binding),
+                ))
+        logging.info("领域 %s 实例化完成：%d 个事实，%d 个动作",
+                     self.name, len(self.facts), len(self.operators))
+
+    def encode(self, facts: Iterable[Fact]) -> int:
+        """事实集合 → 位图；领域中不存在的事实会报错。"""
+        mask = 0
+        for fact in facts:
+            fact = tuple(t.lower() for t in fact)
+            if fact not in self.index:
+                raise ValueError(f"领域 {self.name} 中没有事实 {fact}")
+            mask |= 1 << self.index[fact]
+        return mask
+
+    def decode(self, state: int) -> FrozenSet[Fact]:
+        return frozenset(f for i, f in enumerate(self.facts) if state >> i & 1)
+
+    def plan(self, init: Iterable[Fact], goal: Iterable[Fact]) -> Optional[List[Action]]:
+        """
+        广度优先搜索最短计划。
+        返回动作列表（目标已满足时为空列表），无解返回 None。
+        """
+        return self.search(self.encode(init), self.encode(goal))
+
+    def search(self, start: int, goal_mask: int) -> Optional[List[Action]]:
+        """与 plan 相同，但初始状态和目标已经编码成位图。"""
+        if start & goal_mask == goal_mask:
+            return []
+
+        parents: Dict[int, Tuple[int, Action]] = {start: (start, ())}
+        queue = deque([start])
+        while queue:
+            state = queue.popleft()
+            for op in self.operators:
+                if state & op.pre != op.pre:
+                    continue
+                succ = (state & ~op.delete) | op.add
+                if succ in parents:
+                    continue
+                parents[succ] = (state, op.action)
+                if succ & goal_mask == goal_mask:
+                    plan: List[Action] = []
+                    while succ != start:
+                        succ, action = parents[succ]
+                        plan.append(action)
+                    plan.reverse()
+                    return plan
+                queue.append(succ)
+        return None
+
+
+# =============== 计划缓存 ================
+
+class PlanCache:
+    """
+    带 LRU 淘汰的计划缓存。键是初始状态和目标的位图 (init, goal)，
+    与事实的书写顺序、大小写无关；无解 (None) 同样会被缓存。
+    domain.pddl 的修改时间或大小变化时重新实例化领域并清空缓存。
+
+    用法:
+        cache = PlanCache(DOMAIN_FILE, ["l1", "l2"], maxsize=128)
+        cache.plan(init, goal)
+        cache.hits, cache.misses
+    """
+
+    def __init__(self, domain_file: Path, objects: Iterable[str], maxsize: int = 128):
+        self.domain_file = Path(domain_file)
+        self.objects = tuple(objects)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._plans: "OrderedDict[Tuple[int, int], Optional[Tuple[Action, ...]]]" = OrderedDict()
+        self._signature: Optional[Tuple[int, int]] = self._stat()
+        self.engine = GroundedDomain.from_file(self.domain_file, self.objects)
+
+    def _stat(self) -> Tuple[int, int]:
+        st = os.stat(self.domain_file)
+        return st.st_mtime_ns, st.st_size
+
+    def _check_domain(self) -> None:
+        try:
+            signature = self._stat()
+        except OSError as e:
+            # 文件被删除或正在被替换时继续使用旧的领域
+            if self._signature is not None:
+                logging.error("无法读取 %s，继续使用旧的领域：%s", self.domain_file.name, e)
+                self._signature = None
+            return
+        if signature == self._signature:
+            return
+        # 先解析新领域，解析失败则继续使用旧的领域和缓存；
+        # 失败的签名同样记下来，文件再次修改前不会每次决策都重新解析
+        self._signature = signature
+        try:
+            engine = GroundedDomain.from_file(self.domain_file, self.objects)
+        except (OSError, ValueError, IndexError) as e:
+            logging.error("重新解析 %s 失败，继续使用旧的领域：%s", self.domain_file.name, e)
+            return
+        self.engine = engine
+        self._plans.clear()
+        self.reloads += 1
+        logging.info("%s 已修改，重新实例化领域并清空计划缓存", self.domain_file.name)
+
+    def plan(self, init: Iterable[Fact], goal: Iterable[Fact]) -> Optional[List[Action]]:
+        """同 GroundedDomain.plan，但先查缓存。"""
+        self._check_domain()
+        key = (self.engine.encode(init), self.engine.encode(goal))
+        if key in self._plans:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            plan = self._plans[key]
+        else:
+            self.misses += 1
+            found = self.engine.search(*key)
+            plan = None if found is None else tuple(found)
+            self._plans[key] = plan
+            if len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+        return None if plan is None else list(plan)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._plans), "reloads": self.reloads}
@@ -1,33 +1,42 @@
 # -*- coding: utf-8 -*-
 """
-智能灯光控制主程序（增量式）
-每 10 秒读取一次当前光照值 (lux)，如果太暗就一次只开一盏灯；
-如果太亮就一次只关一盏灯。每次动作后等待传感器缓冲，再继续判断。
+智能灯光控制主程序
+订阅 MQTT 上的光照传感器数据 (lux)，每来一个样本就判断一次（长时间没有样本时
+改为从 InfluxDB 查询）；如果太暗或太亮，就根据学到的每盏灯照度贡献
+一次选出能回到目标区间的整组灯来开/关。每次动作后等待传感器缓冲，再继续判断。
 
 依赖:
-- pyperplan  (pip install pyperplan)
 - paho-mqtt  (pip install paho-mqtt)
-- influx_utils.get_current_luminance 
+- influx_utils.get_current_luminance（没有实时样本时的后备）
+- pddl_engine（进程内规划，启动时解析并实例化 domain.pddl 一次）
+- lux_model（从 InfluxDB 历史学习每盏灯的照度贡献）
 - domain.pddl                        
 """
 from __future__ import annotations
 
 import json
 import logging
-import re
-import subprocess
+import threading
 import time
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 import paho.mqtt.client as mqtt
-from influx_utils import get_current_luminance  # 每 10 秒返回一次 lux 浮点值
+from influx_utils import get_current_luminance, query_stats  # 后备：从 InfluxDB 读最近的 lux
+from lux_model import LuxModel, choose_lamps, learn_model
+from pddl_engine import Fact, PlanCache
 
 # ================== 参数区 ==================
-LOW_THRESHOLD = 100      # lux < 100  → 太暗，需要增加亮度（一次开一盏）
-HIGH_THRESHOLD = 300     # lux > 300  → 太亮，需要降低亮度（一次关一盏）
-CHECK_INTERVAL = 10      # 正常巡检间隔（秒）
+LOW_THRESHOLD = 100      # lux < 100  → 太暗，需要增加亮度
+HIGH_THRESHOLD = 300     # lux > 300  → 太亮，需要降低亮度
+CHECK_INTERVAL = 10      # 轮询模式下的巡检间隔（秒）
+EVENT_DRIVEN = True      # True：每个 MQTT 传感器样本到达就判断；False：按 CHECK_INTERVAL 轮询 InfluxDB
+LIVE_SAMPLE_TIMEOUT = 30    # 超过这么多秒没有新的 MQTT 样本，就改用 InfluxDB 查询
 SENSOR_SETTLE_SECONDS = 30  # 执行动作后等待传感器“缓冲/更新”的时间（秒）
+PLAN_CACHE_SIZE = 128    # 计划缓存最多保存的 (初始状态, 目标) 组合数
+LAMP_LUX_DEFAULT = 150.0    # 历史样本不足时假设每盏灯贡献的 lux
+LUX_MODEL_HISTORY = "-7d"   # 学习照度模型使用的历史范围
+LUX_MODEL_REFRESH = 3600    # 每隔多少秒重新学习一次照度模型
 
 # ================ MQTT 参数 ================
 TOPIC_MAP: Dict[str, str] = {
@@ -42,12 +51,10 @@ MQTT_RETAIN = False
 MQTT_KEEPALIVE = 60
 MQTT_USERNAME: Optional[str] = None
 MQTT_PASSWORD: Optional[str] = None
+SENSOR_TOPIC = "zwave/sensor_data"   # JSON，"Luminance" 键是 lux，约 10 秒一条
 
-# ================ 正则与路径 ================
-STEP_RE = re.compile(r"\(\s*([^\s()]+)\s+([^\s()]+)\s*\)", re.I)  # 捕获: (ACTION LAMP)
+# ================ 路径 ================
 BASE_DIR = Path(__file__).resolve().parent
-PROBLEM_FILE = BASE_DIR / "problem.pddl"
-SOLN_FILE = PROBLEM_FILE.with_suffix(PROBLEM_FILE.suffix + ".soln")  # problem.pddl → problem.pddl.soln
 DOMAIN_FILE = BASE_DIR / "domain.pddl"
 STATE_FILE = BASE_DIR / "lamp_state.json"
 
@@ -70,88 +77,104 @@ def save_states(states: Dict[str, bool]) -> None:
     except Exception as e:
         logging.error("保存灯状态失败：%s", e)
 
-# =============== 规划问题生成（一次只操作一盏） ================
+# =============== 规划问题生成（一次到位，可同时操作多盏） ================
 
-def decide_goal(lux: float, states: Dict[str, bool], lamps: List[str]) -> Optional[Tuple[str, str]]:
+def decide_goal(
+    lux: float, states: Dict[str, bool], lamps: List[str], model: LuxModel
+) -> Optional[Tuple[str, List[str]]]:
     """
-    根据 lux 与当前灯状态，决定本轮目标动作（一次只动一盏）。
-    返回 (action, lamp) 如 ("turn-on", "l1") 或 ("turn-off", "l2")。无动作则返回 None。
+    根据 lux、当前灯状态与照度模型，决定本轮要操作的整组灯。
+    返回 (action, [lamp, ...]) 如 ("turn-on", ["l1", "l2"])。
+    在 [LOW_THRESHOLD, HIGH_THRESHOLD] 之间或无可操作灯时返回 None。
     """
-    if lux < LOW_THRESHOLD:
-        # 需要更亮：找第一盏关闭的灯来开
-        for l in lamps:
-            if not states.get(l, False):
-                return ("turn-on", l)
-        return None  # 都已开，无能为力，等下一轮
-    elif lux > HIGH_THRESHOLD:
-        # 需要更暗：找第一盏开启的灯来关（也可反向优先，这里沿用同顺序）
-        for l in lamps:
-            if states.get(l, False):
-                return ("turn-off", l)
-        return None  # 都已关，无能为力，等下一轮
-    else:
-        # 在 [LOW_THRESHOLD, HIGH_THRESHOLD] 之间，保持不动
-        return None
+    return choose_lamps(model, lux, states, lamps, LOW_THRESHOLD, HIGH_THRESHOLD)
 
 def build_problem_for_action(
-    action: str, lamp: str, states: Dict[str, bool], lamps: List[str]
-) -> None:
+    action: str, targets: List[str], states: Dict[str, bool], lamps: List[str]
+) -> Tuple[List[Fact], List[Fact]]:
     """
-    写出只为一个动作设计的 PDDL 问题。初始状态使用真实的灯状态；
+    构造规划问题，返回内存中的 (init, goal) 事实列表。
+    初始状态使用真实的灯状态；
     亮/暗标识使用动作需要的全局 flag（turn-on 需要 dark，turn-off 需要 bright）。
-    目标只要求该灯达到目标状态。
+    目标要求 targets 中的每盏灯都达到目标状态。
     """
     if action == "turn-on":
-        flag = "(dark)"
-        goal = f"(lamp-on {lamp})"
+        flag = ("dark",)
+        goal = [("lamp-on", l) for l in targets]
     elif action == "turn-off":
-        flag = "(bright)"
-        goal = f"(lamp-off {lamp})"
+        flag = ("bright",)
+        goal = [("lamp-off", l) for l in targets]
     else:
         raise ValueError(f"未知动作: {action}")
 
-    init_states = [f"(lamp-on {l})" if states.get(l, False) else f"(lamp-off {l})" for l in lamps]
-    PROBLEM_FILE.write_text(
-        f"""(define (problem light-problem)
-  (:domain light-control)
-  (:objects {' '.join(lamps)})
-  (:init {flag} {' '.join(init_states)})
-  (:goal (and {goal}))
-)""",
-        encoding="utf-8",
-    )
+    init = [flag] + [("lamp-on", l) if states.get(l, False) else ("lamp-off", l) for l in lamps]
+    return init, goal
 
 # =============== 调用 Planner ===============
 
-def run_planner() -> List[Tuple[str, str]]:
-    """调用 pyperplan BFS，返回 (action, lamp) 对列表（小写）。"""
-    cmd = ["python3", "-m", "pyperplan", "-s", "bfs", str(DOMAIN_FILE), str(PROBLEM_FILE)]
+def run_planner(planner: PlanCache, init: List[Fact], goal: List[Fact]) -> List[Tuple[str, str]]:
+    """在进程内做 BFS（先查计划缓存），返回 (action, lamp) 对列表（小写）。"""
+    started = time.perf_counter()
     try:
-        out = subprocess.check_output(cmd, text=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logging.error("Planner failed (exit %d):\n%s", e.returncode, e.output)
+        plan = planner.plan(init, goal)
+    except ValueError as e:
+        logging.error("规划问题无效：%s", e)
+        return []
+    logging.debug("规划耗时 %.1f µs：%s", (time.perf_counter() - started) * 1e6, plan)
+    logging.info("计划缓存：命中 %(hits)d / 未命中 %(misses)d（缓存 %(size)d 条，领域重载 %(reloads)d 次）",
+                 planner.stats())
+
+    if plan is None:
+        logging.warning("规划无解：init=%s goal=%s", init, goal)
         return []
-    logging.debug(out)
+    return [(a[0], a[1]) for a in plan]
 
-    pairs: List[Tuple[str, str]] = []
+# ================ 实时光照样本 =================
 
-    # 1) 优先解析 .soln 文件
-    if SOLN_FILE.exists():
-        for line in SOLN_FILE.read_text(encoding="utf-8").splitlines():
-            if m := STEP_RE.search(line):
-                pairs.append((m.group(1).lower(), m.group(2).lower()))
+class LiveLuminance:
+    """保存 MQTT 上收到的最新光照样本，主循环可以等待下一个样本。"""
 
-    # 2) 备用：从 stdout 解析
-    if not pairs:
-        for line in out.splitlines():
-            if m := STEP_RE.search(line):
-                pairs.append((m.group(1).lower(), m.group(2).lower()))
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.seq = 0              # 已收到的样本数，用来区分新旧样本
+        self.lux: Optional[float] = None
 
-    return pairs
+    def update(self, lux: float) -> None:
+        with self._cond:
+            self.seq += 1
+            self.lux = lux
+            self._cond.notify_all()
+
+    def wait_next(self, after_seq: int, timeout: float) -> Optional[Tuple[int, float]]:
+        """等待序号大于 after_seq 的样本，返回 (seq, lux)；超时返回 None。"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > after_seq, timeout=timeout):
+                return None
+            return self.seq, self.lux
+
+def next_luminance(live: Optional[LiveLuminance], after_seq: int) -> Tuple[int, Optional[float], str]:
+    """
+    取下一个要评估的光照值，返回 (seq, lux, 来源)。
+    事件驱动模式下等待新的 MQTT 样本；LIVE_SAMPLE_TIMEOUT 内没有样本（或轮询模式）
+    才查询 InfluxDB。InfluxDB 也没有数据时 lux 为 None。
+    """
+    if live is not None:
+        sample = live.wait_next(after_seq, LIVE_SAMPLE_TIMEOUT)
+        if sample is not None:
+            return sample[0], sample[1], "MQTT"
+        logging.warning("%d 秒内没有收到 %s 样本，改用 InfluxDB。", LIVE_SAMPLE_TIMEOUT, SENSOR_TOPIC)
+    else:
+        time.sleep(CHECK_INTERVAL)
+    try:
+        lux = get_current_luminance()
+    except Exception as e:
+        logging.error("从 InfluxDB 读取光照失败：%s", e)
+        lux = None
+    return after_seq, None if lux is None else float(lux), "InfluxDB"
 
 # ================ MQTT 封装 =================
 
-def build_mqtt_client() -> mqtt.Client:
+def build_mqtt_client(live: Optional[LiveLuminance] = None) -> mqtt.Client:
     client = mqtt.Client(client_id="light-planner-controller")
     if MQTT_USERNAME:
         client.username_pw_set(MQTT_USERNAME, password=MQTT_PASSWORD)
@@ -159,15 +182,29 @@ def build_mqtt_client() -> mqtt.Client:
     def _on_connect(c, u, f, rc):
         if rc == 0:
             logging.info("已连接 MQTT broker %s:%d", MQTT_HOST, MQTT_PORT)
+            if live is not None:
+                # 每次（重新）连接都要重新订阅
+                c.subscribe(SENSOR_TOPIC, qos=0)
+                logging.info("已订阅光照传感器 %s", SENSOR_TOPIC)
         else:
             logging.error("MQTT 连接失败，错误码: %s", rc)
 
+    def _on_message(c, u, msg):
+        try:
+            lux = json.loads(msg.payload.decode("utf-8")).get("Luminance")
+            if lux is not None:
+                live.update(float(lux))
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.warning("无法解析 %s 消息：%s", msg.topic, e)
+
     def _on_disconnect(c, u, rc):
         if rc != 0:
             logging.warning("MQTT 非正常断开（rc=%s），将由客户端自动重连。", rc)
 
     client.on_connect = _on_connect
     client.on_disconnect = _on_disconnect
+    if live is not None:
+        client.message_callback_add(SENSOR_TOPIC, _on_message)
 
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
     client.loop_start()
@@ -187,7 +224,7 @@ def publish_action(client: mqtt.Client, lamp: str, action: str) -> None:
 
 def act(pairs: List[Tuple[str, str]], mqtt_client: mqtt.Client, states: Dict[str, bool]) -> bool:
     """
-    执行动作（通常是一个动作），并更新本地灯状态。
+    执行计划中的全部动作，并更新本地灯状态。
     返回是否执行了至少一个动作。
     """
     if not pairs:
@@ -222,35 +259,50 @@ def main() -> None:
     if not DOMAIN_FILE.exists():
         raise FileNotFoundError(f"未找到 {DOMAIN_FILE}, 请将 domain.pddl 放在同目录。")
 
+    # 只解析与实例化一次领域，之后每轮只做内存搜索；domain.pddl 修改后自动重新加载
+    planner = PlanCache(DOMAIN_FILE, lamps, maxsize=PLAN_CACHE_SIZE)
+
     states = load_states(lamps)
     logging.info("初始灯状态: %s", states)
 
-    mqtt_client = build_mqtt_client()
+    model = learn_model(TOPIC_MAP, LAMP_LUX_DEFAULT, LUX_MODEL_HISTORY)
+    model_learned = time.monotonic()
+
+    live = LiveLuminance() if EVENT_DRIVEN else None
+    mqtt_client = build_mqtt_client(live)
+    seq = 0
 
     try:
         while True:
-            lux = float(get_current_luminance())
-            logging.info("当前光照: %.2f lux | 状态: %s", lux, states)
+            if time.monotonic() - model_learned > LUX_MODEL_REFRESH:
+                logging.info("InfluxDB 查询耗时：%s", query_stats())
+                model = learn_model(TOPIC_MAP, LAMP_LUX_DEFAULT, LUX_MODEL_HISTORY)
+                model_learned = time.monotonic()
+
+            seq, lux, source = next_luminance(live, seq)
+            if lux is None:
+                logging.warning("没有可用的光照数据，跳过本轮。")
+                continue
+            logging.info("当前光照: %.2f lux（%s）| 状态: %s", lux, source, states)
 
-            decision = decide_goal(lux, states, lamps)
+            decision = decide_goal(lux, states, lamps, model)
             if decision is None:
                 logging.info("光照处于 [%d, %d] lux 范围或无可操作灯，跳过动作。",
                              LOW_THRESHOLD, HIGH_THRESHOLD)
-                time.sleep(CHECK_INTERVAL)
                 continue
 
-            action, lamp = decision
-            build_problem_for_action(action, lamp, states, lamps)
-            plan = run_planner()
+            action, targets = decision
+            logging.info("目标：%s %s（环境光估计 %.1f lux）", action, targets, model.ambient(lux, states))
+            init, goal = build_problem_for_action(action, targets, states, lamps)
+            plan = run_planner(planner, init, goal)
             executed = act(plan, mqtt_client, states)
 
-            # 若执行了动作，则等待传感器缓冲时间，再继续下一轮；
-            # 否则按正常巡检间隔。
+            # 若执行了动作，则等待传感器缓冲时间，缓冲期间收到的样本不再评估
             if executed:
                 logging.info("动作已执行，等待传感器缓冲 %d 秒再评估。", SENSOR_SETTLE_SECONDS)
                 time.sleep(SENSOR_SETTLE_SECONDS)
-            else:
-                time.sleep(CHECK_INTERVAL)
+                if live is not None:
+                    seq = live.seq
 
     except KeyboardInterrupt:
         print("\n已手动终止智能灯光控制程序。")
@@ -258,6 +310,7 @@ def main() -> None:
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
         logging.info("已断开 MQTT 连接。")
+        logging.info("InfluxDB 查询耗时：%s", query_stats())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from pddl_engine import PlanCache
+
+DOMAIN_FILE = Path(__file__).resolve().parent / "domain.pddl"
+
+
+class PlanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.domain = Path(self.dir) / "domain.pddl"
+        shutil.copy(DOMAIN_FILE, self.domain)
+        self.cache = PlanCache(self.domain, ["l1"])
+        self.init = {("dark",), ("lamp-off", "l1")}
+        self.goal = {("lamp-on", "l1")}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_corrupted_domain_keeps_old_engine(self):
+        plan = self.cache.plan(self.init, self.goal)
+        self.assertEqual(plan, [("turn-on", "l1")])
+
+        with open(self.domain, "a", encoding="utf-8") as f:
+            f.write("(")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.cache.plan(self.init, self.goal), plan)
+        # 同一个损坏的文件不会再被解析
+        with self.assertNoLogs(level="ERROR"):
+            self.assertEqual(self.cache.plan(self.init, self.goal), plan)
+        self.assertEqual(self.cache.stats()["reloads"], 0)
+
+    def test_missing_domain_keeps_old_engine(self):
+        plan = self.cache.plan(self.init, self.goal)
+        os.remove(self.domain)
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.cache.plan(self.init, self.goal), plan)
+
+        shutil.copy(DOMAIN_FILE, self.domain)
+        self.assertEqual(self.cache.plan(self.init, self.goal), plan)
+        self.assertEqual(self.cache.stats()["reloads"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
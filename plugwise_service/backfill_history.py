@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plugwise history backfill
+- Reads the hourly energy log buffers of the Circles and writes them to InfluxDB
+- Remembers per Circle how far it got, so running it again only loads new hours
+- Run inside the plugwise container while the controller is stopped:
+    docker compose run --rm plugwise python backfill_history.py
+"""
+
+from plugwise.api import Stick, Circle, CalibrationStore
+from plugwise.history import HistoryCursorStore, iter_fleet_power_usage_history
+from influxdb_client import InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+import os
+
+# ──────────────────────────  CONFIG  ──────────────────────────
+DEFAULT_PORT        = os.getenv("DEFAULT_PORT_PLUGWISE")
+MACS                = os.getenv("PLUGWISE_MACS", "000D6F0005692B55,000D6F0004B1E6C4").split(",")
+
+INFLUX_URL          = os.getenv("INFLUX_URL")
+INFLUX_TOKEN        = os.getenv("INFLUX_TOKEN")
+INFLUX_ORG          = os.getenv("INFLUX_ORG")
+INFLUX_BUCKET       = os.getenv("INFLUX_BUCKET", "zwave")
+MEASUREMENT         = "plugwise_energy"
+
+CALIBRATION_FILE    = os.getenv("PLUGWISE_CALIBRATION_FILE", "/data/calibration.json")
+CURSOR_FILE         = os.getenv("PLUGWISE_HISTORY_CURSOR_FILE", "/data/history_cursor.json")
+# ───────────────────────────────────────────────────────────────
+
+def main():
+    stick       = Stick(DEFAULT_PORT)
+    calibration = CalibrationStore(CALIBRATION_FILE)
+    cursors     = HistoryCursorStore(CURSOR_FILE)
+    circles     = [Circle(mac.strip(), stick, calibration_store=calibration) for mac in MACS]
+
+    written = 0
+    points  = []
+    with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
+        write_api = client.write_api(write_options=SYNCHRONOUS)
+
+        # runs before the cursor moves past a log buffer: the samples have to be
+        # in InfluxDB by then, otherwise a crash would skip them for good
+        def flush():
+            nonlocal written
+            if points:
+                write_api.write(bucket=INFLUX_BUCKET, record=points)
+                written += len(points)
+                points.clear()
+
+        for mac, dt, watt_hours in iter_fleet_power_usage_history(circles, cursor_store=cursors, flush=flush):
+            points.append(Point(MEASUREMENT)
+                          .tag("mac", mac.decode())
+                          .field("energy_wh", float(watt_hours))
+                          .time(dt))
+        flush()
+
+    print(f"Wrote {written} hourly samples to {INFLUX_BUCKET}/{MEASUREMENT}")
+
+if __name__ == "__main__":
+    main()
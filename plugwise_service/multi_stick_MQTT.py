@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plugwise MQTT controller for several Sticks
+- Every Stick is driven by its own worker process (plugwise.shards)
+- Listens on plugwise/control/<device> and plugwise/control/group/<name>
+- Payload must be JSON: {"action": "on"} or {"action": "off"}
+- Publishes power of every device on plugwise/status/<device>
+"""
+
+from plugwise.shards import ShardManager
+from datetime import datetime
+import paho.mqtt.client as mqtt
+import json, traceback, os, threading
+from time import sleep
+
+# ──────────────────────────  CONFIG  ──────────────────────────
+DEFAULT_PORT        = os.getenv("DEFAULT_PORT_PLUGWISE")
+
+# device name → MAC, the name is used in the MQTT topics
+DEVICES             = json.loads(os.getenv("PLUGWISE_DEVICES", json.dumps({
+                          "plus":   "000D6F0005692B55",
+                          "circle": "000D6F0004B1E6C4",
+                      })))
+
+# Stick port → device names behind it, e.g. {"/dev/ttyUSB0": ["plus"], "/dev/ttyUSB1": ["circle"]}
+STICKS              = json.loads(os.getenv("PLUGWISE_STICKS", "null")) or {DEFAULT_PORT: list(DEVICES)}
+
+# group name → device names
+GROUPS              = json.loads(os.getenv("PLUGWISE_GROUPS", json.dumps({"all": list(DEVICES)})))
+
+MQTT_BROKER         = os.getenv("MQTT_BROKER", "mosquitto")
+MQTT_PORT           = 1883
+MQTT_ID             = "plugwise_controller"
+
+TOPIC_CONTROL       = "plugwise/control/"
+TOPIC_GROUP         = "plugwise/control/group/"
+TOPIC_STATUS        = "plugwise/status/"
+TOPIC_HOURLY        = "plugwise/energy/"
+
+CALIBRATION_FILE    = os.getenv("PLUGWISE_CALIBRATION_FILE", "/data/calibration.json")
+MULTIRATE           = os.getenv("PLUGWISE_MULTIRATE", "0") == "1"
+POLL_INTERVAL       = float(os.getenv("PLUGWISE_POLL_INTERVAL", "60" if MULTIRATE else "10"))
+RETRIES             = int(os.getenv("PLUGWISE_RETRIES", "1"))
+RELAY_MAX_STALENESS = float(os.getenv("PLUGWISE_RELAY_MAX_STALENESS", "60"))
+SWITCH_TIMEOUT      = 30
+STATS_INTERVAL      = 300
+# ───────────────────────────────────────────────────────────────
+
+NAMES = {mac.upper().encode(): name for name, mac in DEVICES.items()}
+
+# ───────────────────────  Report Energy ─────────────────────────────
+def publish_power(mac: bytes, power_w: float, relay_state: int, energy_hour_wh):
+    payload = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "power": round(power_w, 2)
+    }
+    if energy_hour_wh is not None:
+        payload["energy_hour_wh"] = round(energy_hour_wh, 3)
+    print(f"[{NAMES[mac]}] {payload}")
+    client.publish(TOPIC_STATUS + NAMES[mac], json.dumps(payload), qos=0)
+
+def publish_hour(mac: bytes, hour: datetime, energy_wh: float):
+    payload = {
+        "mac": mac.decode(),
+        "timestamp": hour.isoformat(timespec="seconds"),
+        "energy_wh": round(energy_wh, 3)
+    }
+    print(f"[{NAMES[mac]}] finished hour {payload}")
+    client.publish(TOPIC_HOURLY + NAMES[mac], json.dumps(payload), qos=1)
+
+def energy_error(mac: bytes, message: str):
+    print(f"Read {NAMES[mac]} energy fail: {message}")
+
+def stats_report_loop():
+    while True:
+        sleep(STATS_INTERVAL)
+        try:
+            for port, stats in shards.stats(timeout=STATS_INTERVAL).items():
+                print(f"Stick {port}: {stats}")
+        except Exception as e:
+            print(f"Collecting stats failed: {e}")
+
+shards = ShardManager({port: [DEVICES[name] for name in names] for port, names in STICKS.items()},
+                      power_callback=publish_power, error_callback=energy_error, hour_callback=publish_hour,
+                      interval=POLL_INTERVAL, retries=RETRIES, calibration_file=CALIBRATION_FILE,
+                      multirate=MULTIRATE)
+
+# ───────────────────────  Helper  ─────────────────────────────
+def handle_switch(label: str, names: list, turn_on: bool):
+    """Route the switch to the shards of the devices, the Sticks work in parallel."""
+    future = shards.request_switch([DEVICES[n] for n in names], turn_on, max_staleness=RELAY_MAX_STALENESS)
+
+    def done(f):
+        if f.exception() is not None:
+            print(f"[{label}] switching {'ON' if turn_on else 'OFF'} failed: {f.exception()}")
+            return
+        results = f.result()
+        failed  = {NAMES.get(mac, mac): r for mac, r in results.items() if r is not True}
+        print(f"[{label}] switched {len(results) - len(failed)} {'ON' if turn_on else 'OFF'}, "
+              f"{len(names) - len(results)} already were" + (f", failed: {failed}" if failed else ""))
+
+    future.add_done_callback(done)
+
+# ───────────────────────  MQTT callbacks  ─────────────────────
+def on_connect(client, *_):
+    print("Connected to MQTT broker")
+    client.subscribe([(TOPIC_CONTROL + "+", 0), (TOPIC_GROUP + "+", 0)])
+    print(f"Subscribed to {TOPIC_CONTROL}+ ({', '.join(DEVICES)}) & {TOPIC_GROUP}+ ({', '.join(GROUPS)})")
+
+def on_message(client, _userdata, msg):
+    try:
+        data    = json.loads(msg.payload.decode())
+        action  = data.get("action")
+        topic   = msg.topic
+
+        if topic.startswith(TOPIC_GROUP):
+            name  = topic[len(TOPIC_GROUP):]
+            names = GROUPS.get(name)
+            label = f"group {name}"
+        else:
+            name  = topic[len(TOPIC_CONTROL):]
+            names = [name] if name in DEVICES else None
+            label = name
+
+        if names is None:
+            print(f"Unknown topic {topic}")
+            return
+        if action not in ("on", "off"):
+            print(f"Unknown action '{action}' on {topic}")
+            return
+
+        handle_switch(label, names, action == "on")
+
+    except Exception as e:
+        print(f"Error processing message on {msg.topic}: {e}")
+        traceback.print_exc()
+
+# ─────────────────────────  MQTT init  ────────────────────────
+client = mqtt.Client(client_id=MQTT_ID, clean_session=True)
+client.on_connect  = on_connect
+client.on_message  = on_message
+
+client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+if __name__ == "__main__":
+    shards.start()
+    print(f"Started {len(STICKS)} Stick workers: {STICKS}")
+    client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+    threading.Thread(target=stats_report_loop, daemon=True).start()
+    print("waiting for MQTT messages")
+    client.loop_forever()
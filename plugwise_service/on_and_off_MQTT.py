@@ -5,10 +5,16 @@ Plugwise MQTT controller
 - Listens on two topics:
     plugwise/control/plus
     plugwise/control/circle
+- and on plugwise/control/group/<name> for switching a group of Circles at once
 - Payload must be JSON: {"action": "on"} or {"action": "off"}
 """
 
-from plugwise.api import Stick, Circle
+from plugwise.api import Stick, Circle, CalibrationStore
+from plugwise.scheduler import PollScheduler
+from plugwise.groups import CircleGroup
+from plugwise.telemetry import EnergyMeter
+from plugwise.startup import LazyInitializer
+from plugwise.commands import PRIORITY_ACTUATION, PRIORITY_STATUS, PRIORITY_TELEMETRY
 from datetime import datetime
 import paho.mqtt.client as mqtt
 import json, traceback, os, threading
@@ -26,69 +32,133 @@ MQTT_ID             = "plugwise_controller"
 
 TOPIC_PLUS          = "plugwise/control/plus"
 TOPIC_CIRCLE        = "plugwise/control/circle"
+TOPIC_GROUP_PREFIX  = "plugwise/control/group/"
 TOPIC_PLUS_ENERGY   = "plugwise/status/plus"
 TOPIC_CIRCLE_ENERGY = "plugwise/status/circle"
+TOPIC_PLUS_HOURLY   = "plugwise/energy/plus"
+TOPIC_CIRCLE_HOURLY = "plugwise/energy/circle"
+
+# record all Stick traffic to this file for replaying it later (see plugwise.capture), empty = off
+CAPTURE_FILE        = os.getenv("PLUGWISE_CAPTURE_FILE") or None
+
+# calibration values survive restarts here, so power is reported right after boot
+CALIBRATION_FILE    = os.getenv("PLUGWISE_CALIBRATION_FILE", "/data/calibration.json")
+
+# multi-rate telemetry: report the 8 s average power and the energy from the hourly
+# pulse counter, so no energy is lost even if the devices are polled rarely
+MULTIRATE           = os.getenv("PLUGWISE_MULTIRATE", "0") == "1"
+
+# every device is sampled once per POLL_INTERVAL, polls are spread over the interval
+POLL_INTERVAL       = float(os.getenv("PLUGWISE_POLL_INTERVAL", "60" if MULTIRATE else "10"))
+STATS_INTERVAL      = 300
+
+# requests that time out are resent this many times, timeouts adapt to each device
+RETRIES             = int(os.getenv("PLUGWISE_RETRIES", "1"))
+
+# group name → MACs, e.g. {"livingroom": ["000D6F0005692B55", "000D6F0004B1E6C4"]}
+GROUPS_CONFIG       = json.loads(os.getenv("PLUGWISE_GROUPS", json.dumps({"all": [PLUS_MAC, CIRCLE_MAC]})))
+
+# switching trusts the known relay state if it is at most this old (seconds)
+RELAY_MAX_STALENESS = float(os.getenv("PLUGWISE_RELAY_MAX_STALENESS", "60"))
 # ───────────────────────────────────────────────────────────────
 
 # Init Plugwise stick & devices
-stick        = Stick(DEFAULT_PORT)
-circle_plus  = Circle(PLUS_MAC, stick)
-circle       = Circle(CIRCLE_MAC, stick)
+stick        = Stick(DEFAULT_PORT, reader=True, capture=CAPTURE_FILE, retries=RETRIES)
+calibration  = CalibrationStore(CALIBRATION_FILE)
+circle_plus  = Circle(PLUS_MAC, stick, calibration_store=calibration)
+circle       = Circle(CIRCLE_MAC, stick, calibration_store=calibration)
+
+GROUPS = {name: CircleGroup.from_macs(macs, [circle_plus, circle], name=name)
+          for name, macs in GROUPS_CONFIG.items()}
+
+# mac → (energy topic, name)
+DEVICES = {
+    circle_plus.mac: (TOPIC_PLUS_ENERGY,   "Circle+"),
+    circle.mac:      (TOPIC_CIRCLE_ENERGY, "Circle"),
+}
+
+# mac → topic for the energy of each finished hour (multi-rate telemetry only)
+HOURLY_TOPICS = {
+    circle_plus.mac: TOPIC_PLUS_HOURLY,
+    circle.mac:      TOPIC_CIRCLE_HOURLY,
+}
+
+# clock sync & state discovery run in the background, a device that gets a
+# command before that is initialized right before the command
+def device_ready(device: Circle, result):
+    if isinstance(result, Exception):
+        print(f"[{DEVICES[device.mac][1]}] init failed: {result}")
+    else:
+        print(f"[{DEVICES[device.mac][1]}] ready, relay {'ON' if result['relay_state'] else 'OFF'}")
 
-now = datetime.now()
-circle_plus.set_clock(now)
-circle.set_clock(now)
+initializer = LazyInitializer(stick, [circle_plus, circle], callback=device_ready)
 
 # ───────────────────────  Report Energy ─────────────────────────────
-def publish_energy(device: Circle, topic: str, name: str):
-    try:
-        state = device.get_info()
-        power_w = 0.0
-        if state["relay_state"] == 1:
-            power_w = device.get_power_usage()
-        else:
-            power_w = 0.0
-        payload = {
-            "timestamp": datetime.now().isoformat(timespec="seconds"),
-            "power": round(power_w, 2)           
-        }
-        print(payload)
-        client.publish(topic, json.dumps(payload), qos=0)
-        
-        
-    except Exception as e:
-        print(f"Read {name} energy fail: {e}")
-
-def energy_report_loop():
+def publish_energy(device: Circle, power_w: float, relay_state: int):
+    topic, _ = DEVICES[device.mac]
+    payload = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "power": round(power_w, 2)
+    }
+    if MULTIRATE and meter.last_sample(device.mac) is not None:
+        payload["energy_hour_wh"] = round(meter.last_sample(device.mac).energy_hour, 3)
+    print(payload)
+    client.publish(topic, json.dumps(payload), qos=0)
+
+def publish_hour(mac: bytes, hour: datetime, energy_wh: float):
+    payload = {
+        "mac": mac.decode(),
+        "timestamp": hour.isoformat(timespec="seconds"),
+        "energy_wh": round(energy_wh, 3)
+    }
+    print(f"[{DEVICES[mac][1]}] finished hour {payload}")
+    client.publish(HOURLY_TOPICS[mac], json.dumps(payload), qos=1)
+
+def energy_error(device: Circle, e: Exception):
+    _, name = DEVICES[device.mac]
+    print(f"Read {name} energy fail: {e}")
+
+def stats_report_loop():
     while True:
-        publish_energy(circle_plus,  TOPIC_PLUS_ENERGY,   "Circle+")
-        publish_energy(circle,       TOPIC_CIRCLE_ENERGY, "Circle")
-        sleep(10)
+        sleep(STATS_INTERVAL)
+        stats = poller.stats()
+        print(f"Polling stats: {stats} (capacity at 1 Hz: {poller.capacity(1.0)} devices)")
+        print(f"Command queue wait: {stick.commands.stats()}")
 
-threading.Thread(target=energy_report_loop, daemon=True).start()
+meter  = EnergyMeter(hour_callback=publish_hour) if MULTIRATE else None
+poller = PollScheduler(stick, [circle_plus, circle], interval=POLL_INTERVAL,
+                       callback=publish_energy, error_callback=energy_error,
+                       priority=PRIORITY_TELEMETRY, energy_meter=meter)
+calibration.start_refresh([circle_plus, circle], priority=PRIORITY_STATUS)
 
 # ───────────────────────  Helper  ─────────────────────────────
 def handle_switch(device: Circle, turn_on: bool, name: str):
-    """Switch device on/off if state differs."""
-    state = device.get_info()
-    relay = state["relay_state"]  # 1=on, 0=off
-    desired = 1 if turn_on else 0
-
-    if relay == desired:
+    """Switch device on/off if state differs (state comes from the relay shadow)."""
+    initializer.ensure(device)
+    if device.switch_if_needed(turn_on, max_staleness=RELAY_MAX_STALENESS):
+        print(f"[{name}] switching {'ON' if turn_on else 'OFF'} …")
+    else:
         print(f"[{name}] already {'ON' if turn_on else 'OFF'}")
-        return
 
-    print(f"[{name}] switching {'ON' if turn_on else 'OFF'} …")
-    if turn_on:
-        device.switch_on()
-    else:
-        device.switch_off()
+def handle_group_switch(group: CircleGroup, turn_on: bool):
+    """Send the switch frames of the whole group back-to-back, then collect the acks."""
+    ready, results = initializer.ensure_all(group.circles)
+    results.update(CircleGroup(ready, name=group.name).switch(turn_on, max_staleness=RELAY_MAX_STALENESS))
+    failed  = [mac.decode() for mac, ok in results.items() if ok is not True]
+    print(f"[group {group.name}] switched {len(results) - len(failed)} "
+          f"{'ON' if turn_on else 'OFF'}, {len(group.circles) - len(results)} already were"
+          + (f", failed: {failed}" if failed else ""))
+
+def switch_failed(name: str, future):
+    e = future.exception()
+    if e is not None:
+        print(f"[{name}] switching failed: {e}")
 
 # ───────────────────────  MQTT callbacks  ─────────────────────
 def on_connect(client, *_):
     print("Connected to MQTT broker")
-    client.subscribe([(TOPIC_PLUS, 0), (TOPIC_CIRCLE, 0)])
-    print(f"Subscribed to {TOPIC_PLUS} & {TOPIC_CIRCLE}")
+    client.subscribe([(TOPIC_PLUS, 0), (TOPIC_CIRCLE, 0), (TOPIC_GROUP_PREFIX + "+", 0)])
+    print(f"Subscribed to {TOPIC_PLUS}, {TOPIC_CIRCLE} & {TOPIC_GROUP_PREFIX}+ (groups: {', '.join(GROUPS)})")
 
 def on_message(client, _userdata, msg):
     try:
@@ -96,6 +166,18 @@ def on_message(client, _userdata, msg):
         action  = data.get("action")
         topic   = msg.topic
 
+        if topic.startswith(TOPIC_GROUP_PREFIX):
+            group = GROUPS.get(topic[len(TOPIC_GROUP_PREFIX):])
+            if group is None:
+                print(f"Unknown group topic {topic}")
+                return
+            if action not in ("on", "off"):
+                print(f"Unknown action '{action}' on {topic}")
+                return
+            future = stick.execute(PRIORITY_ACTUATION, handle_group_switch, group, action == "on")
+            future.add_done_callback(lambda f: switch_failed(f"group {group.name}", f))
+            return
+
         if topic == TOPIC_PLUS:
             device, name = circle_plus, "Circle+"
         elif topic == TOPIC_CIRCLE:
@@ -104,12 +186,13 @@ def on_message(client, _userdata, msg):
             print(f"Unknown topic {topic}")
             return
 
-        if action == "on":
-            handle_switch(device, True, name)
-        elif action == "off":
-            handle_switch(device, False, name)
-        else:
+        if action not in ("on", "off"):
             print(f"Unknown action '{action}' on {topic}")
+            return
+
+        # switching jumps ahead of the queued polls, don't block the MQTT loop meanwhile
+        future = stick.execute(PRIORITY_ACTUATION, handle_switch, device, action == "on", name)
+        future.add_done_callback(lambda f: switch_failed(name, f))
 
     except Exception as e:
         print(f"Error processing message on {msg.topic}: {e}")
@@ -123,5 +206,8 @@ client.on_message  = on_message
 client.reconnect_delay_set(min_delay=1, max_delay=120)
 
 client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+initializer.start()
+poller.start()
+threading.Thread(target=stats_report_loop, daemon=True).start()
 print("waiting for MQTT messages")
 client.loop_forever()
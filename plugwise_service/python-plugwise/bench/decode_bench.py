@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Compares the cost of decoding response frames with the message objects
+(unserialize + response_to_dict) and with the compiled decoders (decode).
+
+Run from the python-plugwise directory:
+    python bench/decode_bench.py [-n NUMBER]
+"""
+
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from plugwise.protocol import *
+from plugwise.api import response_to_dict, record_to_dict
+
+MAC = b'000D6F0000ABCDEF'
+SEQ = b'01A2'
+
+PAYLOADS = {
+    # datetime, logaddr, relay state, hz, hw version, fw version, unknown
+    PlugwiseInfoResponse: b'12060F1C' + b'00044020' + b'01' + b'85' + b'000000730007' + b'4E0843A9' + b'01',
+    # 1s, 8s & hourly pulses + 3 unknown fields
+    PlugwisePowerUsageResponse: b'0042' + b'0210' + b'00003D41' + b'0000' + b'0000' + b'0000',
+    # 4 times (datetime, pulses) + logaddr
+    PlugwisePowerBufferResponse: b'12060F00' + b'00000A10' + b'12060F3C' + b'00000B20' +
+        b'12060F78' + b'00000C30' + b'12060FB4' + b'00000D40' + b'00044020',
+}
+
+def build_frame(response_class, payload):
+    msg = response_class.ID + SEQ + MAC + payload
+    return PACKET_HEADER + msg + checksum(msg) + PACKET_FOOTER
+
+def decode_with_objects(response_class, frame):
+    resp = response_class()
+    resp.unserialize(frame)
+    return response_to_dict(resp)
+
+def decode_compiled(response_class, frame):
+    return record_to_dict(response_class.decode(frame))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--number", type="int", default=20000,
+        help="how many times each frame is decoded")
+    options, args = parser.parse_args()
+
+    print("%-28s %12s %12s %8s" % ("message", "objects us", "compiled us", "speedup"))
+    for response_class, payload in PAYLOADS.items():
+        frame = build_frame(response_class, payload)
+        assert decode_with_objects(response_class, frame) == decode_compiled(response_class, frame)
+
+        old = min(timeit.repeat(lambda: decode_with_objects(response_class, frame), number=options.number, repeat=3))
+        new = min(timeit.repeat(lambda: decode_compiled(response_class, frame), number=options.number, repeat=3))
+        print("%-28s %12.2f %12.2f %7.1fx" % (response_class.__name__, old/options.number*1e6,
+            new/options.number*1e6, old/new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Compares converting hourly history pulse counters to watt-hours sample by sample
+with Circle.pulse_correction and with plugwise.vectorized in one call.
+
+Run from the python-plugwise directory (requires numpy):
+    python bench/pulse_bench.py [-d DEVICES] [-s SAMPLES]
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from plugwise.api import Circle
+from plugwise.vectorized import calibration_arrays, history_usage_array
+
+def make_circles(count):
+    circles = []
+    for i in range(count):
+        c = Circle("000D6F00%08X" % (i,), None)
+        c.gain_a = random.uniform(0.9, 1.1)
+        c.gain_b = random.uniform(-1e-6, 1e-6)
+        c.off_ruis = random.uniform(-1.0, 1.0)
+        c.off_tot = random.uniform(-0.01, 0.01)
+        circles.append(c)
+    return circles
+
+def convert_scalar(circles, pulses):
+    retl = []
+    for c, row in zip(circles, pulses):
+        retl.append([c.pulses_to_kWs(c.pulse_correction(p, 3600))/3600*1000 for p in row])
+    return retl
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-d", "--devices", type="int", default=40)
+    parser.add_option("-s", "--samples", type="int", default=24*31,
+        help="hourly samples per device, default is a month")
+    options, args = parser.parse_args()
+
+    circles = make_circles(options.devices)
+    pulses = [[random.choice((0, random.randint(1, 2000000))) for _ in range(options.samples)]
+        for _ in circles]
+
+    start = time.perf_counter()
+    scalar = convert_scalar(circles, pulses)
+    scalar_time = time.perf_counter() - start
+
+    calibration = calibration_arrays(circles)
+    pulses_array = np.array(pulses)
+    start = time.perf_counter()
+    vectorized = history_usage_array(pulses_array, calibration)
+    vectorized_time = time.perf_counter() - start
+
+    assert np.allclose(np.array(scalar), vectorized, rtol=1e-12, atol=0)
+
+    samples = options.devices * options.samples
+    print("%d devices x %d samples" % (options.devices, options.samples))
+    print("scalar:     %8.2f ms (%.3f us/sample)" % (scalar_time*1e3, scalar_time/samples*1e6))
+    print("vectorized: %8.2f ms (%.3f us/sample)" % (vectorized_time*1e3, vectorized_time/samples*1e6))
+    print("speedup:    %8.1fx" % (scalar_time/vectorized_time,))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Decodes all the frames that were received in a capture file (see plugwise.capture)
+and reports how long that takes per message type. Recording the traffic of a
+real installation once gives a benchmark that can be rerun after every change
+of the decoding code.
+
+Run from the python-plugwise directory:
+    python bench/replay_bench.py CAPTURE_FILE [-n REPEAT]
+"""
+
+import optparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from plugwise.capture import *
+from plugwise.protocol import *
+from plugwise.util import *
+
+def received_frames(path):
+    """return the frames with valid checksums that were read from the Stick in the capture"""
+    splitter = FrameSplitter()
+    frames = []
+    for t, direction, data in read_capture(path):
+        if direction == DIRECTION_READ:
+            frames += [f for f in splitter.feed(data) if checksum_ok(f)]
+    return frames
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] CAPTURE_FILE")
+    parser.add_option("-n", "--repeat", type="int", default=100,
+        help="how many times the frames are decoded")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("capture file is required")
+
+    by_class = defaultdict(list)
+    for frame in received_frames(args[0]):
+        response_class = RESPONSE_CLASSES.get(frame[4:8])
+        if response_class is not None:
+            by_class[response_class].append(frame)
+
+    print("%-28s %8s %12s" % ("message", "frames", "decode us"))
+    for response_class, frames in sorted(by_class.items(), key=lambda x: x[0].__name__):
+        decode = response_class.decode
+        start = time.time()
+        for i in range(options.repeat):
+            for frame in frames:
+                decode(frame)
+        elapsed = time.time() - start
+        print("%-28s %8d %12.2f" % (response_class.__name__, len(frames),
+            elapsed / (options.repeat*len(frames)) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Measures how fast the power usage of a fleet of Circles can be read through
+the Stick API, using the simulated Stick from plugwise.simulator.
+Each round reads all Circles once, one after the other (get_power_usage) and
+pipelined (request_power_usage + gather) with and without the reader thread.
+
+Run from the python-plugwise directory:
+    python bench/stick_bench.py [-n CIRCLES] [--latency SECONDS] [--rounds N]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from plugwise.api import Stick, Circle
+from plugwise.exceptions import *
+from plugwise.simulator import CircleSimulator
+
+def read_sequential(stick, circles):
+    failed = 0
+    for c in circles:
+        try:
+            c.get_power_usage()
+        except TimeoutException:
+            failed += 1
+    return failed
+
+def read_pipelined(stick, circles):
+    results = stick.gather([c.request_power_usage() for c in circles])
+    return sum(1 for r in results if isinstance(r, Exception))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--circles", type="int", default=100, help="number of simulated Circles")
+    parser.add_option("--latency", type="float", default=0.02, help="reply latency of the Circles in seconds")
+    parser.add_option("--jitter", type="float", default=0.005, help="reply latency varies this much")
+    parser.add_option("--drop-rate", type="float", default=0.0, help="probability of losing a reply")
+    parser.add_option("--noise-rate", type="float", default=0.05, help="probability of noise in front of a frame")
+    parser.add_option("--max-inflight", type="int", default=8, help="pipeline depth of the Stick")
+    parser.add_option("--rounds", type="int", default=3, help="how many times all Circles are read")
+    options, args = parser.parse_args()
+
+    sim = CircleSimulator(count=options.circles, latency=options.latency, jitter=options.jitter,
+        drop_rate=options.drop_rate, noise_rate=options.noise_rate, seed=1)
+    sim.start()
+
+    print("%d Circles, %.0f ms latency" % (options.circles, options.latency*1000))
+    print("%-24s %10s %10s %8s" % ("mode", "reads/s", "ms/round", "failed"))
+    for name, reader, read in (
+            ("sequential", False, read_sequential),
+            ("pipelined", False, read_pipelined),
+            ("pipelined+reader", True, read_pipelined)):
+        stick = Stick(sim.port, timeout=max(options.latency*20, 1), max_inflight=options.max_inflight, reader=reader)
+        circles = [Circle(m, stick) for m in sim.macs]
+        # calibration is a one time cost, keep it out of the measurement
+        for c in circles:
+            c.calibrate()
+
+        failed = 0
+        start = time.time()
+        for i in range(options.rounds):
+            failed += read(stick, circles)
+        elapsed = time.time() - start
+
+        reads = options.rounds * len(circles)
+        print("%-24s %10.1f %10.1f %8d" % (name, reads/elapsed, elapsed/options.rounds*1000, failed))
+        stick.stop_reader()
+
+    sim.close()
+
+if __name__ == '__main__':
+    main()
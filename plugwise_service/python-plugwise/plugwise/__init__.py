@@ -14,6 +14,12 @@ Usage example:
    >>> print c2.get_power_usage()
    >>> c1.switch_off()
 
+Requests to several Circles can be kept in flight at the same time, replies are matched
+to the requests by the sequence number the Stick assigns to each request:
+
+   >>> futures = [c.request_power_usage() for c in (c1, c2)]
+   >>> print s.gather(futures)
+
 """
 
 from .api import *
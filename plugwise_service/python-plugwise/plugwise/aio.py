@@ -0,0 +1,222 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+asyncio interface to the Stick and the Circles.
+
+The serial port is read by the event loop itself (loop.add_reader on the file
+descriptor of the port), so no threads are involved and a single event loop can
+talk to the Stick while it's serving MQTT, InfluxDB & co. Requests are pipelined
+in the same way as with Stick.submit, the Circle logic is shared with
+plugwise.api.Circle.
+
+Usage:
+    >>> async def main():
+    ...     async with AsyncStick("/dev/ttyUSB0") as stick:
+    ...         circle = AsyncCircle(mac, stick)
+    ...         await circle.switch(True)
+    ...         print(await circle.get_power_usage(timeout=2))
+    >>> asyncio.run(main())
+
+The port has to be a real file descriptor backed device (serial port or pty).
+"""
+
+import asyncio
+import time
+from concurrent.futures import Future
+
+import serial
+
+from .api import *
+from .exceptions import *
+from .pipeline import *
+from .protocol import *
+from .util import *
+
+class AsyncStick(object):
+    """Stick driven by an asyncio event loop"""
+
+    def __init__(self, port=0, timeout=DEFAULT_TIMEOUT, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """
+        @param timeout: default timeout for the requests in seconds
+        @param max_inflight: how many requests can wait for a reply at the same time
+        """
+        self.port = port
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self._fd = None
+        self._loop = None
+        self._tracker = RequestTracker()
+        self._splitter = FrameSplitter()
+        self._inflight = None
+        self._waiters = {}
+        self._tick_handle = None
+
+    async def open(self):
+        """open the port, start reading it in the event loop and initialize the Stick"""
+        self._loop = asyncio.get_running_loop()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._fd = serial.Serial(self.port, baudrate=115200, timeout=0)
+        self._loop.add_reader(self._fd.fileno(), self._on_readable)
+        self._tick()
+        try:
+            await self.init()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd.fileno())
+        self._tick_handle.cancel()
+        self._fd.close()
+        self._fd = None
+        self._tracker.expire(-1)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def init(self, timeout=None):
+        """send init message to the stick
+        @return: decoded PlugwiseInitResponse
+        """
+        # the reply doesn't carry the MAC of the request, so it can't be tracked like the others
+        waiter = self._loop.create_future()
+        self._waiters.setdefault(PlugwiseInitResponse.ID, []).append(waiter)
+        self.submit(PlugwiseInitRequest())
+        frame = await _with_timeout(waiter, timeout or self.timeout)
+        return PlugwiseInitResponse.decode(frame)
+
+    def submit(self, request, response_class=None, urgent=False):
+        """send the request right away, same as Stick.submit except that it never blocks.
+        The max_inflight limit is enforced by request() instead.
+        @return: concurrent.futures.Future that resolves to the decoded reply
+        """
+        future = Future()
+        pending = PendingRequest(request.mac, response_class, future)
+        msg = request.serialize()
+        debug("_submit:"+repr(msg))
+        self._tracker.sent(pending)
+        self._fd.write(msg)
+        return future
+
+    async def request(self, send, timeout=None):
+        """call send() to submit a request once a pipeline slot is free and wait for the result
+        @param send: function that returns a concurrent.futures.Future, like Circle.request_info
+        @param timeout: seconds, defaults to the timeout of the Stick
+        """
+        await self._inflight.acquire()
+        try:
+            future = send()
+        except:
+            self._inflight.release()
+            raise
+        # the slot is freed once the request is off the wire, not when the caller stops
+        # waiting for it: after a timeout it's still tracked until it expires
+        future.add_done_callback(lambda f: self._release_slot())
+        return await _with_timeout(asyncio.wrap_future(future), timeout or self.timeout)
+
+    def _release_slot(self):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._inflight.release)
+
+    def _on_readable(self):
+        try:
+            data = self._fd.read(self._fd.in_waiting or 1)
+        except serial.SerialException as reason:
+            error("reading failed: "+str(reason))
+            return
+
+        debug("read:"+repr(data))
+        for frame in self._splitter.feed(data):
+            if not checksum_ok(frame):
+                error("dropping frame with broken checksum: "+repr(frame))
+                continue
+            function_code = frame[4:8]
+            if self._tracker.handle_frame(function_code, frame[8:12], frame):
+                continue
+            waiters = self._waiters.get(function_code)
+            while waiters:
+                waiter = waiters.pop(0)
+                if not waiter.done():
+                    waiter.set_result(frame)
+                    break
+
+    def _tick(self):
+        self._tracker.expire(self.timeout)
+        self._tick_handle = self._loop.call_later(READER_POLL_INTERVAL, self._tick)
+
+async def _with_timeout(future, timeout):
+    # the future is shielded since the reply might still be routed to it after the timeout
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        # nobody is going to look at the outcome anymore
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise TimeoutException("Timeout while waiting for response from device")
+
+class AsyncCircle(object):
+    """asyncio version of Circle, all the methods take an optional timeout in seconds"""
+
+    def __init__(self, mac, stick, calibration_store=None):
+        """
+        will raise ValueError if mac doesn't look valid
+        @param stick: AsyncStick
+        """
+        self.circle = Circle(mac, stick, calibration_store=calibration_store)
+        self.mac = self.circle.mac
+        self._stick = stick
+
+    @property
+    def relay_state(self):
+        """last known relay state, see Circle.relay_state"""
+        return self.circle.relay_state
+
+    async def calibrate(self, timeout=None):
+        return await self._stick.request(self.circle.request_calibration, timeout)
+
+    async def _ensure_calibrated(self, timeout):
+        if not self.circle._load_calibration():
+            await self.calibrate(timeout)
+
+    async def get_info(self, timeout=None):
+        """fetch relay state & current logbuffer index info, see Circle.get_info"""
+        return await self._stick.request(self.circle.request_info, timeout)
+
+    async def get_pulse_counters(self, timeout=None):
+        return await self._stick.request(self.circle.request_pulse_counters, timeout)
+
+    async def get_power_usage(self, timeout=None):
+        """returns power usage for the last second in Watts"""
+        await self._ensure_calibrated(timeout)
+        return await self._stick.request(self.circle.request_power_usage, timeout)
+
+    async def get_power_usage_history(self, log_buffer_index=None, timeout=None):
+        """see Circle.get_power_usage_history"""
+        if log_buffer_index is None:
+            log_buffer_index = (await self.get_info(timeout))['last_logaddr']
+        await self._ensure_calibrated(timeout)
+        return await self._stick.request(lambda: self.circle.request_power_usage_history(log_buffer_index), timeout)
+
+    async def switch(self, on, timeout=None):
+        """switch power on or off and wait for the Circle to ack it
+        @return: new relay state (1=on, 0=off)
+        """
+        await self._stick.request(lambda: self.circle.request_switch(on), timeout)
+        return self.circle.relay_state
+
+    async def switch_if_needed(self, on, max_staleness=DEFAULT_RELAY_MAX_STALENESS, timeout=None):
+        """see Circle.switch_if_needed
+        @return: True if switch request was sent
+        """
+        relay_state = self.circle.relay_state
+        if relay_state is None or time.time() - self.circle.relay_state_time > max_staleness:
+            relay_state = (await self.get_info(timeout))['relay_state']
+        if relay_state == (1 if on else 0):
+            return False
+        await self.switch(on, timeout)
+        return True
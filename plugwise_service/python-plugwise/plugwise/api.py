@@ -8,8 +8,6 @@
 #   - make communication channel concurrency safe
 #   - return more reasonable responses than response message objects from the functions that don't do so yet
 #   - make message construction syntax better. Fields should only be specified once and contain name so we can serialize response message to dict
-#   - verify response checksums
-#   - look at the ACK messages
 #   - unit tests
 #   - pairing
 #   - switching schedule upload
@@ -17,21 +15,64 @@
 
 import re
 import sys
+import threading
 import time
 
+from collections import namedtuple
+from concurrent.futures import Future, wait as futures_wait
+
 from .util import *
 from .protocol import *
 from .exceptions import *
+from .pipeline import *
+from .commands import *
+from .store import *
+from .history import *
 
 PULSES_PER_KW_SECOND = 468.9385193
 
 DEFAULT_TIMEOUT = 10
 
+# how many requests may be waiting for a reply at the same time
+DEFAULT_MAX_INFLIGHT = 8
+
+# power usage in Watts averaged over the last second & the last 8 seconds and
+# the energy used in the current hour in Wh, all from a single power usage request
+PowerSample = namedtuple('PowerSample', ['timestamp', 'power_1s', 'power_8s', 'energy_hour'])
+
+# how many times a pipelined request is resent after it timed out
+DEFAULT_RETRIES = 0
+
+# how old the relay state shadow may be before it's refreshed from the device
+DEFAULT_RELAY_MAX_STALENESS = 60
+
 class Stick(SerialComChannel):
     """provides interface to the Plugwise Stick"""
 
-    def __init__(self, port=0, timeout=DEFAULT_TIMEOUT):
-        SerialComChannel.__init__(self, port=port, timeout=timeout)
+    def __init__(self, port=0, timeout=DEFAULT_TIMEOUT, max_inflight=DEFAULT_MAX_INFLIGHT, reader=False, capture=None,
+            retries=DEFAULT_RETRIES):
+        """
+        @param timeout: the longest time to wait for a reply, once the round trip times of a
+            device are known the timeouts for it are derived from them, see RttTracker
+        @param max_inflight: how many pipelined requests can wait for a reply at the same time
+        @param reader: start the background reader thread, see SerialComChannel.start_reader
+        @param capture: record all the traffic to this file, see plugwise.capture
+        @param retries: how many times a pipelined request is resent if it times out
+        """
+        SerialComChannel.__init__(self, port=port, timeout=timeout, capture=capture)
+        self.max_inflight = max_inflight
+        self.retries = retries
+        self.rtt = RttTracker(max_timeout=timeout)
+        self._tracker = RequestTracker()
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        # the order of the writes has to match the order of the tracked requests
+        self._write_lock = threading.Lock()
+        self.commands = CommandQueue()
+        self._last_send = None
+        # send time of the latest send_msg() of each thread, for the RTT of the reply it expects
+        self._sent = threading.local()
+        if reader:
+            self.start_reader()
         self.init()
 
     def init(self):
@@ -43,38 +84,201 @@ class Stick(SerialComChannel):
 
     def send_msg(self, cmd):
         debug("_send_cmd:"+repr(cmd))
-        self.write(cmd)
-
-    def _recv_response(self, response_obj):
-        readlen = len(response_obj)
-        debug("expecting to read "+str(readlen)+" bytes for msg. "+str(response_obj))
-        msg = self.readline()
-        if msg == b"":
-            raise TimeoutException("Timeout while waiting for response from device")
+        with self._write_lock:
+            # the Stick acks this request too, keep the pipelined requests in step with that.
+            # This has to happen before writing since the ack might be read right away.
+            pending = PendingRequest(None, None)
+            self._tracker.sent(pending)
+            self._last_send = self._sent.at = pending.sent_at
+            self.write(cmd)
+
+    def execute(self, priority, fn, *args, **kwargs):
+        """run fn(*args, **kwargs) through the command queue of the Stick, see CommandQueue.
+        All the device I/O should go through here when several threads use the same
+        Stick, that way the I/O is serialized and the more important commands go first.
+        The reader thread is started since replies can't be read by the callers anymore.
+
+        @param priority: one of the PRIORITY_* constants
+        @return: concurrent.futures.Future with the return value of fn
+        """
+        self.start_reader()
+        return self.commands.submit(priority, fn, *args, **kwargs)
+
+    def submit(self, request, response_class=None, urgent=False, timeout=None, retries=None):
+        """send the request without waiting for the reply.
+        Up to max_inflight requests can be outstanding, after that this blocks until
+        some of the earlier ones have been answered.
+
+        @param request: PlugwiseRequest instance
+        @param response_class: class of the reply, see PendingRequest
+        @param urgent: send right away even if max_inflight requests are already outstanding
+        @param timeout: seconds to wait for the reply, defaults to the one derived from
+            the round trip times of the device
+        @param retries: how many times to resend the request if it times out, defaults to self.retries
+        @return: concurrent.futures.Future that resolves to the decoded reply (see PlugwiseResponse.decode)
+        """
+        if not urgent:
+            self._acquire_slot()
+
+        future = Future()
+        if not urgent:
+            future.add_done_callback(lambda f: self._inflight.release())
+        msg = request.serialize()
+        self._send_attempt(request.mac, msg, response_class, future, timeout,
+            self.retries if retries is None else retries)
+        return future
+
+    def _send_attempt(self, mac, msg, response_class, future, timeout, retries):
+        attempt = Future()
+        pending = PendingRequest(mac, response_class, attempt,
+            timeout if timeout is not None or not mac else self.rtt.timeout(mac))
+
+        def _done(f):
+            reason = f.exception()
+            if reason is None:
+                if mac:
+                    self.rtt.observe(mac, time.time() - pending.sent_at)
+                future.set_result(f.result())
+                return
+            if isinstance(reason, TimeoutException) and mac:
+                self.rtt.observe_timeout(mac)
+                if retries > 0:
+                    debug("retrying request to %s" % (mac,))
+                    self._send_attempt(mac, msg, response_class, future, timeout, retries - 1)
+                    return
+            future.set_exception(reason)
+
+        attempt.add_done_callback(_done)
+        debug("_submit:"+repr(msg))
+        with self._write_lock:
+            self._tracker.sent(pending)
+            self.write(msg)
+
+    def _acquire_slot(self):
+        """wait until less than max_inflight requests are outstanding"""
+        if self.reader_running:
+            while not self._inflight.acquire(timeout=self.timeout):
+                self._tracker.expire(self.timeout)
+        else:
+            while not self._inflight.acquire(False):
+                self._pump()
+
+    def wait(self, futures):
+        """process incoming messages until all of the given futures are done
+        Futures that don't get a reply within the timeout fail with TimeoutException.
+        """
+        if self.reader_running:
+            futures_wait(futures)
+            return
 
-        debug("read:"+repr(msg)+" with length "+str(len(msg)))
+        for f in futures:
+            while not f.done():
+                self._pump()
 
-        header_start = msg.find(PlugwiseMessage.PACKET_HEADER)
-        if header_start > 0:
-            # 2011 firmware seems to sometimes send extra \x83 byte before some of the
-            # response messages but there might a all kinds of chatter going on so just 
-            # look for our packet header
-            msg = msg[header_start:]
+    def gather(self, futures):
+        """wait for the futures and return their results in the same order
+        exceptions are returned in place of the result instead of being raised
+        """
+        self.wait(futures)
+        return [f.exception() or f.result() for f in futures]
 
-        response_obj.unserialize(msg)
-        return response_obj
+    def _pump(self):
+        """read one message and hand it to whoever it belongs to"""
+        try:
+            frame = self.read_frame()
+        except TimeoutException:
+            self._tracker.expire(self.timeout)
+            return
+        self._route_frame(frame[4:8], frame)
+        # requests can have shorter timeouts than the one of the serial port. There might
+        # be more frames waiting to be read, so only the acked requests can be expired here.
+        self._tracker.expire(self.timeout, unacked=False)
+
+    def _route_frame(self, function_code, frame):
+        # replies to pipelined requests are matched by the sequence number,
+        # everything else goes to the waiters & subscribers
+        if self._tracker.handle_frame(function_code, frame[8:12], frame):
+            return
+        SerialComChannel._route_frame(self, function_code, frame)
+
+    def _reader_tick(self):
+        self._tracker.expire(self.timeout)
 
     def expect_response(self, response_class, src_mac=None):
-        resp = response_class()
+        """wait for reply of the given type and return it as an unserialized message object"""
+        def unserialize(frame):
+            resp = response_class()
+            resp.unserialize(frame)
+            return resp
+
+        return self._expect(response_class, src_mac, unserialize)
+
+    def expect_record(self, response_class, src_mac=None):
+        """same as expect_response but the reply is decoded with the compiled decoder
+        @return: namedtuple with the fields of the response
+        """
+        return self._expect(response_class, src_mac, response_class.decode)
+
+    def _expect(self, response_class, src_mac, decode):
+        if src_mac is None:
+            timeout = self.timeout
+        else:
+            timeout = self.rtt.timeout(src_mac)
+
+        try:
+            if self.reader_running:
+                resp = self._wait_response(response_class, src_mac, decode, timeout)
+            else:
+                resp = self._read_response(response_class, src_mac, decode, timeout)
+        except TimeoutException:
+            if src_mac is not None:
+                self.rtt.observe_timeout(src_mac)
+            raise
+
+        # the RTT is measured from the request this reply answers, not from whatever
+        # was sent last, other threads might have sent requests in the meantime
+        sent_at = getattr(self._sent, 'at', None)
+        if src_mac is not None and sent_at is not None:
+            self.rtt.observe(src_mac, time.time() - sent_at)
+        return resp
+
+    def _read_response(self, response_class, src_mac, decode, timeout):
+        deadline = time.time() + timeout
         # XXX: there's a lot of debug info flowing on the bus so it's
         # expected that we constantly get unexpected messages
         while 1:
+            # the serial port has its own timeout, so this isn't checked before the next frame
             try:
-                retval = self._recv_response(resp)
+                if time.time() > deadline:
+                    raise TimeoutException("Timeout while waiting for response from device")
+                frame = self.read_frame()
+            except TimeoutException:
+                # like in _pump: a request whose Stick ack got lost must not take the
+                # ack of the next pipelined request
+                self._tracker.expire(self.timeout)
+                raise
+            function_code = frame[4:8]
+            if self._tracker.handle_frame(function_code, frame[8:12], frame):
+                continue
+            if function_code != response_class.ID or (src_mac is not None and src_mac != frame_mac(frame)):
+                SerialComChannel._route_frame(self, function_code, frame)
+                continue
 
-                if src_mac is None or src_mac == retval.mac:
-                    return retval
+            try:
+                return decode(frame)
+            except ProtocolError as reason:
+                error("encountered protocol error:"+str(reason))
 
+    def _wait_response(self, response_class, src_mac, decode, timeout):
+        deadline = time.time() + timeout
+        while 1:
+            frame = self.wait_frame(response_class.ID, src_mac, max(deadline - time.time(), 0),
+                since=getattr(self._sent, 'at', self._last_send))
+            if frame is None:
+                raise TimeoutException("Timeout while waiting for response from device")
+
+            try:
+                return decode(frame)
             except ProtocolError as reason:
                 error("encountered protocol error:"+str(reason))
 
@@ -82,9 +286,11 @@ class Circle(object):
     """provides interface to the Plugwise Plug & Plug+ devices
     """
 
-    def __init__(self, mac, comchan):
+    def __init__(self, mac, comchan, calibration_store=None):
         """
         will raise ValueError if mac doesn't look valid
+        @param calibration_store: CalibrationStore to load calibration values from instead
+            of asking them from the device, freshly fetched values are saved there too
         """
         mac = mac.upper()
         if self._validate_mac(mac) == False:
@@ -93,12 +299,17 @@ class Circle(object):
         self.mac = sc(mac)
 
         self._comchan = comchan
+        self.calibration_store = calibration_store
 
         self.gain_a = None
         self.gain_b = None
         self.off_ruis = None
         self.off_tot = None
 
+        # last known relay state, updated from info replies & switch acks
+        self.relay_state = None
+        self.relay_state_time = None
+
     def _validate_mac(self, mac):
         if not re.match("^[A-F0-9]+$", mac):
             return False
@@ -111,7 +322,7 @@ class Circle(object):
         return True
 
     def _expect_response(self, response_class):
-        return self._comchan.expect_response(response_class, self.mac)
+        return self._comchan.expect_record(response_class, self.mac)
 
     def pulse_correction(self, pulses, seconds=1):
         """correct pulse count with Circle specific calibration offsets
@@ -121,8 +332,7 @@ class Circle(object):
         if pulses == 0:
             return 0.0
 
-        if self.gain_a is None:
-            self.calibrate()
+        self._ensure_calibrated()
 
         pulses /= float(seconds)
         corrected_pulses = seconds * (((((pulses + self.off_ruis)**2) * self.gain_b) + ((pulses + self.off_ruis) * self.gain_a)) + self.off_tot)
@@ -140,16 +350,46 @@ class Circle(object):
         """
         msg = PlugwiseCalibrationRequest(self.mac).serialize()
         self._comchan.send_msg(msg)
-        calibration_response = self._expect_response(PlugwiseCalibrationResponse)
+        return self._apply_calibration(self._expect_response(PlugwiseCalibrationResponse))
+
+    def request_calibration(self):
+        """pipelined version of calibrate
+        @return: future that resolves to the same list as calibrate
+        """
+        f = self._comchan.submit(PlugwiseCalibrationRequest(self.mac), PlugwiseCalibrationResponse)
+        return chain(f, self._apply_calibration)
+
+    def _apply_calibration(self, calibration_response):
         retl = []
 
         for x in ('gain_a', 'gain_b', 'off_ruis', 'off_tot'):
-            val = getattr(calibration_response, x).value
+            val = getattr(calibration_response, x)
             retl.append(val)
             setattr(self, x, val)
 
+        if self.calibration_store is not None:
+            self.calibration_store.put_calibration(self.mac, retl)
+
         return retl
 
+    def _ensure_calibrated(self):
+        """load calibration values from the store or from the device if that hasn't been done yet"""
+        if not self._load_calibration():
+            self.calibrate()
+
+    def _load_calibration(self):
+        """@return: True if the calibration values are known without asking the device"""
+        if self.gain_a is not None:
+            return True
+
+        if self.calibration_store is not None:
+            values = self.calibration_store.get_calibration(self.mac)
+            if values is not None:
+                self.gain_a, self.gain_b, self.off_ruis, self.off_tot = values
+                return True
+
+        return False
+
     def get_pulse_counters(self):
         """return pulse counters for 1s interval, 8s interval and for the current hour
         as a tuple
@@ -157,7 +397,17 @@ class Circle(object):
         msg = PlugwisePowerUsageRequest(self.mac).serialize()
         self._comchan.send_msg(msg)
         resp = self._expect_response(PlugwisePowerUsageResponse)
-        p1s, p8s, p1h = resp.pulse_1s.value, resp.pulse_8s.value, resp.pulse_hour.value
+        return self._parse_pulse_counters(resp)
+
+    def request_pulse_counters(self):
+        """pipelined version of get_pulse_counters
+        @return: future that resolves to the same tuple as get_pulse_counters
+        """
+        f = self._comchan.submit(PlugwisePowerUsageRequest(self.mac), PlugwisePowerUsageResponse)
+        return chain(f, self._parse_pulse_counters)
+
+    def _parse_pulse_counters(self, resp):
+        p1s, p8s, p1h = resp.pulse_1s, resp.pulse_8s, resp.pulse_hour
 
         # sometimes the circle returns max values for some of the pulse counters
         # I have no idea what it means but it certainly isn't a reasonable value
@@ -173,36 +423,99 @@ class Circle(object):
         """returns power usage for the last second in Watts
         might raise ValueError if reading the pulse counters fails
         """
-        pulse_1s, _, _ = self.get_pulse_counters()
-        corrected_pulses = self.pulse_correction(pulse_1s)
-        retval = self.pulses_to_kWs(corrected_pulses)*1000
+        return self._pulse_counters_to_watts(self.get_pulse_counters())
+
+    def request_power_usage(self):
+        """pipelined version of get_power_usage
+        If the Circle hasn't been calibrated yet then that's done before sending the request
+        since calibration values are needed for processing the reply.
+        @return: future that resolves to power usage for the last second in Watts
+        """
+        self._ensure_calibrated()
+        return chain(self.request_pulse_counters(), self._pulse_counters_to_watts)
+
+    def _pulse_counters_to_watts(self, counters):
+        pulse_1s, _, _ = counters
+        return self._pulses_to_watts(pulse_1s, 1)
+
+    def _pulses_to_watts(self, pulses, seconds):
+        corrected_pulses = self.pulse_correction(pulses, seconds)
+        retval = self.pulses_to_kWs(corrected_pulses)/seconds*1000
         # sometimes it's slightly less than 0, probably caused by calibration/calculation errors
         # it doesn't make much sense to return negative power usage in that case
         return retval if retval > 0.0 else 0.0
 
+    def get_power_sample(self):
+        """return PowerSample with everything that can be derived from the pulse counters.
+        The 8 second average is a better estimate of the power usage than the 1 second value
+        when the Circle is polled rarely, energy_hour allows computing the energy usage
+        between the polls exactly (see telemetry.EnergyMeter)
+        might raise ValueError if reading the pulse counters fails
+        """
+        return self._pulse_counters_to_sample(self.get_pulse_counters())
+
+    def request_power_sample(self):
+        """pipelined version of get_power_sample"""
+        self._ensure_calibrated()
+        return chain(self.request_pulse_counters(), self._pulse_counters_to_sample)
+
+    def _pulse_counters_to_sample(self, counters):
+        pulse_1s, pulse_8s, pulse_hour = counters
+        # the hourly counter is corrected the same way as the hourly values in the log buffers
+        energy_hour = self.pulses_to_kWs(self.pulse_correction(pulse_hour, 3600))/3600*1000
+        return PowerSample(time.time(), self._pulses_to_watts(pulse_1s, 1), self._pulses_to_watts(pulse_8s, 8),
+            max(energy_hour, 0.0))
+
     def get_info(self):
         """fetch relay state & current logbuffer index info
         """
+        msg = PlugwiseInfoRequest(self.mac).serialize()
+        self._comchan.send_msg(msg)
+        resp = self._expect_response(PlugwiseInfoResponse)
+        return self._parse_info(resp)
+
+    def request_info(self):
+        """pipelined version of get_info
+        @return: future that resolves to the same dict as get_info
+        """
+        f = self._comchan.submit(PlugwiseInfoRequest(self.mac), PlugwiseInfoResponse)
+        return chain(f, self._parse_info)
+
+    def _parse_info(self, resp):
         def map_hz(hz_raw):
             if hz_raw == 133:
                 return 50
             elif hz_raw == 197:
                 return 60
 
-        msg = PlugwiseInfoRequest(self.mac).serialize()
-        self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseInfoResponse)
-        retd = response_to_dict(resp)
+        retd = record_to_dict(resp)
         retd['hz'] = map_hz(retd['hz'])
+        self._set_relay_state(retd['relay_state'])
         return retd
 
+    def _set_relay_state(self, relay_state):
+        self.relay_state = relay_state
+        self.relay_state_time = time.time() if relay_state is not None else None
+
+    def invalidate_relay_state(self):
+        """forget the relay state so that the next get_relay_state asks it from the device"""
+        self._set_relay_state(None)
+
+    def get_relay_state(self, max_staleness=DEFAULT_RELAY_MAX_STALENESS):
+        """return relay state (1=on, 0=off) from the shadow, the device is only
+        asked if the shadow is older than max_staleness seconds
+        """
+        if self.relay_state is None or time.time() - self.relay_state_time > max_staleness:
+            self.get_info()
+        return self.relay_state
+
     def get_clock(self):
         """fetch current time from the device
         """
         msg = PlugwiseClockInfoRequest(self.mac).serialize()
         self._comchan.send_msg(msg)
         resp = self._expect_response(PlugwiseClockInfoResponse)
-        return resp.time.value
+        return resp.time
 
     def set_clock(self, dt):
         """set clock to the value indicated by the datetime object dt
@@ -213,10 +526,44 @@ class Circle(object):
 
     def switch(self, on):
         """switch power on or off
+        With the reader thread running this doesn't wait for the Circle to ack it, the relay
+        state shadow is updated when the ack arrives. Without the reader the ack is read
+        right away since nothing else would read it in time.
         @param on: new state, boolean
         """
+        future = self.request_switch(on)
+        if not self._comchan.reader_running:
+            self._comchan.wait([future])
+
+    def request_switch(self, on):
+        """pipelined version of switch
+        @return: future that resolves to the decoded ack sent by the Circle
+        """
         req = PlugwiseSwitchRequest(self.mac, on)
-        return self._comchan.send_msg(req.serialize())
+        # assume that the switching succeeds until the ack tells otherwise
+        self._set_relay_state(1 if on else 0)
+        future = self._comchan.submit(req, PlugwiseAckResponse, urgent=True)
+        future.add_done_callback(self._switch_done)
+        return future
+
+    def _switch_done(self, future):
+        if future.exception() is not None:
+            self.invalidate_relay_state()
+        elif future.result().ack_id == PlugwiseAckResponse.ACK_ON:
+            self._set_relay_state(1)
+        elif future.result().ack_id == PlugwiseAckResponse.ACK_OFF:
+            self._set_relay_state(0)
+
+    def switch_if_needed(self, on, max_staleness=DEFAULT_RELAY_MAX_STALENESS):
+        """switch only if the relay isn't already in the requested state.
+        The relay state is taken from the shadow, so usually this is a single request
+        or none at all. The device is asked first only if the shadow is older than max_staleness seconds.
+        @return: True if switch request was sent
+        """
+        if self.get_relay_state(max_staleness) == (1 if on else 0):
+            return False
+        self.switch(on)
+        return True
 
     def switch_on(self):
         self.switch(True)
@@ -242,20 +589,33 @@ class Circle(object):
         log_req = PlugwisePowerBufferRequest(self.mac, log_buffer_index).serialize()
         self._comchan.send_msg(log_req)
         resp = self._expect_response(PlugwisePowerBufferResponse)
+        return self._parse_power_usage_history(resp)
+
+    def request_power_usage_history(self, log_buffer_index):
+        """pipelined version of get_power_usage_history, log_buffer_index is mandatory here
+        @return: future that resolves to the same list as get_power_usage_history
+        """
+        self._ensure_calibrated()
+        req = PlugwisePowerBufferRequest(self.mac, log_buffer_index)
+        f = self._comchan.submit(req, PlugwisePowerBufferResponse)
+        return chain(f, self._parse_power_usage_history)
+
+    def _parse_power_usage_history(self, resp):
         retl = []
 
         for i in range(1, 5):
-            dt = getattr(resp, "logdate%d" % (i,)).value
-            corrected_pulses = self.pulse_correction(getattr(resp, "pulses%d" % (i,)).value, 3600)
+            dt = getattr(resp, "logdate%d" % (i,))
+            corrected_pulses = self.pulse_correction(getattr(resp, "pulses%d" % (i,)), 3600)
             watts = self.pulses_to_kWs(corrected_pulses)/3600*1000
             retl.append((dt, watts))
 
         return retl
 
 def response_to_dict(r):
-    retd = {}
-    for key in dir(r):
-        ptr = getattr(r, key)
-        if isinstance(ptr, BaseType):
-            retd[key] = ptr.value
+    return dict((key, getattr(r, key).value) for key in r.decoder().field_names)
+
+def record_to_dict(r):
+    """convert a decoded response to dict of its fields"""
+    retd = r._asdict()
+    del retd['mac'], retd['command_counter']
     return retd
@@ -0,0 +1,225 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Recording the traffic of a Stick and playing it back later.
+
+A capture file starts with CAPTURE_MAGIC followed by one record per write or
+successful read on the serial port:
+
+    uint32  microseconds since the previous record (monotonic clock)
+    uint8   direction, DIRECTION_WRITE or DIRECTION_READ
+    uint16  length of the data
+    data    the bytes exactly as they were written / read
+
+Usage:
+    >>> stick = Stick("/dev/ttyUSB0", capture="/tmp/stick.cap")
+    ... run the problematic workload ...
+    >>> stick = Stick(ReplaySerial("/tmp/stick.cap", speed=10))
+"""
+
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b'PWCAP1\n'
+
+DIRECTION_WRITE = 0
+DIRECTION_READ = 1
+
+_RECORD = struct.Struct("<IBH")
+_MAX_DELTA = 0xFFFFFFFF
+
+def read_capture(path):
+    """yield (seconds since the start of the capture, direction, data) for each record in the file"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a Plugwise capture file" % (path,))
+        t = 0
+        while 1:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            delta, direction, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # capture was cut short
+                return
+            t += delta
+            yield t / 1e6, direction, data
+
+class CaptureWriter(object):
+    """appends records to a capture file, safe to use from several threads"""
+
+    def __init__(self, path):
+        self._f = open(path, 'wb')
+        self._f.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+
+    def record(self, direction, data):
+        if not data:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # gaps longer than 71 minutes are shortened, nothing useful happens in them anyway
+            delta = min(int((now - self._last) * 1e6), _MAX_DELTA)
+            self._last = now
+            # records are limited to 64k, serial reads never get anywhere close
+            for i in range(0, len(data), 0xFFFF):
+                chunk = data[i:i+0xFFFF]
+                self._f.write(_RECORD.pack(delta, direction, len(chunk)))
+                self._f.write(chunk)
+                delta = 0
+            # the capture is most useful when things go wrong, don't lose the tail
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+class CaptureSerial(object):
+    """wraps a serial port and records everything written to and read from it"""
+
+    def __init__(self, fd, path):
+        self._fd = fd
+        self._writer = CaptureWriter(path)
+
+    def read(self, size=1):
+        data = self._fd.read(size)
+        self._writer.record(DIRECTION_READ, data)
+        return data
+
+    def readline(self):
+        data = self._fd.readline()
+        self._writer.record(DIRECTION_READ, data)
+        return data
+
+    def write(self, data):
+        self._writer.record(DIRECTION_WRITE, data)
+        return self._fd.write(data)
+
+    @property
+    def in_waiting(self):
+        return self._fd.in_waiting
+
+    @property
+    def timeout(self):
+        return self._fd.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._fd.timeout = value
+
+    def close(self):
+        self._writer.close()
+        self._fd.close()
+
+class ReplaySerial(object):
+    """serial port look-alike that plays back a capture file.
+
+    The recorded reads are handed out in order. Reads that followed a write in the
+    capture are held back until the same number of writes has been done during the
+    replay, and then become available with the same delay as in the capture divided
+    by speed. The written data isn't checked against the capture, the number of
+    writes that differ from the recorded ones is counted in mismatches.
+    """
+
+    def __init__(self, path, speed=1.0, timeout=None):
+        """
+        @param speed: 1 replays at the original speed, 10 ten times faster,
+            None hands out the reads without any delay
+        @param timeout: read timeout in seconds like in serial.Serial
+        """
+        self.timeout = timeout
+        self.speed = speed
+        self.mismatches = 0
+        self.extra_writes = 0
+
+        self._records = list(read_capture(path))
+        self._pos = 0
+        self._buf = b''
+        self._cond = threading.Condition()
+        # real and capture time of the last write, the reads are timed relative to that
+        self._anchor = (time.monotonic(), 0.0)
+
+    def _release(self):
+        """move the reads that are due into the buffer
+        @return: seconds until the next read is due or None if it isn't known yet
+        """
+        now = time.monotonic()
+        while self._pos < len(self._records):
+            t, direction, data = self._records[self._pos]
+            if direction != DIRECTION_READ:
+                # the client has to do this write first
+                return None
+            if self.speed:
+                due = self._anchor[0] + (t - self._anchor[1]) / self.speed
+                if due > now:
+                    return due - now
+            self._buf += data
+            self._pos += 1
+        return None
+
+    def write(self, data):
+        with self._cond:
+            # reads that the client didn't wait for are still handed out, just late
+            while self._pos < len(self._records) and self._records[self._pos][1] == DIRECTION_READ:
+                self._buf += self._records[self._pos][2]
+                self._pos += 1
+
+            if self._pos < len(self._records):
+                t, direction, recorded = self._records[self._pos]
+                if recorded != data:
+                    self.mismatches += 1
+                self._pos += 1
+                self._anchor = (time.monotonic(), t)
+            else:
+                self.extra_writes += 1
+            self._cond.notify_all()
+        return len(data)
+
+    def _wait(self, done):
+        """wait until done() is true or the timeout passes"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while 1:
+            next_due = self._release()
+            if done():
+                return
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            if next_due is not None and (remaining is None or next_due < remaining):
+                remaining = next_due
+            if remaining is None and self._pos >= len(self._records):
+                # nothing is ever going to arrive
+                return
+            self._cond.wait(remaining)
+
+    def read(self, size=1):
+        with self._cond:
+            self._wait(lambda: len(self._buf) >= size)
+            data, self._buf = self._buf[:size], self._buf[size:]
+            return data
+
+    def readline(self):
+        with self._cond:
+            self._wait(lambda: b'\n' in self._buf)
+            end = self._buf.find(b'\n')
+            end = len(self._buf) if end < 0 else end + 1
+            data, self._buf = self._buf[:end], self._buf[end:]
+            return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._release()
+            return len(self._buf)
+
+    @property
+    def finished(self):
+        """True when all the recorded traffic has been played back"""
+        with self._cond:
+            return self._pos >= len(self._records) and not self._buf
+
+    def close(self):
+        pass
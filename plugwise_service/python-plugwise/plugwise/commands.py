@@ -0,0 +1,118 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Priority ordered execution of device I/O.
+
+Everything that talks to the devices through a Stick can be handed to its
+CommandQueue. The commands are executed one at a time by a single worker
+thread, always taking the most important waiting command first, so switching
+a lamp never waits behind a queue of power usage polls.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from .util import *
+
+PRIORITY_ACTUATION = 0
+PRIORITY_STATUS = 1
+PRIORITY_TELEMETRY = 2
+PRIORITY_HISTORY = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_ACTUATION: 'actuation',
+    PRIORITY_STATUS: 'status',
+    PRIORITY_TELEMETRY: 'telemetry',
+    PRIORITY_HISTORY: 'history',
+}
+
+class CommandQueue(object):
+    """executes callables one at a time in priority order, lower value goes first.
+    Commands with the same priority are executed in the order they were submitted.
+    """
+
+    def __init__(self, name="plugwise-commands"):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stats = {}
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """stop the worker after the commands that are already queued have been executed"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        thread.join()
+        self._thread = None
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """queue fn(*args, **kwargs) for execution
+        @return: concurrent.futures.Future with the return value of fn
+        """
+        future = Future()
+        with self._cond:
+            heapq.heappush(self._heap, (priority, next(self._counter), time.time(), future, fn, args, kwargs))
+            self._cond.notify()
+        self.start()
+        return future
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while not self._heap and not self._stopping:
+                    self._cond.wait()
+                if not self._heap:
+                    return
+                priority, _, queued_at, future, fn, args, kwargs = heapq.heappop(self._heap)
+                self._account(priority, time.time() - queued_at)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as reason:
+                warning("command %s failed: %r" % (getattr(fn, '__name__', fn), reason))
+                future.set_exception(reason)
+
+    def _account(self, priority, waited):
+        stats = self._stats.setdefault(priority, {'count': 0, 'total_wait': 0.0, 'max_wait': 0.0})
+        stats['count'] += 1
+        stats['total_wait'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+
+    def stats(self):
+        """return {priority name: {'count', 'mean_wait', 'max_wait'}} with the time
+        the executed commands spent waiting in the queue, in seconds
+        """
+        with self._cond:
+            retd = {}
+            for priority, stats in self._stats.items():
+                retd[PRIORITY_NAMES.get(priority, priority)] = {
+                    'count': stats['count'],
+                    'mean_wait': stats['total_wait'] / stats['count'],
+                    'max_wait': stats['max_wait'],
+                }
+            retd['queued'] = len(self._heap)
+            return retd
@@ -0,0 +1,74 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Switching several Circles at once.
+
+All the switch requests of a group are written out back to back and the acks
+are collected afterwards, so switching a whole room takes about as long as
+switching a single Circle.
+"""
+
+import time
+
+from .util import *
+
+class CircleGroup(object):
+    """a set of Circles on the same Stick that are switched together
+
+    Usage:
+        >>> room = CircleGroup([c1, c2, c3], name="livingroom")
+        >>> room.switch(True)
+        {b'000D6F0000000001': True, ...}
+    """
+
+    def __init__(self, circles, name=None):
+        self.circles = list(circles)
+        self.name = name
+        if len(set(c._comchan for c in self.circles)) > 1:
+            raise ValueError("all the Circles of a group have to be on the same Stick")
+
+    @classmethod
+    def from_macs(cls, macs, circles, name=None):
+        """create group of the given MACs
+        @param circles: Circles to pick from
+        will raise ValueError if some of the MACs aren't among the Circles
+        """
+        by_mac = dict((c.mac, c) for c in circles)
+        try:
+            return cls([by_mac[sc(m.upper())] for m in macs], name=name)
+        except KeyError as reason:
+            raise ValueError("unknown Circle %s in group %s" % (reason, name))
+
+    @property
+    def macs(self):
+        return [c.mac for c in self.circles]
+
+    def request_switch(self, on, max_staleness=None):
+        """send the switch requests without waiting for the acks
+        @param max_staleness: skip the Circles whose relay state shadow is at most this many
+            seconds old and already in the requested state. None switches all of them
+        @return: {mac: future that resolves to the ack} of the Circles that were switched
+        """
+        state = 1 if on else 0
+        now = time.time()
+        futures = {}
+        for c in self.circles:
+            if max_staleness is not None and c.relay_state == state and now - c.relay_state_time <= max_staleness:
+                continue
+            futures[c.mac] = c.request_switch(on)
+        return futures
+
+    def switch(self, on, max_staleness=None):
+        """switch all the Circles and wait for the acks
+        @return: {mac: True or the exception if switching failed} of the Circles that were switched
+        """
+        futures = self.request_switch(on, max_staleness)
+        if not futures:
+            return {}
+        stick = self.circles[0]._comchan
+        stick.wait(list(futures.values()))
+        retd = {}
+        for mac, f in futures.items():
+            reason = f.exception()
+            retd[mac] = True if reason is None else reason
+        return retd
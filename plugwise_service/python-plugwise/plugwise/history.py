@@ -0,0 +1,105 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Bulk reading of the power usage history stored in the Circles.
+
+Each log buffer holds 4 hourly samples. The buffers of a range are requested
+through the pipelined Stick API so several of them are in flight at once,
+and the samples are yielded as soon as the buffer they're in arrives.
+"""
+
+import datetime
+
+from .exceptions import *
+from .store import *
+from .util import *
+
+# how far back to go for a Circle that has never been read before, 180 buffers is 30 days
+DEFAULT_BACKFILL_BUFFERS = 180
+
+class HistoryCursorStore(KeyedStore):
+    """remembers up to where the history of each Circle has been read.
+
+    The cursor is the last log buffer that was read together with the timestamp
+    of the last sample that was yielded from it. The buffer that is currently
+    being written is read again on the next run, samples that were already
+    yielded are skipped.
+    """
+
+    def get_cursor(self, mac):
+        """return (log buffer index, datetime of the last sample) or None"""
+        value = self.get(mac)
+        if value is None:
+            return None
+        return value['logaddr'], datetime.datetime.strptime(value['last'], "%Y-%m-%dT%H:%M:%S")
+
+    def put_cursor(self, mac, logaddr, last):
+        self.put(mac, {'logaddr': logaddr, 'last': last.strftime("%Y-%m-%dT%H:%M:%S")})
+
+def iter_power_usage_history(circle, start=None, end=None, cursor_store=None, priority=None, flush=None):
+    """yield (datetime, watt-hours) samples from the log buffers of the Circle in chronological order.
+
+    @param start: index of the first log buffer to read. Defaults to the cursor
+        from cursor_store or DEFAULT_BACKFILL_BUFFERS before end if there's no cursor
+    @param end: index of the last log buffer to read, defaults to the buffer that
+        is currently being written
+    @param cursor_store: HistoryCursorStore that is updated after each buffer
+        so that the next run only reads new buffers
+    @param priority: if given the requests are sent through the command queue of the
+        Stick with this priority (usually PRIORITY_HISTORY) so they don't delay anything else
+    @param flush: called before the cursor is moved past the samples yielded so far,
+        it has to make them durable (e.g. write them out to the database) or raise
+    """
+    stick = circle._comchan
+    last_seen = None
+
+    def run_io(fn, *args):
+        if priority is None:
+            return fn(*args)
+        return stick.execute(priority, fn, *args).result()
+
+    if end is None:
+        end = run_io(circle.get_info)['last_logaddr']
+
+    if start is None:
+        cursor = cursor_store.get_cursor(circle.mac) if cursor_store is not None else None
+        if cursor is not None:
+            start, last_seen = cursor
+        else:
+            start = max(end - DEFAULT_BACKFILL_BUFFERS, 0)
+
+    if start > end:
+        return
+
+    # keep the pipeline full, the buffers are consumed in order
+    pending = []
+    next_index = start
+    while pending or next_index <= end:
+        while next_index <= end and len(pending) < stick.max_inflight:
+            pending.append((next_index, run_io(circle.request_power_usage_history, next_index)))
+            next_index += 1
+
+        index, future = pending.pop(0)
+        stick.wait([future])
+
+        for dt, watt_hours in future.result():
+            # slots that haven't been written yet don't contain valid dates
+            if dt is None or (last_seen is not None and dt <= last_seen):
+                continue
+            last_seen = dt
+            yield dt, watt_hours
+
+        if cursor_store is not None and last_seen is not None:
+            if flush is not None:
+                flush()
+            cursor_store.put_cursor(circle.mac, index, last_seen)
+
+def iter_fleet_power_usage_history(circles, cursor_store=None, priority=None, flush=None):
+    """yield (mac, datetime, watt-hours) for all the new samples of all the given Circles"""
+    for c in circles:
+        try:
+            for dt, watt_hours in iter_power_usage_history(c, cursor_store=cursor_store, priority=priority,
+                    flush=flush):
+                yield c.mac, dt, watt_hours
+        except PlugwiseException as reason:
+            error("failed to read history of %s: %s" % (c.mac, reason))
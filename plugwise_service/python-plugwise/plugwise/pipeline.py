@@ -0,0 +1,302 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Bookkeeping for requests that are sent without waiting for the previous reply.
+
+The Stick acknowledges every request in the order it receives them and the ack
+carries the sequence number assigned to the request. Replies from the Circles carry
+the same sequence number in their command_counter field, so once the ack has been
+seen a reply can be matched to its request regardless of the order in which
+replies arrive.
+"""
+
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+from .protocol import *
+from .exceptions import *
+from .util import *
+
+# bounds of the timeouts derived from the measured round trip times
+MIN_TIMEOUT = 0.5
+MAX_TIMEOUT = 10.0
+
+# round trip times are only trusted once there are this many samples of the device
+MIN_RTT_SAMPLES = 4
+
+# how many of the latest round trip times are kept per device for the percentiles
+RTT_WINDOW = 64
+
+# a device that has timed out this many times in a row is considered slow
+SLOW_TIMEOUTS = 3
+
+class PendingRequest(object):
+    """a request that has been written out but hasn't been answered yet"""
+
+    __slots__ = ('mac', 'response_class', 'future', 'seq', 'sent_at', 'timeout')
+
+    def __init__(self, mac, response_class, future=None, timeout=None):
+        """
+        @param mac: MAC of the addressed device, replies from other devices are never accepted
+        @param response_class: class of the expected reply.
+            PlugwiseAckResponse means that the request is done once the Circle acks it.
+            None means that the ack from the Stick is all we are going to get.
+        @param timeout: seconds to wait for the reply, None uses the timeout given to expire()
+        """
+        self.mac = mac
+        self.response_class = response_class
+        self.future = future
+        self.seq = None
+        self.sent_at = None
+        self.timeout = timeout
+
+    def complete(self, frame):
+        try:
+            resp = self.response_class.decode(frame)
+        except ProtocolError as reason:
+            self.fail(reason)
+            return
+        self.future.set_result(resp)
+
+    def fail(self, reason):
+        if self.future is not None and not self.future.done():
+            self.future.set_exception(reason)
+
+class RequestTracker(object):
+    """matches acks & replies to outstanding requests using the sequence numbers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._unacked = deque()
+        self._by_seq = {}
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for p in self._unacked if p.future is not None) + len(self._by_seq)
+
+    def sent(self, pending):
+        """register request that is about to be written out.
+        Requests that are sent without tracking still have to be registered with a
+        PendingRequest that has no future, otherwise the acks would get out of step.
+        """
+        pending.sent_at = time.time()
+        with self._lock:
+            self._unacked.append(pending)
+
+    def handle_frame(self, function_code, seq, frame):
+        """process a frame read from the Stick
+        @return: True if the frame belonged to a tracked request
+        """
+        if function_code == PlugwiseAckResponse.ID:
+            return self._handle_ack(seq, frame)
+
+        with self._lock:
+            pending = self._by_seq.get(seq)
+            if pending is None or pending.response_class is None or pending.response_class.ID != function_code:
+                return False
+            if frame_mac(frame) != pending.mac:
+                return False
+            del self._by_seq[seq]
+
+        pending.complete(frame)
+        return True
+
+    def _handle_ack(self, seq, frame):
+        try:
+            ack = PlugwiseAckResponse.decode(frame)
+        except ProtocolError as reason:
+            error("ignoring broken ack: "+str(reason))
+            return False
+
+        if ack.mac is None and ack.ack_id in (PlugwiseAckResponse.ACK_SUCCESS, PlugwiseAckResponse.ACK_ERROR):
+            pending = self._pop_unacked()
+            if pending is None or pending.future is None:
+                return pending is not None
+
+            if ack.ack_id == PlugwiseAckResponse.ACK_ERROR:
+                pending.fail(ProtocolError("Stick refused the request"))
+            elif pending.response_class is None:
+                pending.future.set_result(ack)
+            else:
+                pending.seq = seq
+                with self._lock:
+                    self._by_seq[seq] = pending
+            return True
+
+        with self._lock:
+            pending = self._by_seq.get(seq)
+            if pending is None:
+                return False
+            if ack.ack_id == PlugwiseAckResponse.ACK_TIMEOUT:
+                del self._by_seq[seq]
+            elif pending.response_class is PlugwiseAckResponse and ack.mac == pending.mac:
+                del self._by_seq[seq]
+            else:
+                return False
+
+        if ack.ack_id == PlugwiseAckResponse.ACK_TIMEOUT:
+            pending.fail(TimeoutException("Circle %s didn't respond" % (pending.mac,)))
+        else:
+            pending.future.set_result(ack)
+        return True
+
+    def _pop_unacked(self):
+        # the Stick acks in the order it received the requests, so the ack always
+        # belongs to the oldest request that hasn't been acked yet, no matter how late
+        # it is read. Lost acks are dealt with by expire().
+        with self._lock:
+            if not self._unacked:
+                return None
+            return self._unacked.popleft()
+
+    def expire(self, timeout, unacked=True):
+        """fail all the requests that have been waiting for longer than their own
+        timeout or timeout seconds if they don't have one
+        @param unacked: also give up on requests the Stick hasn't acked yet. Only pass True
+            when everything received so far has been read, otherwise the ack might
+            still be waiting to be read and dropping the request would put the acks
+            of all the following requests out of step.
+        """
+        now = time.time()
+
+        def overdue(pending):
+            return pending.sent_at < now - (timeout if pending.timeout is None else pending.timeout)
+
+        expired = []
+        with self._lock:
+            while unacked and self._unacked and overdue(self._unacked[0]):
+                expired.append(self._unacked.popleft())
+            for seq, pending in list(self._by_seq.items()):
+                if overdue(pending):
+                    expired.append(self._by_seq.pop(seq))
+
+        for pending in expired:
+            pending.fail(TimeoutException("Timeout while waiting for response from device"))
+
+class _DeviceRtt(object):
+    __slots__ = ('srtt', 'rttvar', 'samples', 'timeouts', 'total_timeouts')
+
+    def __init__(self, window):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = deque(maxlen=window)
+        self.timeouts = 0
+        self.total_timeouts = 0
+
+RttStats = namedtuple('RttStats', ['count', 'srtt', 'rttvar', 'p50', 'p90', 'p99', 'timeout', 'timeouts', 'slow'])
+
+class RttTracker(object):
+    """keeps track of the round trip times of each device and derives the timeouts from them.
+
+    The smoothed RTT and its variation are computed like TCP does (RFC 6298), the timeout
+    of a device is srtt + 4*rttvar but at least a bit more than the 99th percentile of the
+    recent samples. Every consecutive timeout of the device doubles that. Until there are
+    enough samples of a device the round trip times of all the devices together are used
+    and max_timeout if there aren't enough of those either.
+    """
+
+    def __init__(self, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, alpha=0.125, beta=0.25,
+            window=RTT_WINDOW, min_samples=MIN_RTT_SAMPLES):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._all = _DeviceRtt(window)
+
+    def _device(self, mac):
+        device = self._devices.get(mac)
+        if device is None:
+            device = self._devices[mac] = _DeviceRtt(self.window)
+        return device
+
+    def observe(self, mac, rtt):
+        """record a successful request to the device that took rtt seconds"""
+        with self._lock:
+            device = self._device(mac)
+            for d in (device, self._all):
+                if d.srtt is None:
+                    d.srtt = rtt
+                    d.rttvar = rtt / 2
+                else:
+                    d.rttvar += self.beta * (abs(d.srtt - rtt) - d.rttvar)
+                    d.srtt += self.alpha * (rtt - d.srtt)
+                d.samples.append(rtt)
+            device.timeouts = 0
+
+    def observe_timeout(self, mac):
+        """record a request to the device that didn't get a reply in time"""
+        with self._lock:
+            device = self._device(mac)
+            device.timeouts += 1
+            device.total_timeouts += 1
+
+    def timeout(self, mac):
+        """return how long to wait for a reply from the device, in seconds"""
+        with self._lock:
+            device = self._devices.get(mac)
+            timeouts = device.timeouts if device is not None else 0
+            if device is None or len(device.samples) < self.min_samples:
+                device = self._all
+                if len(device.samples) < self.min_samples:
+                    return self.max_timeout
+            timeout = max(device.srtt + 4*device.rttvar, _percentile(device.samples, 99) * 1.25)
+            timeout *= 2 ** timeouts
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def percentile(self, mac, p):
+        """return the p-th percentile of the recent round trip times of the device or None"""
+        with self._lock:
+            device = self._devices.get(mac)
+            if device is None or not device.samples:
+                return None
+            return _percentile(device.samples, p)
+
+    def is_slow(self, mac, slow_rtt=None):
+        """True if the device has timed out SLOW_TIMEOUTS times in a row or,
+        if slow_rtt is given, its median round trip time is above that
+        """
+        with self._lock:
+            device = self._devices.get(mac)
+            if device is None:
+                return False
+            if device.timeouts >= SLOW_TIMEOUTS:
+                return True
+            if slow_rtt is None or len(device.samples) < self.min_samples:
+                return False
+            return _percentile(device.samples, 50) > slow_rtt
+
+    def stats(self, slow_rtt=None):
+        """return {mac: RttStats} for all the devices seen so far"""
+        with self._lock:
+            macs = list(self._devices.keys())
+        retd = {}
+        for mac in macs:
+            with self._lock:
+                device = self._devices[mac]
+                count, srtt, rttvar, timeouts = len(device.samples), device.srtt, device.rttvar, device.total_timeouts
+            retd[mac] = RttStats(count, srtt, rttvar, self.percentile(mac, 50), self.percentile(mac, 90),
+                self.percentile(mac, 99), self.timeout(mac), timeouts, self.is_slow(mac, slow_rtt))
+        return retd
+
+def _percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+def chain(future, fn):
+    """return a future that resolves to fn(result of future)"""
+    chained = Future()
+
+    def _done(f):
+        try:
+            chained.set_result(fn(f.result()))
+        except Exception as reason:
+            chained.set_exception(reason)
+
+    future.add_done_callback(_done)
+    return chained
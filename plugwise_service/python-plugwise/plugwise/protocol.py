@@ -5,6 +5,7 @@
 import struct
 import binascii
 import datetime
+from collections import namedtuple
 
 from .exceptions import *
 from .util import *
@@ -14,9 +15,7 @@ DEBUG_PROTOCOL = False
 # plugwise year information is offset from y2k
 PLUGWISE_EPOCH = 2000
 
-import crcmod
-
-crc_fun = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
+crc_fun = crc16
 
 class BaseType(object):
     def __init__(self, value, length):
@@ -32,6 +31,25 @@ class BaseType(object):
     def __len__(self):
         return self.length
 
+    # the compiled decoders first turn the hex payload into binary and unpack it with
+    # a single struct format, the methods below describe how each type takes part in that
+
+    def struct_format(self):
+        return "%ds" % (self.length // 2)
+
+    def struct_count(self):
+        """how many values struct_format unpacks to"""
+        return 1
+
+    def converter(self):
+        """return function that turns the unpacked value(s) into the value of the field
+        or None if the unpacked value can be used as is
+        """
+        return _hex_upper
+
+def _hex_upper(raw):
+    return binascii.hexlify(raw).upper()
+
 class CompositeType(BaseType):
     def __init__(self):
         self.contents = []
@@ -51,6 +69,12 @@ class CompositeType(BaseType):
     def __len__(self):
         return sum(len(x) for x in self.contents)
 
+    def struct_format(self):
+        return ''.join(x.struct_format() for x in self.contents)
+
+    def struct_count(self):
+        return sum(x.struct_count() for x in self.contents)
+
 class String(BaseType):
     pass
 
@@ -66,6 +90,14 @@ class Int(BaseType):
     def unserialize(self, val):
         self.value = int(val, 16)
 
+    STRUCT_FORMATS = {2: 'B', 4: 'H', 8: 'I', 16: 'Q'}
+
+    def struct_format(self):
+        return self.STRUCT_FORMATS[self.length]
+
+    def converter(self):
+        return None
+
 class UnixTimestamp(Int):
     def __init__(self, value, length=8):
         Int.__init__(self, value, length=length)
@@ -74,6 +106,9 @@ class UnixTimestamp(Int):
         Int.unserialize(self, val)
         self.value = datetime.datetime.fromtimestamp(self.value)
 
+    def converter(self):
+        return datetime.datetime.fromtimestamp
+
 class Year2k(Int):
     """year value that is offset from the year 2000"""
 
@@ -81,6 +116,9 @@ class Year2k(Int):
         Int.unserialize(self, val)
         self.value += PLUGWISE_EPOCH
 
+    def converter(self):
+        return lambda raw: raw + PLUGWISE_EPOCH
+
 class DateTime(CompositeType):
     """datetime value as used in the general info response
     format is: YYMMmmmm
@@ -97,16 +135,22 @@ class DateTime(CompositeType):
 
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
-        minutes = self.minutes.value
+        self.value = self._to_datetime(self.year.value, self.month.value, self.minutes.value)
+
+    def converter(self):
+        return lambda raw: self._to_datetime(raw[0] + PLUGWISE_EPOCH, raw[1], raw[2])
+
+    @staticmethod
+    def _to_datetime(year, month, minutes):
         hours = minutes // 60
         days = hours // 24
         hours -= (days*24)
         minutes -= (days*24*60)+(hours*60)
         try:
-            self.value = datetime.datetime(self.year.value, self.month.value, days+1, hours, minutes)
+            return datetime.datetime(year, month, days+1, hours, minutes)
         except ValueError:
             debug('encountered value error while attempting to construct datetime object')
-            self.value = None
+            return None
 
 class Time(CompositeType):
     """time value as used in the clock info response"""
@@ -121,6 +165,9 @@ class Time(CompositeType):
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
         self.value = datetime.time(self.hour.value, self.minute.value, self.second.value)
+
+    def converter(self):
+        return lambda raw: datetime.time(*raw)
         
 
 class Float(BaseType):
@@ -132,6 +179,12 @@ class Float(BaseType):
         hexval = binascii.unhexlify(val)
         self.value = struct.unpack("!f", hexval)[0]
 
+    def struct_format(self):
+        return 'f'
+
+    def converter(self):
+        return None
+
 class LogAddr(Int):
     LOGADDR_OFFSET = 278528
 
@@ -142,23 +195,109 @@ class LogAddr(Int):
         Int.unserialize(self, val)
         self.value = (self.value - self.LOGADDR_OFFSET) // 32
 
+    def converter(self):
+        return lambda raw: (raw - self.LOGADDR_OFFSET) // 32
+
 # /base types
 
+class ResponseDecoder(object):
+    """field layout of a response class compiled into a single struct format & offset table.
+
+    The response classes stay the description of the message layout, they are
+    instantiated only once here to find out the names, order & types of the fields.
+    Decoding a frame afterwards doesn't allocate any field objects, the result
+    is a namedtuple with mac, command_counter and a member for each field.
+    """
+
+    def __init__(self, response_class):
+        proto = response_class()
+        attr_names = dict((id(v), k) for k, v in vars(proto).items() if isinstance(v, BaseType))
+
+        fmt = '>'
+        fields = []
+        index = 0
+        for p in proto.params:
+            count = p.struct_count()
+            fields.append((attr_names[id(p)], index, count, p.converter()))
+            fmt += p.struct_format()
+            index += count
+
+        # some messages list the same field twice, the last occurrence wins like it does for the objects
+        self.fields = [f for i, f in enumerate(fields) if f[0] not in [x[0] for x in fields[i+1:]]]
+        self.field_names = [f[0] for f in self.fields]
+
+        self.function_code = response_class.ID
+        self.payload_end = len(proto)-6
+        self.length = len(proto)
+        self._struct = struct.Struct(fmt)
+        self.record = namedtuple(response_class.__name__+'Record', ['mac', 'command_counter']+self.field_names)
+
+    def decode(self, frame):
+        if len(frame) != self.length:
+            raise ProtocolError("message doesn't have expected length. expected %d bytes got %d" % (self.length, len(frame)))
+
+        if frame[:4] != PACKET_HEADER:
+            raise ProtocolError("broken header!")
+
+        if frame[4:8] != self.function_code:
+            raise ProtocolError("unexpected function code %r, expected %r" % (frame[4:8], self.function_code))
+
+        if frame[-2:] != PACKET_FOOTER:
+            raise ProtocolError("broken footer!")
+
+        if not checksum_ok(frame):
+            raise ProtocolError("broken checksum!")
+
+        try:
+            raw = self._struct.unpack(binascii.unhexlify(frame[28:self.payload_end]))
+        except (binascii.Error, TypeError, ValueError) as reason:
+            raise ProtocolError("message contains invalid hex: "+str(reason))
+
+        values = [frame[12:28], frame[8:12]]
+        for _, index, count, conv in self.fields:
+            if count == 1:
+                val = raw[index]
+            else:
+                val = raw[index:index+count]
+            values.append(val if conv is None else conv(val))
+        return self.record._make(values)
+
 class PlugwiseMessage(object):
-    PACKET_HEADER = b'\x05\x05\x03\x03'
-    PACKET_FOOTER = b'\x0d\x0a'
-    
+    PACKET_HEADER = PACKET_HEADER
+    PACKET_FOOTER = PACKET_FOOTER
+
+    # serialized frames of the requests that are sent over and over again
+    # (info, power usage...) are cached by (message ID, MAC, args)
+    FRAME_CACHE_SIZE = 4096
+    _frame_cache = {}
+
     def serialize(self):
         """return message in a serialized format that can be sent out
         on wire
         """
+        key = self.cache_key()
+        if key is not None:
+            frame = self._frame_cache.get(key)
+            if frame is not None:
+                return frame
+
         args = b''.join(a.serialize() for a in self.args)
         msg = self.ID+self.mac+sc(args)
         checksum = self.calculate_checksum(msg)
-        return self.PACKET_HEADER+msg+checksum+self.PACKET_FOOTER
+        frame = self.PACKET_HEADER+msg+checksum+self.PACKET_FOOTER
+
+        if key is not None:
+            if len(self._frame_cache) >= self.FRAME_CACHE_SIZE:
+                self._frame_cache.clear()
+            self._frame_cache[key] = frame
+        return frame
+
+    def cache_key(self):
+        """return hashable key identifying the serialized frame or None if the frame shouldn't be cached"""
+        return None
 
     def calculate_checksum(self, s):
-        return sc("%04X" % crc_fun(s))
+        return checksum(s)
 
 class PlugwiseResponse(PlugwiseMessage):
     def __init__(self):
@@ -172,22 +311,26 @@ class PlugwiseResponse(PlugwiseMessage):
         if len(response) != len(self):
             raise ProtocolError("message doesn't have expected length. expected %d bytes got %d" % (len(self), len(response)))
 
+        frame = response
         header, function_code, self.command_counter, self.mac = struct.unpack("4s4s4s16s", response[:28])
         debug(repr(header)+" "+repr(function_code)+" "+repr(self.command_counter)+" "+repr(self.mac))
 
-        # FIXME: check function code match
-
         if header != self.PACKET_HEADER:
             raise ProtocolError("broken header!")
 
+        if function_code != self.ID:
+            raise ProtocolError("unexpected function code %r, expected %r" % (function_code, self.ID))
+
         # FIXME: avoid magic numbers
         response = response[28:]
         response = self._parse_params(response)
-        crc = response[:4]
 
         if response[4:] != self.PACKET_FOOTER:
             raise ProtocolError("broken footer!")
 
+        if not checksum_ok(frame):
+            raise ProtocolError("broken checksum!")
+
     def _parse_params(self, response):
         for p in self.params:
             myval = response[:len(p)]
@@ -201,6 +344,81 @@ class PlugwiseResponse(PlugwiseMessage):
         arglen = sum(len(x) for x in self.params)
         return 34 + arglen
 
+    @classmethod
+    def decoder(cls):
+        """return the compiled decoder of this message type, it's created on first use"""
+        decoder = cls.__dict__.get('_decoder')
+        if decoder is None:
+            decoder = cls._decoder = ResponseDecoder(cls)
+        return decoder
+
+    @classmethod
+    def decode(cls, frame):
+        """fast alternative to unserialize, returns namedtuple instead of filling in the message object"""
+        return cls.decoder().decode(frame)
+
+class PlugwiseAckResponse(PlugwiseResponse):
+    """acknowledgement sent for every request
+
+    The Stick acks each request it accepts with ACK_SUCCESS and the sequence number
+    it assigned to it. The response from the Circle later carries the same value in its
+    command_counter field, which is what allows several requests to be in flight at once.
+    Requests without a real response (switching, clock setting) are acked a second time
+    by the Circle, those acks also contain the MAC of the Circle.
+    """
+    ID = ACK_FUNCTION_CODE
+
+    ACK_SUCCESS = b'00C1'
+    ACK_ERROR = b'00C2'
+    ACK_TIMEOUT = b'00E1'
+    ACK_CLOCK_SET = b'00D7'
+    ACK_ON = b'00D8'
+    ACK_OFF = b'00DE'
+
+    def __init__(self):
+        PlugwiseResponse.__init__(self)
+        self.ack_id = None
+
+    def unserialize(self, response):
+        # unlike the other responses the MAC is optional and comes after the ack code
+        if len(response) not in (22, 38):
+            raise ProtocolError("ack doesn't have expected length. got %d bytes" % (len(response),))
+
+        header, function_code, self.command_counter, self.ack_id = struct.unpack("4s4s4s4s", response[:16])
+
+        if header != self.PACKET_HEADER:
+            raise ProtocolError("broken header!")
+
+        if function_code != self.ID:
+            raise ProtocolError("unexpected function code %r, expected %r" % (function_code, self.ID))
+
+        if len(response) == 38:
+            self.mac = response[16:32]
+
+        if response[-2:] != self.PACKET_FOOTER:
+            raise ProtocolError("broken footer!")
+
+        if not checksum_ok(response):
+            raise ProtocolError("broken checksum!")
+
+    def __len__(self):
+        return 22 if self.mac is None else 38
+
+    Record = namedtuple('PlugwiseAckResponseRecord', ['mac', 'command_counter', 'ack_id'])
+
+    @classmethod
+    def decode(cls, frame):
+        if len(frame) not in (22, 38):
+            raise ProtocolError("ack doesn't have expected length. got %d bytes" % (len(frame),))
+
+        if frame[:4] != PACKET_HEADER or frame[4:8] != cls.ID or frame[-2:] != PACKET_FOOTER:
+            raise ProtocolError("broken ack!")
+
+        if not checksum_ok(frame):
+            raise ProtocolError("broken checksum!")
+
+        return cls.Record(frame[16:32] if len(frame) == 38 else None, frame[8:12], frame[12:16])
+
 class PlugwiseCalibrationResponse(PlugwiseResponse):
     ID = b'0027'
 
@@ -295,12 +513,25 @@ class PlugwiseInitResponse(PlugwiseResponse):
             self.unknown,
         ]
 
+RESPONSE_CLASSES = dict((cls.ID, cls) for cls in (
+    PlugwiseAckResponse,
+    PlugwiseCalibrationResponse,
+    PlugwiseClockInfoResponse,
+    PlugwisePowerUsageResponse,
+    PlugwisePowerBufferResponse,
+    PlugwiseInfoResponse,
+    PlugwiseInitResponse,
+))
+
 class PlugwiseRequest(PlugwiseMessage):
     def __init__(self, mac):
         PlugwiseMessage.__init__(self)
         self.args = []
         self.mac = sc(mac)
 
+    def cache_key(self):
+        return (self.ID, self.mac, tuple((type(a), a.length, a.value) for a in self.args))
+
 class PlugwiseInitRequest(PlugwiseRequest):
     """initialize Stick"""
     ID = b'000A'
@@ -333,6 +564,10 @@ class PlugwiseClockSetRequest(PlugwiseRequest):
         log_buf_addr = String('FFFFFFFF', 8)
         self.args += [d, log_buf_addr, t, day_of_week]
 
+    def cache_key(self):
+        # every clock set message is different, no point in caching them
+        return None
+
 class PlugwiseSwitchRequest(PlugwiseRequest):
     """switches Plug or or off"""
     ID = b'0017'
@@ -0,0 +1,290 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Periodic power usage polling for a fleet of Circles.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+
+from .commands import *
+from .exceptions import *
+from .pipeline import chain
+from .util import *
+
+DEFAULT_POLL_INTERVAL = 10.0
+
+# relay state is refreshed with an info request at least this often
+DEFAULT_INFO_INTERVAL = 300.0
+
+# slow devices are polled this many times less often than the others
+SLOW_LANE_FACTOR = 6
+
+class PollScheduler(object):
+    """polls power usage of the Circles so that each one is sampled once per interval.
+
+    The polls are spread evenly over the interval instead of being done in a burst
+    and are sent through the pipelined Stick API. The relay state is taken from the
+    relay state shadow of the Circle, so a poll normally costs a single power usage request
+    (or nothing at all when the relay is off) and the info request is only sent when
+    the shadow is older than info_interval.
+
+    Devices that keep timing out (or that answer slower than slow_rtt) are moved to a
+    slow lane where they are polled only every slow_interval seconds, so that they don't
+    keep the pipeline full of requests that are not going to be answered. They are
+    moved back as soon as they answer normally again.
+
+    Usage:
+        >>> def report(circle, watts, relay_state):
+        ...     print circle.mac, watts
+        >>> s = PollScheduler(stick, circles, interval=10, callback=report)
+        >>> s.start()
+    """
+
+    def __init__(self, stick, circles, interval=DEFAULT_POLL_INTERVAL, callback=None,
+            error_callback=None, info_interval=DEFAULT_INFO_INTERVAL, priority=None,
+            slow_interval=None, slow_rtt=None, energy_meter=None):
+        """
+        @param interval: seconds between two samples of the same Circle
+        @param callback: called with (circle, watts, relay_state) after each poll
+        @param error_callback: called with (circle, exception) when a poll fails
+        @param priority: if given the polls are sent through the command queue of the Stick
+            with this priority (usually PRIORITY_TELEMETRY) instead of directly
+        @param slow_interval: seconds between the polls of a slow Circle,
+            defaults to SLOW_LANE_FACTOR times interval
+        @param slow_rtt: Circles with median round trip time above this many seconds are
+            treated as slow too, by default only the ones that keep timing out are
+        @param energy_meter: telemetry.EnergyMeter that is fed with PowerSamples of the Circles.
+            The callback then gets the 8 second average instead of the 1 second value, which
+            together with the energy accounting allows polling much less often
+        """
+        self.stick = stick
+        self.circles = list(circles)
+        self.interval = interval
+        self.callback = callback
+        self.error_callback = error_callback
+        self.info_interval = info_interval
+        self.priority = priority
+        self.slow_interval = slow_interval if slow_interval is not None else interval * SLOW_LANE_FACTOR
+        self.slow_rtt = slow_rtt
+        self.energy_meter = energy_meter
+
+        self._lock = threading.Lock()
+        self._outstanding = set()
+        self._busy_since = None
+        self._busy_time = 0.0
+        self._requests = 0
+        # polls that sent at least one request, the ones of Circles that are off
+        # and don't need an info request are free and mustn't dilute the average
+        self._active_polls = 0
+        self._rtt_total = 0.0
+
+        # work that the reply callbacks hand back to the polling thread, the callbacks
+        # run in the reader thread and must not send requests & wait for them there
+        self._followups = deque()
+        self._wake = threading.Event()
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="plugwise-poller")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def run(self):
+        """poll until stop() is called"""
+        now = time.time()
+        spacing = self.interval / max(len(self.circles), 1)
+        queue = [(now + i*spacing, i) for i in range(len(self.circles))]
+        heapq.heapify(queue)
+
+        while not self._stop.is_set():
+            self._wake.clear()
+            while self._followups:
+                self._followups.popleft()()
+
+            now = time.time()
+            while queue and queue[0][0] <= now:
+                due, i = heapq.heappop(queue)
+                circle = self.circles[i]
+                self._run_io(self._poll, circle)
+                # schedule from the due time, not from now, so the spacing doesn't drift
+                heapq.heappush(queue, (max(due + self._interval_of(circle), now), i))
+
+            if self.priority is None and not self.stick.reader_running:
+                # somebody has to read the replies
+                with self._lock:
+                    outstanding = list(self._outstanding)
+                self.stick.wait(outstanding)
+
+            if queue and not self._followups:
+                self._wake.wait(max(queue[0][0] - time.time(), 0))
+
+    def _interval_of(self, circle):
+        if self.is_slow(circle):
+            return self.slow_interval
+        return self.interval
+
+    def is_slow(self, circle):
+        """True if the Circle is in the slow lane"""
+        return self.stick.rtt.is_slow(circle.mac, self.slow_rtt)
+
+    def _later(self, fn):
+        """run fn in the polling thread"""
+        self._followups.append(lambda: self._run_io(fn))
+        self._wake.set()
+
+    def _run_io(self, fn, *args):
+        if self.priority is None:
+            fn(*args)
+        else:
+            future = self.stick.execute(self.priority, fn, *args)
+            future.add_done_callback(lambda f: self._io_done(f, args))
+
+    def _io_done(self, future, args):
+        # the command failed before any request of it was tracked, e.g. a serial error
+        reason = future.exception()
+        if reason is None:
+            return
+        if args:
+            self._report_error(args[0], reason)
+        else:
+            warning("polling failed: %r" % (reason,))
+
+    def _poll(self, circle):
+        relay_state = circle.relay_state
+
+        if relay_state is None or time.time() - circle.relay_state_time >= self.info_interval:
+            self._track(circle.request_info(), lambda f: self._info_done(circle, f))
+        else:
+            self._poll_power(circle, relay_state)
+
+    def _poll_power(self, circle, relay_state, requested=False):
+        """@param requested: the poll has already sent an info request"""
+        if relay_state:
+            try:
+                # this might have to calibrate the Circle first
+                if self.energy_meter is None:
+                    future = circle.request_power_usage()
+                else:
+                    future = chain(circle.request_power_sample(), lambda sample: self._account(circle, sample))
+            except PlugwiseException as reason:
+                self._report_error(circle, reason)
+                return
+            self._track(future, lambda f: self._power_done(circle, f, relay_state))
+        else:
+            self._count_poll(requested)
+            if self.energy_meter is not None:
+                self.energy_meter.idle(circle.mac)
+            self._report(circle, 0.0, relay_state)
+
+    def _account(self, circle, sample):
+        self.energy_meter.update(circle.mac, sample)
+        return sample.power_8s
+
+    def _info_done(self, circle, future):
+        try:
+            info = future.result()
+        except Exception as reason:
+            self._report_error(circle, reason)
+            return
+
+        self._later(lambda: self._poll_power(circle, info['relay_state'], requested=True))
+
+    def _count_poll(self, requested):
+        if not requested:
+            return
+        with self._lock:
+            self._active_polls += 1
+
+    def _power_done(self, circle, future, relay_state):
+        self._count_poll(True)
+        try:
+            watts = future.result()
+        except Exception as reason:
+            self._report_error(circle, reason)
+            return
+        self._report(circle, watts, relay_state)
+
+    def _report(self, circle, watts, relay_state):
+        if self.callback is not None:
+            try:
+                self.callback(circle, watts, relay_state)
+            except Exception as reason:
+                error("poll callback failed: "+str(reason))
+
+    def _report_error(self, circle, reason):
+        # the relay state might have changed, find out on the next poll
+        circle.invalidate_relay_state()
+        if self.error_callback is not None:
+            self.error_callback(circle, reason)
+        else:
+            warning("polling %s failed: %r" % (circle.mac, reason))
+
+    def _track(self, future, done):
+        """keep account of the time the Stick spends with requests in flight"""
+        sent_at = time.time()
+        with self._lock:
+            if not self._outstanding:
+                self._busy_since = sent_at
+            self._outstanding.add(future)
+            self._requests += 1
+
+        def _finished(f):
+            now = time.time()
+            with self._lock:
+                self._outstanding.discard(f)
+                self._rtt_total += now - sent_at
+                if not self._outstanding:
+                    self._busy_time += now - self._busy_since
+            done(f)
+
+        future.add_done_callback(_finished)
+
+    def stats(self):
+        """return dict with the measured performance of the polling:
+            rtt: average time from sending a request to getting the reply
+            throughput: requests the Stick completes per second while it has work
+            requests_per_poll: average number of requests a poll that sends any needs
+            capacity: how many devices could be polled at the current interval,
+                None until there's enough data
+            slow: MACs of the Circles in the slow lane
+        """
+        with self._lock:
+            busy_time = self._busy_time
+            if self._outstanding:
+                busy_time += time.time() - self._busy_since
+            requests, polls, rtt_total = self._requests, self._active_polls, self._rtt_total
+            completed = requests - len(self._outstanding)
+
+        retd = {
+            'rtt': rtt_total / completed if completed else None,
+            'throughput': completed / busy_time if busy_time > 0 else None,
+            'requests_per_poll': float(requests) / polls if polls else None,
+            'capacity': None,
+            'slow': [c.mac for c in self.circles if self.is_slow(c)],
+        }
+        retd['capacity'] = self.capacity(self.interval, retd)
+        return retd
+
+    def capacity(self, interval, stats=None):
+        """return how many devices the Stick can sustain if each one is sampled every interval seconds"""
+        if stats is None:
+            stats = self.stats()
+        if not stats['throughput'] or not stats['requests_per_poll']:
+            return None
+        return int(stats['throughput'] * interval / stats['requests_per_poll'])
@@ -0,0 +1,322 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Driving several Sticks, each one from its own worker process.
+
+Every Stick (shard) gets a worker process that owns the serial port, the
+Circles behind it and a PollScheduler for them. The main process only routes
+commands to the right shard using the device to Stick map and merges the
+telemetry coming back from all the workers, so the capacity grows with the
+number of Sticks and CPU cores.
+
+Usage:
+    >>> def report(mac, watts, relay_state, energy_hour):
+    ...     print(mac, watts)
+    >>> shards = ShardManager({"/dev/ttyUSB0": [mac1, mac2], "/dev/ttyUSB1": [mac3]}, power_callback=report)
+    >>> shards.start()
+    >>> shards.switch([mac1, mac3], True)
+    {b'...': True, b'...': True}
+"""
+
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import wait as wait_connections
+
+from .exceptions import *
+from .util import *
+
+# how long the main process waits for the workers to finish when stopping
+WORKER_STOP_TIMEOUT = 10.0
+
+class ShardManager(object):
+    """starts a worker process per Stick and talks to them through queues"""
+
+    def __init__(self, sticks, power_callback=None, error_callback=None, hour_callback=None,
+            interval=10.0, retries=0, calibration_file=None, multirate=False, set_clock=True):
+        """
+        @param sticks: {port: [MACs of the Circles behind that Stick]}
+        @param power_callback: called with (mac, watts, relay_state, energy_hour) for each poll,
+            energy_hour is the Wh used in the current hour or None if multirate is off
+        @param error_callback: called with (mac, error message) when a poll fails
+        @param hour_callback: called with (mac, datetime of the start of the hour, Wh) in multirate mode
+        @param interval: seconds between polls of the same Circle
+        @param retries: see Stick
+        @param calibration_file: each shard keeps its calibration values in a file of its own
+            that is named after this one, e.g. calibration-0.json, calibration-1.json, ...
+        @param multirate: poll power samples and account energy, see telemetry.EnergyMeter
+        @param set_clock: set the clocks of the Circles when the worker starts
+        """
+        self.sticks = dict((port, [sc(m.upper()) for m in macs]) for port, macs in sticks.items())
+        self.power_callback = power_callback
+        self.error_callback = error_callback
+        self.hour_callback = hour_callback
+        self.options = {
+            'interval': interval,
+            'retries': retries,
+            'multirate': multirate,
+            'set_clock': set_clock,
+        }
+        self.calibration_file = calibration_file
+
+        self.shard_of = {}
+        for port, macs in self.sticks.items():
+            for mac in macs:
+                if mac in self.shard_of:
+                    raise ValueError("%s is behind both %s and %s" % (mac, self.shard_of[mac], port))
+                self.shard_of[mac] = port
+
+        self._context = multiprocessing.get_context()
+        # every worker sends its events through a pipe of its own, so a worker that dies
+        # can't take the others with it and its end of file tells that it's gone
+        self._events = {}
+        self._gone = set()
+        self._stopping = False
+        self._wakeup = None
+        self._commands = {}
+        self._workers = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._events_thread = None
+
+    def _calibration_file(self, index):
+        if self.calibration_file is None:
+            return None
+        root, ext = os.path.splitext(self.calibration_file)
+        return "%s-%d%s" % (root, index, ext)
+
+    def start(self):
+        if self._workers:
+            return
+        for index, (port, macs) in enumerate(sorted(self.sticks.items())):
+            commands = self._context.Queue()
+            events, worker_events = self._context.Pipe(duplex=False)
+            options = dict(self.options, calibration_file=self._calibration_file(index))
+            worker = self._context.Process(target=_worker_main, args=(port, macs, options, commands, worker_events),
+                name="plugwise-shard-%d" % (index,))
+            worker.daemon = True
+            worker.start()
+            # only the worker may hold the sending end, otherwise its death wouldn't close the pipe
+            worker_events.close()
+            self._commands[port] = commands
+            self._events[port] = events
+            self._workers[port] = worker
+
+        self._wakeup = self._context.Pipe(duplex=False)
+        self._gone = set()
+        self._stopping = False
+        self._events_thread = threading.Thread(target=self._read_events, name="plugwise-shard-events")
+        self._events_thread.daemon = True
+        self._events_thread.start()
+
+    def stop(self):
+        self._stopping = True
+        for commands in self._commands.values():
+            commands.put(None)
+        for worker in self._workers.values():
+            worker.join(WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        if self._events_thread is not None:
+            self._wakeup[1].send(None)
+            self._events_thread.join()
+        for events in self._events.values():
+            events.close()
+        self._workers, self._commands, self._events, self._events_thread = {}, {}, {}, None
+
+    def _call(self, port, command, *args):
+        """send command to the worker of the Stick
+        @return: future that resolves to the reply of the worker, it fails with
+            PlugwiseException if the command failed or the worker is gone
+        """
+        future = Future()
+        request_id = next(self._ids)
+        with self._pending_lock:
+            if port in self._gone or not self._workers[port].is_alive():
+                future.set_exception(PlugwiseException("worker of Stick %s isn't running" % (port,)))
+                return future
+            self._pending[request_id] = (port, future)
+        self._commands[port].put((command, request_id) + args)
+        return future
+
+    def _shard_gone(self, port):
+        """the worker of the Stick has exited, fail its outstanding commands"""
+        worker = self._workers[port]
+        worker.join(WORKER_STOP_TIMEOUT)
+        reason = "worker of Stick %s exited with code %s" % (port, worker.exitcode)
+        if not self._stopping:
+            warning(reason)
+        with self._pending_lock:
+            self._gone.add(port)
+            failed = [request_id for request_id, (p, _) in self._pending.items() if p == port]
+            futures = [self._pending.pop(request_id)[1] for request_id in failed]
+        for future in futures:
+            future.set_exception(PlugwiseException(reason))
+
+    def request_switch(self, macs, on, max_staleness=None):
+        """switch the Circles, the requests to different Sticks are sent in parallel
+        @return: future that resolves to {mac: True or error message}
+        will raise ValueError if some of the MACs aren't behind any of the Sticks
+        """
+        by_port = {}
+        for mac in macs:
+            mac = sc(mac.upper())
+            if mac not in self.shard_of:
+                raise ValueError("unknown Circle "+repr(mac))
+            by_port.setdefault(self.shard_of[mac], []).append(mac)
+
+        futures = dict((self._call(port, 'switch', port_macs, on, max_staleness), port_macs)
+            for port, port_macs in by_port.items())
+        merged = Future()
+        remaining = [len(futures)]
+        results = {}
+        lock = threading.Lock()
+
+        def _done(f):
+            with lock:
+                if f.exception() is None:
+                    results.update(f.result())
+                else:
+                    # the whole shard failed, so did each of its Circles
+                    results.update((mac, str(f.exception())) for mac in futures[f])
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                merged.set_result(results)
+
+        if not futures:
+            merged.set_result(results)
+        for f in futures:
+            f.add_done_callback(_done)
+        return merged
+
+    def switch(self, macs, on, max_staleness=None, timeout=None):
+        """blocking version of request_switch"""
+        return self.request_switch(macs, on, max_staleness).result(timeout)
+
+    def stats(self, timeout=None):
+        """return {port: polling & command queue stats of the shard}"""
+        futures = dict((port, self._call(port, 'stats')) for port in self._commands)
+        return dict((port, f.result(timeout)) for port, f in futures.items())
+
+    def _read_events(self):
+        port_of = dict((events, port) for port, events in self._events.items())
+        wakeup = self._wakeup[0]
+        while 1:
+            for conn in wait_connections(list(port_of) + [wakeup]):
+                if conn is wakeup:
+                    return
+                try:
+                    event = conn.recv()
+                except (EOFError, OSError):
+                    # a dead worker never replies, its callers must not wait forever
+                    self._shard_gone(port_of.pop(conn))
+                    continue
+                self._handle_event(event)
+
+    def _handle_event(self, event):
+        kind, args = event[0], event[1:]
+        try:
+            if kind in ('reply', 'failed'):
+                request_id, result = args
+                with self._pending_lock:
+                    _, future = self._pending.pop(request_id, (None, None))
+                if future is None:
+                    return
+                if kind == 'reply':
+                    future.set_result(result)
+                else:
+                    future.set_exception(PlugwiseException(result))
+            elif kind == 'power' and self.power_callback is not None:
+                self.power_callback(*args)
+            elif kind == 'error' and self.error_callback is not None:
+                self.error_callback(*args)
+            elif kind == 'hour' and self.hour_callback is not None:
+                self.hour_callback(*args)
+        except Exception as reason:
+            error("handling %s event failed: %s" % (kind, reason))
+
+class _EventPipe(object):
+    """the sending end of the events pipe of a worker, several threads of the worker use it"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        with self._lock:
+            self._conn.send(event)
+
+def _worker_main(port, macs, options, commands, events):
+    """entry point of the worker process of a single Stick"""
+    events = _EventPipe(events)
+    # imported here so that the main process doesn't need the serial port code
+    from .api import Stick, Circle
+    from .commands import PRIORITY_ACTUATION, PRIORITY_STATUS, PRIORITY_TELEMETRY
+    from .groups import CircleGroup
+    from .scheduler import PollScheduler
+    from .startup import LazyInitializer
+    from .store import CalibrationStore
+    from .telemetry import EnergyMeter
+
+    try:
+        stick = Stick(port, reader=True, retries=options['retries'])
+    except Exception as reason:
+        for mac in macs:
+            events.put(('error', mac, "Stick %s failed: %s" % (port, reason)))
+        return
+    calibration = None
+    if options['calibration_file'] is not None:
+        calibration = CalibrationStore(options['calibration_file'])
+    circles = dict((mac, Circle(mac.decode(), stick, calibration_store=calibration)) for mac in macs)
+    def initialized(circle, result):
+        if isinstance(result, Exception):
+            events.put(('error', circle.mac, "init failed: %s" % (result,)))
+
+    initializer = LazyInitializer(stick, list(circles.values()), set_clock=options['set_clock'],
+        callback=initialized)
+    initializer.start()
+
+    meter = None
+    if options['multirate']:
+        meter = EnergyMeter(hour_callback=lambda mac, hour, wh: events.put(('hour', mac, hour, wh)))
+
+    def report(circle, watts, relay_state):
+        energy_hour = None
+        if meter is not None and meter.last_sample(circle.mac) is not None:
+            energy_hour = meter.last_sample(circle.mac).energy_hour
+        events.put(('power', circle.mac, watts, relay_state, energy_hour))
+
+    poller = PollScheduler(stick, list(circles.values()), interval=options['interval'], callback=report,
+        error_callback=lambda circle, reason: events.put(('error', circle.mac, str(reason))),
+        priority=PRIORITY_TELEMETRY, energy_meter=meter)
+    poller.start()
+    if calibration is not None:
+        calibration.start_refresh(list(circles.values()), priority=PRIORITY_STATUS)
+
+    def switch(request_id, macs, on, max_staleness):
+        ready, results = initializer.ensure_all([circles[m] for m in macs])
+        results.update(CircleGroup(ready).switch(on, max_staleness))
+        events.put(('reply', request_id, dict((m, r if r is True else str(r)) for m, r in results.items())))
+
+    def stats(request_id):
+        retd = dict(poller.stats(), commands=stick.commands.stats())
+        events.put(('reply', request_id, retd))
+
+    handlers = {'switch': switch, 'stats': stats}
+    while 1:
+        command = commands.get()
+        if command is None:
+            break
+        name, request_id, args = command[0], command[1], command[2:]
+        future = stick.execute(PRIORITY_ACTUATION if name == 'switch' else PRIORITY_STATUS,
+            handlers[name], request_id, *args)
+        # the caller must not wait forever for a command that failed
+        future.add_done_callback(lambda f, request_id=request_id:
+            f.exception() is not None and events.put(('failed', request_id, str(f.exception()))))
+
+    poller.stop()
+    stick.commands.stop()
@@ -0,0 +1,288 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Simulated Stick with a network of virtual Circles behind a pseudo terminal.
+
+The simulator answers the init, info, power usage, calibration, clock,
+switch and power buffer requests like a real Stick does: every request is
+acked right away with a sequence number and the reply of the Circle follows
+after a configurable latency. Replies can be dropped and stray bytes can be
+put in front of the frames to exercise the error handling.
+
+Usage:
+    >>> sim = CircleSimulator(count=200, latency=0.05)
+    >>> sim.start()
+    >>> stick = Stick(sim.port)
+    >>> Circle(sim.macs[0], stick).get_power_usage()
+    60.0
+
+or from the command line, e.g. for running the MQTT services against it:
+    python -m plugwise.simulator -n 200 --latency 0.05
+"""
+
+import binascii
+import datetime
+import heapq
+import optparse
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from .api import PULSES_PER_KW_SECOND
+from .protocol import *
+from .util import *
+
+# the first simulated Circle gets this MAC, the rest count up from it
+FIRST_MAC = 0x000D6F0000000001
+
+# garbage the real Stick is known to send in front of some frames
+NOISE_BYTES = b'\x83'
+
+class VirtualCircle(object):
+    """state of a single simulated Circle
+    The calibration values are neutral so the reported power is exactly the configured
+    one after correction.
+    """
+
+    def __init__(self, mac, watts=60.0, relay_state=True, history_hours=48):
+        """
+        @param watts: power used while the relay is on
+        @param history_hours: how many hours of history are in the log buffers
+        """
+        self.mac = sc(mac)
+        self.watts = watts
+        self.relay_state = relay_state
+        self.gain_a = 1.0
+        self.gain_b = 0.0
+        self.off_tot = 0.0
+        self.off_ruis = 0.0
+        # the log starts at a full hour
+        self.started = (time.time() // 3600 - history_hours) * 3600
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def pulses(self, seconds, watts=None):
+        """pulse count for the current power over the given number of seconds"""
+        if watts is None:
+            watts = self.watts if self.relay_state else 0.0
+        return int(round(watts / 1000.0 * PULSES_PER_KW_SECOND * seconds))
+
+    def last_logaddr(self):
+        hours = int((time.time() - self.started) // 3600)
+        return hours // 4
+
+    def log_slot(self, hour):
+        """(DateTime, pulses) of the given hour of the log, counted from the start"""
+        slot_time = datetime.datetime.fromtimestamp(self.started + hour*3600)
+        if self.started + (hour+1)*3600 > time.time():
+            return String(b'FFFFFFFF', 8), Int(0xFFFFFFFF, 8)
+        return _datetime(slot_time), Int(self.pulses(3600, self.watts), 8)
+
+    def handle(self, function_code, payload):
+        """return [(ID of the reply, payload of the reply)] for the request"""
+        if function_code == PlugwisePowerUsageRequest.ID:
+            return [(PlugwisePowerUsageResponse.ID, _serialize(
+                Int(self.pulses(1), 4), Int(self.pulses(8), 4), Int(self.pulses(time.time() % 3600), 8),
+                Int(0, 4), Int(0, 4), Int(0, 4)))]
+
+        if function_code == PlugwiseInfoRequest.ID:
+            return [(PlugwiseInfoResponse.ID, _serialize(
+                _datetime(self.now()), LogAddr(self.last_logaddr(), 8), Int(int(self.relay_state), 2),
+                Int(0x85, 2), String(b'000000730007', 12), Int(0x4E0843A9, 8), Int(1, 2)))]
+
+        if function_code == PlugwiseCalibrationRequest.ID:
+            return [(PlugwiseCalibrationResponse.ID, b''.join(_float(x)
+                for x in (self.gain_a, self.gain_b, self.off_tot, self.off_ruis)))]
+
+        if function_code == PlugwiseClockInfoRequest.ID:
+            now = self.now()
+            return [(PlugwiseClockInfoResponse.ID, _serialize(
+                Time(now.hour, now.minute, now.second), Int(now.weekday(), 2), Int(0, 2), Int(0, 4)))]
+
+        if function_code == PlugwiseClockSetRequest.ID:
+            return [(ACK_FUNCTION_CODE, PlugwiseAckResponse.ACK_CLOCK_SET)]
+
+        if function_code == PlugwiseSwitchRequest.ID:
+            self.relay_state = payload[:2] == b'01'
+            return [(ACK_FUNCTION_CODE, PlugwiseAckResponse.ACK_ON if self.relay_state else PlugwiseAckResponse.ACK_OFF)]
+
+        if function_code == PlugwisePowerBufferRequest.ID:
+            address = LogAddr(0, 8)
+            address.unserialize(payload[:8])
+            args = []
+            for i in range(4):
+                args += self.log_slot(address.value*4 + i)
+            args.append(LogAddr(address.value, 8))
+            return [(PlugwisePowerBufferResponse.ID, _serialize(*args))]
+
+        return []
+
+def _serialize(*args):
+    return b''.join(a.serialize() for a in args)
+
+def _float(value):
+    return sc(binascii.hexlify(struct.pack("!f", value)).upper())
+
+def _datetime(dt):
+    minutes = (dt.day-1)*24*60 + dt.hour*60 + dt.minute
+    return DateTime(dt.year, dt.month, minutes)
+
+class CircleSimulator(object):
+    """pseudo terminal that behaves like a Stick with a number of Circles in its network
+
+    The Stick acks are sent immediately, the replies from the Circles follow after
+    latency +- jitter seconds, so replies to pipelined requests can arrive in a different
+    order than the requests were sent. Requests to unknown MACs are answered with
+    a timeout ack after unknown_delay seconds.
+    """
+
+    def __init__(self, count=2, macs=None, latency=0.0, jitter=0.0, drop_rate=0.0, noise_rate=0.0,
+            unknown_delay=1.0, seed=None, **circle_options):
+        """
+        @param count: number of Circles, ignored if macs is given
+        @param macs: MACs of the Circles
+        @param latency: average delay of the replies from the Circles in seconds
+        @param jitter: the delay varies uniformly this much around latency
+        @param drop_rate: probability that a reply from a Circle is lost
+        @param noise_rate: probability that a frame is preceded by NOISE_BYTES
+        @param circle_options: passed on to VirtualCircle
+        """
+        if macs is None:
+            macs = ["%016X" % (FIRST_MAC + i) for i in range(count)]
+        self.circles = dict((sc(m), VirtualCircle(m, **circle_options)) for m in macs)
+        self.macs = list(macs)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.noise_rate = noise_rate
+        self.unknown_delay = unknown_delay
+        self.random = random.Random(seed)
+
+        self.requests = 0
+        self.dropped = 0
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._seq = 0
+        self._scheduled = []
+        self._counter = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="plugwise-simulator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        """serve requests until stop() is called"""
+        buf = b''
+        while not self._stop.is_set():
+            timeout = 0.1
+            if self._scheduled:
+                timeout = min(max(self._scheduled[0][0] - time.time(), 0), timeout)
+
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if readable:
+                buf += os.read(self._master, 4096)
+                while PACKET_FOOTER in buf:
+                    line, buf = buf.split(PACKET_FOOTER, 1)
+                    self._handle_line(line)
+
+            now = time.time()
+            while self._scheduled and self._scheduled[0][0] <= now:
+                _, _, frame = heapq.heappop(self._scheduled)
+                self._send(frame)
+
+    def _handle_line(self, line):
+        start = line.find(PACKET_HEADER)
+        if start < 0:
+            return
+        # requests carry a checksum too, but the real Stick doesn't complain about broken ones either
+        msg = line[start+len(PACKET_HEADER):-4]
+        function_code, mac, payload = msg[:4], msg[4:20], msg[20:]
+        self.requests += 1
+
+        self._seq = (self._seq + 1) & 0xFFFF
+        seq = b'%04X' % (self._seq,)
+        self._send(self._frame(ACK_FUNCTION_CODE + seq + PlugwiseAckResponse.ACK_SUCCESS))
+
+        if function_code == PlugwiseInitRequest.ID:
+            self._send(self._frame(PlugwiseInitResponse.ID + seq + b'0' * 16 + _serialize(
+                Int(0, 2), Int(1, 2), Int(FIRST_MAC, 16), Int(0xABCD, 4), Int(0, 2))))
+            return
+
+        circle = self.circles.get(mac)
+        if circle is None:
+            self._schedule(self.unknown_delay,
+                self._frame(ACK_FUNCTION_CODE + seq + PlugwiseAckResponse.ACK_TIMEOUT + mac))
+            return
+
+        for reply_id, reply in circle.handle(function_code, payload):
+            if self.random.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            if reply_id == ACK_FUNCTION_CODE:
+                body = reply_id + seq + reply + mac
+            else:
+                body = reply_id + seq + mac + reply
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            self._schedule(max(delay, 0), self._frame(body))
+
+    def _frame(self, body):
+        return PACKET_HEADER + body + checksum(body) + PACKET_FOOTER
+
+    def _schedule(self, delay, frame):
+        self._counter += 1
+        heapq.heappush(self._scheduled, (time.time() + delay, self._counter, frame))
+
+    def _send(self, frame):
+        if self.random.random() < self.noise_rate:
+            frame = NOISE_BYTES + frame
+        os.write(self._master, frame)
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--count", type="int", default=2, help="number of simulated Circles")
+    parser.add_option("-m", "--mac", action="append", dest="macs",
+        help="MAC of a simulated Circle, can be given several times. Overrides --count")
+    parser.add_option("--latency", type="float", default=0.0, help="reply latency in seconds")
+    parser.add_option("--jitter", type="float", default=0.0, help="reply latency varies this much")
+    parser.add_option("--drop-rate", type="float", default=0.0, help="probability of losing a reply")
+    parser.add_option("--noise-rate", type="float", default=0.0, help="probability of noise in front of a frame")
+    parser.add_option("--watts", type="float", default=60.0, help="power used by each Circle")
+    options, args = parser.parse_args()
+
+    sim = CircleSimulator(count=options.count, macs=options.macs, latency=options.latency,
+        jitter=options.jitter, drop_rate=options.drop_rate, noise_rate=options.noise_rate,
+        watts=options.watts)
+    print("simulating %d Circles on %s" % (len(sim.macs), sim.port))
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Initializing the Circles in the background.
+
+Setting the clocks, finding out the relay states and loading the calibration
+values takes a few round trips per Circle. Instead of doing all of that before
+a service can start serving requests, LazyInitializer queues the work in the
+command queue of the Stick and a device that is needed earlier is initialized
+on demand.
+"""
+
+import datetime
+import threading
+
+from .commands import *
+from .util import *
+
+class LazyInitializer(object):
+    """initializes the Circles through the command queue of the Stick
+
+    Usage:
+        >>> init = LazyInitializer(stick, [c1, c2])
+        >>> init.start()
+        ...
+        >>> init.ensure(c1)    # before the first command to c1
+        >>> c1.switch_if_needed(True)
+    """
+
+    def __init__(self, stick, circles, priority=PRIORITY_STATUS, set_clock=True, callback=None):
+        """
+        @param priority: priority of the initialization in the command queue
+        @param set_clock: set the clocks of the Circles to the local time
+        @param callback: called with (circle, info dict or exception) when a Circle has been initialized
+        """
+        self.stick = stick
+        self.circles = list(circles)
+        self.priority = priority
+        self.set_clock = set_clock
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._locks = dict((c.mac, threading.Lock()) for c in self.circles)
+        self._done = set()
+
+    def start(self):
+        """queue the initialization of all the Circles, returns right away"""
+        return [self.stick.execute(self.priority, self.ensure, c) for c in self.circles]
+
+    def is_initialized(self, circle):
+        with self._lock:
+            return circle.mac in self._done
+
+    def ensure(self, circle):
+        """initialize the Circle now unless that has already been done.
+        Failures are not remembered, the next call tries again.
+        """
+        if self.is_initialized(circle):
+            return
+        with self._locks[circle.mac]:
+            # somebody else might have done it while we were waiting
+            if self.is_initialized(circle):
+                return
+            try:
+                info = self._initialize(circle)
+            except Exception as reason:
+                warning("initializing %s failed: %s" % (circle.mac, reason))
+                self._report(circle, reason)
+                raise
+            with self._lock:
+                self._done.add(circle.mac)
+        self._report(circle, info)
+
+    def ensure_all(self, circles):
+        """ensure for several Circles, a Circle that fails is left out instead of
+        stopping the others, commands must not be sent to it either
+        @return: (list of the initialized Circles, {mac: exception} of the ones that failed)
+        """
+        ready, failed = [], {}
+        for c in circles:
+            try:
+                self.ensure(c)
+            except Exception as reason:
+                failed[c.mac] = reason
+            else:
+                ready.append(c)
+        return ready, failed
+
+    def _initialize(self, circle):
+        if self.set_clock:
+            circle.set_clock(datetime.datetime.now())
+        # the info request also fills in the relay state shadow
+        info = circle.get_info()
+        circle._ensure_calibrated()
+        return info
+
+    def _report(self, circle, result):
+        if self.callback is None:
+            return
+        try:
+            self.callback(circle, result)
+        except Exception as reason:
+            error("init callback failed: "+str(reason))
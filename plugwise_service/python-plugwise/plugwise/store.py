@@ -0,0 +1,150 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Small on-disk stores for per device data that should survive restarts.
+"""
+
+import json
+import os
+import threading
+import time
+
+from .util import *
+
+# calibration values are set in the factory, refreshing them once in a while is only
+# a safety net against a Circle being swapped out under the same configuration
+DEFAULT_CALIBRATION_MAX_AGE = 30*24*3600
+
+class KeyedStore(object):
+    """JSON file backed mapping of device MAC to a value.
+    Every entry remembers when it was last updated. Changes are written out
+    immediately, the file is replaced atomically so a crash can't leave it half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError as reason:
+            error("ignoring broken store %s: %s" % (self.path, reason))
+            return {}
+
+    def _save(self):
+        """write the entries out, a failure only costs persistence: the entries
+        stay in memory and the next put tries again"""
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as reason:
+            warning("failed to save store %s: %s" % (self.path, reason))
+
+    def _key(self, mac):
+        return mac.decode('ascii') if isinstance(mac, bytes) else mac
+
+    def get(self, mac, max_age=None):
+        """return value stored for the device or None if there's none or it's older than max_age seconds"""
+        with self._lock:
+            entry = self._entries.get(self._key(mac))
+        if entry is None:
+            return None
+        if max_age is not None and time.time() - entry['updated'] > max_age:
+            return None
+        return entry['value']
+
+    def age(self, mac):
+        """return how many seconds ago the entry was updated, None if there's no entry"""
+        with self._lock:
+            entry = self._entries.get(self._key(mac))
+        return None if entry is None else time.time() - entry['updated']
+
+    def put(self, mac, value):
+        with self._lock:
+            self._entries[self._key(mac)] = {'value': value, 'updated': time.time()}
+            self._save()
+
+class CalibrationStore(KeyedStore):
+    """keeps calibration values of the Circles so they don't have to be fetched after every restart
+
+    Usage:
+        >>> store = CalibrationStore("/var/lib/plugwise/calibration.json")
+        >>> c = Circle(mac, stick, calibration_store=store)
+        >>> store.start_refresh([c])
+    """
+
+    FIELDS = ('gain_a', 'gain_b', 'off_ruis', 'off_tot')
+
+    def __init__(self, path, max_age=DEFAULT_CALIBRATION_MAX_AGE):
+        """
+        @param max_age: calibration values older than this many seconds are considered stale
+        """
+        KeyedStore.__init__(self, path)
+        self.max_age = max_age
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+
+    def get_calibration(self, mac):
+        """return (gain_a, gain_b, off_ruis, off_tot) or None if there are no fresh values for the device"""
+        value = self.get(mac, self.max_age)
+        if value is None:
+            return None
+        return tuple(value[x] for x in self.FIELDS)
+
+    def put_calibration(self, mac, values):
+        self.put(mac, dict(zip(self.FIELDS, values)))
+
+    def start_refresh(self, circles, interval=3600, priority=None):
+        """start a thread that recalibrates Circles whose values are missing or are about to go stale.
+        Refresh starts when the values have reached 3/4 of max_age so that a Circle
+        never has to be calibrated in the middle of a power reading.
+        If priority is given the calibration requests go through the command queue of the Stick.
+        """
+        if self._refresh_thread is not None:
+            return
+        self._refresh_stop.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, args=(list(circles), interval, priority),
+            name="plugwise-calibration")
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def stop_refresh(self):
+        if self._refresh_thread is None:
+            return
+        self._refresh_stop.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+    def _due(self, circle):
+        age = self.age(circle.mac)
+        if age is None:
+            # calibrated some other way since the Circle was created
+            return circle.gain_a is None
+        return age >= self.max_age*0.75
+
+    def _refresh(self, circle):
+        # checked again right before calibrating: while this waited in the command queue
+        # the Circle might have been calibrated by somebody else, e.g. plugwise.startup
+        if self._due(circle):
+            circle.calibrate()
+
+    def _refresh_loop(self, circles, interval, priority):
+        while not self._refresh_stop.is_set():
+            for c in circles:
+                if not self._due(c):
+                    continue
+                try:
+                    if priority is None:
+                        self._refresh(c)
+                    else:
+                        c._comchan.execute(priority, self._refresh, c).result()
+                except Exception as reason:
+                    error("failed to refresh calibration of %s: %s" % (c.mac, reason))
+            self._refresh_stop.wait(interval)
@@ -0,0 +1,114 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+Energy accounting from the pulse counters of the Circles.
+
+Besides the 1 second counter every power usage reply contains the pulses of
+the last 8 seconds and of the current hour. The hourly counter makes it
+possible to poll rarely without losing energy: the energy used between two
+polls is the difference of the hourly counters, only the part of an hour
+after the last poll before the counter is reset has to be estimated.
+
+Note that the Circle resets the hourly counter according to its own clock,
+so the clocks should be set (Circle.set_clock) for the hour boundaries to match.
+"""
+
+import datetime
+import threading
+import time
+
+from .api import PowerSample
+from .util import *
+
+class EnergyMeter(object):
+    """integrates the PowerSamples of Circles into energy counters
+
+    Usage:
+        >>> meter = EnergyMeter(hour_callback=save_hourly_energy)
+        >>> meter.update(circle.mac, circle.get_power_sample())
+        >>> meter.total(circle.mac)
+    """
+
+    def __init__(self, hour_callback=None):
+        """
+        @param hour_callback: called with (mac, datetime of the start of the hour, Wh)
+            when a sample from a new hour shows that the previous hour has ended.
+            Hours without any sample in them are interpolated and reported too.
+        """
+        self.hour_callback = hour_callback
+        self._lock = threading.Lock()
+        self._last = {}
+        self._totals = {}
+
+    def update(self, mac, sample):
+        """account for a new sample of the Circle
+        @return: Wh used since the previous sample of the Circle
+        """
+        with self._lock:
+            last = self._last.get(mac)
+            self._last[mac] = sample
+            if last is None:
+                self._totals[mac] = 0.0
+                return 0.0
+
+            last_hour = _hour_start(last.timestamp)
+            sample_hour = _hour_start(sample.timestamp)
+            finished = []
+            if sample_hour == last_hour:
+                # the counter might have been read a little differently, it never goes back
+                used = max(sample.energy_hour - last.energy_hour, 0.0)
+            else:
+                # the counter was reset at the top of the hour, the rest of the previous hour
+                # after the last sample is estimated from the 8 second average power
+                end = last_hour + datetime.timedelta(hours=1)
+                tail = last.power_8s * max(_timestamp(end) - last.timestamp, 0) / 3600
+                finished.append((last_hour, last.energy_hour + tail))
+                used = tail + sample.energy_hour
+                # whole hours without any sample (slow lane, outage, restart) are
+                # interpolated from the power of the samples on both sides of the gap
+                gap_power = (last.power_8s + sample.power_8s) / 2
+                hour = end
+                while hour < sample_hour:
+                    finished.append((hour, gap_power))
+                    used += gap_power
+                    hour += datetime.timedelta(hours=1)
+                if len(finished) > 1:
+                    warning("no samples of %s for %d hour(s) from %s, interpolated %.1f W" %
+                        (mac, len(finished) - 1, end, gap_power))
+            self._totals[mac] += used
+
+        if self.hour_callback is not None:
+            for hour, wh in finished:
+                try:
+                    self.hour_callback(mac, hour, wh)
+                except Exception as reason:
+                    error("hour callback failed: "+str(reason))
+        return used
+
+    def idle(self, mac, timestamp=None):
+        """account for a Circle that is known to be switched off without asking it
+        @return: Wh used since the previous sample of the Circle
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            last = self._last.get(mac)
+        energy_hour = 0.0
+        if last is not None and _hour_start(last.timestamp) == _hour_start(timestamp):
+            energy_hour = last.energy_hour
+        return self.update(mac, PowerSample(timestamp, 0.0, 0.0, energy_hour))
+
+    def total(self, mac):
+        """return Wh used by the Circle since its first sample, None if there hasn't been one"""
+        with self._lock:
+            return self._totals.get(mac)
+
+    def last_sample(self, mac):
+        with self._lock:
+            return self._last.get(mac)
+
+def _hour_start(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+
+def _timestamp(dt):
+    return time.mktime(dt.timetuple())
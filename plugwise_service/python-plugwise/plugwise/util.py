@@ -1,11 +1,33 @@
 # Copyright (C) 2011 Sven Petai <hadara@bsd.ee> 
 # Use of this source code is governed by the MIT license found in the LICENSE file.
 
+import binascii
+import logging
 import sys
+import threading
+import time
+from collections import deque
+
 import serial
 
+from .capture import CaptureSerial
+from .exceptions import TimeoutException
+
 DEBUG_PROTOCOL = False
 
+logger = logging.getLogger("plugwise")
+
+PACKET_HEADER = b'\x05\x05\x03\x03'
+PACKET_FOOTER = b'\x0d\x0a'
+
+ACK_FUNCTION_CODE = b'0000'
+
+# how often the reader thread wakes up when there's nothing to read
+READER_POLL_INTERVAL = 0.5
+
+# how many unclaimed frames are kept around per (function code, MAC)
+MAILBOX_SIZE = 4
+
 def _string_convert_py3(s):
     if type(s) == type(b''):
         return s
@@ -33,16 +55,102 @@ def error(msg):
     # so just ignore these for now unless the debug is set
     return debug(msg)
 
+def warning(msg):
+    """report a failure that must not go unnoticed, unlike error() this is always shown"""
+    logger.warning(msg)
+
+def crc16(data):
+    """CRC-16/XMODEM (polynomial 0x1021, initial value 0) that Plugwise uses for the checksums.
+    binascii.crc_hqx computes exactly that with a lookup table in C.
+    """
+    return binascii.crc_hqx(data, 0)
+
+def checksum(msg):
+    """return checksum of the message (everything between the header and the checksum) as sent on wire"""
+    return sc("%04X" % crc16(msg))
+
+def checksum_ok(frame):
+    """check the checksum of a complete frame, header & footer included"""
+    return frame[-6:-2] == checksum(frame[4:-6])
+
+def frame_header(frame):
+    """return (function code, sequence number) of a received frame without parsing the rest of it"""
+    return frame[4:8], frame[8:12]
+
+def frame_mac(frame):
+    """return MAC of the device that sent the frame.
+    Acks from the Stick itself don't contain a MAC, None is returned for those.
+    """
+    if frame[4:8] == ACK_FUNCTION_CODE:
+        return frame[16:32] if len(frame) == 38 else None
+    return frame[12:28]
+
+class FrameSplitter(object):
+    """splits a byte stream into frames that start with PACKET_HEADER and end with PACKET_FOOTER.
+    Anything between the frames (like the stray \\x83 bytes some firmwares send) is dropped.
+    """
+
+    def __init__(self):
+        self._buf = b''
+
+    def feed(self, data):
+        """add data read from the wire
+        @return: list of complete frames, header & footer included
+        """
+        buf = self._buf + data
+        frames = []
+        while 1:
+            start = buf.find(PACKET_HEADER)
+            if start < 0:
+                # keep the tail in case it's the beginning of a header
+                buf = buf[-(len(PACKET_HEADER)-1):]
+                break
+            end = buf.find(PACKET_FOOTER, start)
+            if end < 0:
+                buf = buf[start:]
+                break
+            end += len(PACKET_FOOTER)
+            frames.append(buf[start:end])
+            buf = buf[end:]
+        self._buf = buf
+        return frames
+
+class _FrameWaiter(object):
+    __slots__ = ('event', 'frame', 'since')
+
+    def __init__(self, since):
+        self.event = threading.Event()
+        self.frame = None
+        self.since = since
+
 class SerialComChannel(object):
     """simple wrapper around serial module"""
 
-    def __init__(self, port="/dev/ttyUSB0", baud=115200, bits=8, stop=1, parity='N', timeout=5):
+    def __init__(self, port="/dev/ttyUSB0", baud=115200, bits=8, stop=1, parity='N', timeout=5, capture=None):
+        """
+        @param port: device name or an object that behaves like serial.Serial (e.g. capture.ReplaySerial)
+        @param capture: record all the traffic to this file, see capture.CaptureSerial
+        """
         self.port = port
         self.baud = baud
         self.bits = bits
         self.stop = stop
         self.parity = parity
-        self._fd = serial.Serial(port, baudrate=baud, bytesize=bits, stopbits=stop, parity=parity, timeout=timeout)
+        self.timeout = timeout
+        if hasattr(port, 'read') and hasattr(port, 'write'):
+            self._fd = port
+            self._fd.timeout = timeout
+        else:
+            self._fd = serial.Serial(port, baudrate=baud, bytesize=bits, stopbits=stop, parity=parity, timeout=timeout)
+        if capture is not None:
+            self._fd = CaptureSerial(self._fd, capture)
+
+        self._route_lock = threading.Lock()
+        self._waiters = {}
+        self._subscribers = {}
+        self._mailbox = {}
+        self._reader = None
+        self._reader_stop = threading.Event()
 
     def open(self):
         self._fd = Serial(port=self.port, baudrate=self.baud, bytesize=self.bits, parity='N', stopbits=stop)
@@ -55,3 +163,169 @@ class SerialComChannel(object):
 
     def write(self, data):
         self._fd.write(data)
+
+    def read_frame(self):
+        """read a single frame from the wire, only usable when the reader thread isn't running
+        will raise TimeoutException if nothing was received before timeout
+        frames with broken checksum are skipped
+        """
+        while 1:
+            msg = self.readline()
+            if msg == b"":
+                raise TimeoutException("Timeout while waiting for response from device")
+
+            debug("read:"+repr(msg)+" with length "+str(len(msg)))
+
+            header_start = msg.find(PACKET_HEADER)
+            if header_start > 0:
+                # 2011 firmware seems to sometimes send extra \x83 byte before some of the
+                # response messages but there might a all kinds of chatter going on so just 
+                # look for our packet header
+                msg = msg[header_start:]
+
+            if header_start < 0 or checksum_ok(msg):
+                return msg
+
+            error("dropping frame with broken checksum: "+repr(msg))
+
+    @property
+    def reader_running(self):
+        return self._reader is not None
+
+    def start_reader(self):
+        """start a thread that reads everything that arrives on the wire and routes
+        the frames to the waiters & subscribers. After this frames should only be
+        received through wait_frame() and subscribe().
+        """
+        if self._reader is not None:
+            return
+        self._reader_stop.clear()
+        self._fd.timeout = READER_POLL_INTERVAL
+        self._reader = threading.Thread(target=self._reader_loop, name="plugwise-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop_reader(self):
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        self._reader.join()
+        self._reader = None
+        self._fd.timeout = self.timeout
+
+    def _reader_loop(self):
+        splitter = FrameSplitter()
+        last_tick = time.time()
+        while not self._reader_stop.is_set():
+            try:
+                data = self._fd.read(self._fd.in_waiting or 1)
+            except serial.SerialException as reason:
+                error("reader failed: "+str(reason))
+                self._reader_stop.wait(READER_POLL_INTERVAL)
+                continue
+
+            if data:
+                debug("read:"+repr(data))
+                for frame in splitter.feed(data):
+                    if not checksum_ok(frame):
+                        error("dropping frame with broken checksum: "+repr(frame))
+                        continue
+                    try:
+                        self._route_frame(frame[4:8], frame)
+                    except Exception as reason:
+                        error("failed to route frame "+repr(frame)+": "+str(reason))
+
+            now = time.time()
+            if not data or now - last_tick >= READER_POLL_INTERVAL:
+                last_tick = now
+                self._reader_tick()
+
+    def _reader_tick(self):
+        """called periodically from the reader thread"""
+        pass
+
+    def _route_frame(self, function_code, frame):
+        """hand frame over to whoever is waiting for it.
+        One waiter gets the frame and all the subscribers see it.
+        If nobody is waiting the frame is kept in a small mailbox so that a reply that
+        arrives before its waiter is registered doesn't get lost.
+        """
+        mac = frame_mac(frame)
+        now = time.time()
+        with self._route_lock:
+            subscribers = self._subscribers.get((function_code, mac), []) + \
+                self._subscribers.get((function_code, None), []) + \
+                self._subscribers.get((None, None), [])
+
+            waiter = None
+            for key in ((function_code, mac), (function_code, None)):
+                waiters = self._waiters.get(key)
+                if waiters:
+                    waiter = waiters.pop(0)
+                    break
+
+            if waiter is None:
+                box = self._mailbox.setdefault((function_code, mac), deque(maxlen=MAILBOX_SIZE))
+                box.append((now, frame))
+
+        if waiter is not None:
+            waiter.frame = frame
+            waiter.event.set()
+
+        for callback in subscribers:
+            try:
+                callback(frame)
+            except Exception as reason:
+                error("subscriber failed: "+str(reason))
+
+    def wait_frame(self, function_code, mac=None, timeout=None, since=None):
+        """wait until a frame with the given function code arrives from the device
+        @param mac: only accept frames from this device, None accepts frame from any device
+        @param since: also accept frames that arrived before the call but after this timestamp
+        @return: the frame or None if it didn't arrive before the timeout
+        """
+        waiter = _FrameWaiter(since)
+        key = (function_code, mac)
+        with self._route_lock:
+            if since is not None:
+                frame = self._take_from_mailbox(function_code, mac, since)
+                if frame is not None:
+                    return frame
+            self._waiters.setdefault(key, []).append(waiter)
+
+        if waiter.event.wait(timeout):
+            return waiter.frame
+
+        with self._route_lock:
+            try:
+                self._waiters[key].remove(waiter)
+            except ValueError:
+                pass
+        # the frame might have been handed over right after the timeout
+        return waiter.frame
+
+    def _take_from_mailbox(self, function_code, mac, since):
+        if mac is None:
+            boxes = [box for key, box in self._mailbox.items() if key[0] == function_code]
+        else:
+            boxes = [self._mailbox.get((function_code, mac), ())]
+        for box in boxes:
+            for item in list(box):
+                if item[0] >= since:
+                    box.remove(item)
+                    return item[1]
+        return None
+
+    def subscribe(self, callback, function_code=None, mac=None):
+        """call callback(frame) for every frame with the given function code & MAC.
+        None works as a wildcard, MAC can only be a wildcard if function_code isn't.
+        """
+        with self._route_lock:
+            self._subscribers.setdefault((function_code, mac), []).append(callback)
+
+    def unsubscribe(self, callback, function_code=None, mac=None):
+        with self._route_lock:
+            try:
+                self._subscribers[(function_code, mac)].remove(callback)
+            except (KeyError, ValueError):
+                pass
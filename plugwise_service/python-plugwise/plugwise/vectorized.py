@@ -0,0 +1,64 @@
+# Use of this source code is governed by the MIT license found in the LICENSE file.
+
+"""
+NumPy versions of the pulse -> energy conversions in Circle.
+
+They take arrays of pulse counts and the calibration of the devices and
+convert all of them in one call. Results are the same as the ones of
+Circle.pulse_correction & co. Calibration arrays broadcast against the
+pulse arrays, so for a (devices, samples) array of pulses the calibration
+values should have shape (devices, 1), see calibration_arrays().
+
+NumPy is an optional dependency (pip install plugwiselib[numpy]).
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .api import PULSES_PER_KW_SECOND
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("plugwise.vectorized requires numpy")
+
+def calibration_arrays(circles):
+    """return (gain_a, gain_b, off_ruis, off_tot) arrays of shape (len(circles), 1)
+    Circles that haven't been calibrated yet are calibrated first.
+    """
+    _require_numpy()
+    for c in circles:
+        c._ensure_calibrated()
+    return tuple(np.array([[getattr(c, x)] for c in circles], dtype=float)
+        for x in ('gain_a', 'gain_b', 'off_ruis', 'off_tot'))
+
+def pulse_correction_array(pulses, calibration, seconds=1):
+    """array version of Circle.pulse_correction
+    @param pulses: array of pulse counters
+    @param calibration: (gain_a, gain_b, off_ruis, off_tot), scalars or arrays
+    @param seconds: over how many seconds were the pulses counted
+    """
+    _require_numpy()
+    gain_a, gain_b, off_ruis, off_tot = calibration
+    pulses = np.asarray(pulses, dtype=float)
+    offset_pulses = pulses / float(seconds) + off_ruis
+    corrected = seconds * (((offset_pulses**2) * gain_b) + (offset_pulses * gain_a) + off_tot)
+    # zero pulses means zero usage, the calibration offsets would say otherwise
+    return np.where(pulses == 0, 0.0, corrected)
+
+def pulses_to_kWs_array(pulses):
+    """array version of Circle.pulses_to_kWs"""
+    _require_numpy()
+    return np.asarray(pulses, dtype=float) / PULSES_PER_KW_SECOND
+
+def power_usage_array(pulses_1s, calibration):
+    """convert 1 second pulse counters to Watts like Circle.get_power_usage does"""
+    watts = pulses_to_kWs_array(pulse_correction_array(pulses_1s, calibration)) * 1000
+    return np.maximum(watts, 0.0)
+
+def history_usage_array(pulses_hour, calibration):
+    """convert hourly pulse counters from the log buffers to watt-hours like
+    Circle.get_power_usage_history does
+    """
+    return pulses_to_kWs_array(pulse_correction_array(pulses_hour, calibration, 3600)) / 3600 * 1000
@@ -5,7 +5,7 @@ from setuptools import setup, find_packages
 
 VERSION = '0.2'
 
-install_reqs = ['crcmod', 'pyserial']
+install_reqs = ['pyserial']
 
 setup(name='plugwiselib', 
     version=VERSION,
@@ -17,6 +17,7 @@ setup(name='plugwiselib',
     packages=find_packages(),
     py_modules=['plugwise'],
     install_requires=install_reqs,
+    extras_require={'numpy': ['numpy']},
     scripts=['plugwise_util'],
 )
 
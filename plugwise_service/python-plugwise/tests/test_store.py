@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from plugwise.store import CalibrationStore
+
+class CalibrationStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        path = os.path.join(self.dir, "calibration.json")
+        CalibrationStore(path).put_calibration(b'000D6F0000000001', (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual(CalibrationStore(path).get_calibration(b'000D6F0000000001'), (1.0, 2.0, 3.0, 4.0))
+
+    def test_unwritable_path(self):
+        store = CalibrationStore(os.path.join(self.dir, "missing", "calibration.json"))
+        # the values can't be saved but are still kept in memory
+        store.put_calibration(b'000D6F0000000001', (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual(store.get_calibration(b'000D6F0000000001'), (1.0, 2.0, 3.0, 4.0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import datetime
+import time
+import unittest
+
+from plugwise.api import PowerSample
+from plugwise.telemetry import EnergyMeter
+
+def _ts(dt):
+    return time.mktime(dt.timetuple())
+
+class EnergyMeterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hours = []
+        self.meter = EnergyMeter(hour_callback=lambda mac, hour, wh: self.hours.append((hour, wh)))
+
+    def test_hour_rollover(self):
+        start = datetime.datetime(2026, 1, 1, 10, 30)
+        self.meter.update('m', PowerSample(_ts(start), 100.0, 100.0, 50.0))
+        used = self.meter.update('m', PowerSample(_ts(start.replace(hour=11, minute=15)), 100.0, 100.0, 25.0))
+
+        self.assertEqual(self.hours, [(datetime.datetime(2026, 1, 1, 10), 100.0)])
+        self.assertAlmostEqual(used, 75.0)
+
+    def test_samples_3_hours_apart(self):
+        start = datetime.datetime(2026, 1, 1, 10, 30)
+        self.meter.update('m', PowerSample(_ts(start), 100.0, 100.0, 50.0))
+        used = self.meter.update('m', PowerSample(_ts(start.replace(hour=13)), 200.0, 200.0, 10.0))
+
+        # the half hour after the first sample, then the two hours without samples
+        self.assertEqual(self.hours, [
+            (datetime.datetime(2026, 1, 1, 10), 100.0),
+            (datetime.datetime(2026, 1, 1, 11), 150.0),
+            (datetime.datetime(2026, 1, 1, 12), 150.0),
+        ])
+        self.assertAlmostEqual(used, 50.0 + 150.0 + 150.0 + 10.0)
+        self.assertAlmostEqual(self.meter.total('m'), used)
+
+if __name__ == '__main__':
+    unittest.main()